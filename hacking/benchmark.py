@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+End-to-end throughput benchmark for re-core.
+
+Runs the real `recore.amqp.receive`, `recore.job.create.release` and
+`recore.fsm.FSM` code against the in-process broker and document store
+from `fakes.py`, with simulated workers answering every step.
+
+Each (playbook size, concurrency) scenario runs in a fresh child
+process so peak memory numbers don't bleed into each other. Results
+can be saved with --output and compared against a previous run (say,
+from another commit) with --compare:
+
+    source hacking/setup-env
+    ./hacking/benchmark.py --output before.json
+    git checkout my-branch
+    ./hacking/benchmark.py --compare before.json
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import pika.spec
+
+import fakes
+import recore.journal
+import recore.mongo
+import recore.store.sqlite
+import recore.wal
+
+
+MQ_CONF = {
+    'NAME': 'bench',
+    'PASSWORD': 'bench',
+    'SERVER': 'localhost',
+    'PORT': 5672,
+    'EXCHANGE': 're',
+    'QUEUE': 're',
+}
+CLIENT_QUEUE = 'bench.client'
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values`. None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def summarize(values):
+    """Latency summary in milliseconds. Every figure is None if there
+were no samples."""
+    if not values:
+        return {'p50': None, 'p90': None, 'p99': None, 'max': None}
+    return {
+        'p50': round(percentile(values, 50) * 1000, 3),
+        'p90': round(percentile(values, 90) * 1000, 3),
+        'p99': round(percentile(values, 99) * 1000, 3),
+        'max': round(max(values) * 1000, 3),
+    }
+
+
+def playbook(project, steps, plugins):
+    return {
+        'project': project,
+        'steps': [{
+            'name': 'step %d' % i,
+            'plugin': 'bench%d' % (i % plugins),
+            'parameters': {'command': 'true', 'index': i},
+        } for i in xrange(steps)]
+    }
+
+
+class Scenario(object):
+    """One benchmark run: `releases` releases of a `steps` long
+playbook, never more than `concurrency` of them in flight at once."""
+
+    def __init__(self, steps, concurrency, releases, plugins, workers,
+                 latency, db_latency=0.0, wal=None, sqlite=None):
+        self.steps = steps
+        self.concurrency = concurrency
+        self.releases = releases
+        self.plugins = plugins
+        self.workers = workers
+        self.latency = latency
+
+        self.broker = fakes.FakeBroker(observer=self.observe)
+        if sqlite:
+            self.database = recore.store.sqlite.Database(sqlite)
+        else:
+            self.database = fakes.FakeDatabase()
+            self.database.write_latency = db_latency
+        self.wal = wal
+        self.slots = threading.Semaphore(concurrency)
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.finished = 0
+        self.submitted = collections.deque()
+        self.create_latency = []
+        self.release_duration = []
+        self.step_turnaround = []
+        self.step_latency = []
+        self._dispatched = {}
+        self._replied = {}
+
+    # Measurements ---------------------------------------------------
+    def observe(self, event, correlation_id, when):
+        """Called by the broker and the simulated workers. The time
+        between the core dispatching a step and the worker replying
+        that it's done is the step latency. The time between a worker
+        replying and the next step of the same release arriving at a
+        worker is pure core overhead: that's the step turnaround, which
+        a one step playbook has none of."""
+        with self.lock:
+            if event == 'dispatched':
+                self._dispatched[correlation_id] = when
+            elif event == 'replied':
+                self._replied[correlation_id] = when
+                if correlation_id in self._dispatched:
+                    self.step_latency.append(
+                        when - self._dispatched.pop(correlation_id))
+            elif correlation_id in self._replied:
+                self.step_turnaround.append(
+                    when - self._replied.pop(correlation_id))
+
+    def on_fsm_finished(self, fsm, duration):
+        with self.lock:
+            self.release_duration.append(duration)
+            self.finished += 1
+            if self.finished == self.releases:
+                self.done.set()
+        self.slots.release()
+
+    # Plumbing -------------------------------------------------------
+    def install(self):
+        """Point recore at the fake broker and store"""
+        fakes.install_core(self.broker, self.database, MQ_CONF,
+                           on_finished=self.on_fsm_finished)
+        if self.wal:
+            recore.wal.init_wal({'PATH': self.wal}, self.database)
+        self.database['playbooks'].insert(
+            playbook('bench', self.steps, self.plugins))
+        self.broker.queue(CLIENT_QUEUE)
+        for plugin in xrange(self.plugins):
+            for _ in xrange(self.workers):
+                fakes.SimulatedWorker(
+                    lambda: self.broker.connection().channel(),
+                    'bench%d' % plugin,
+                    latency=lambda: self.latency,
+                    observer=self.observe).start()
+
+    def client(self):
+        """Collect the {"id": ...} replies to our job.create requests"""
+        channel = self.broker.connection().channel()
+        for (method, properties, body) in channel.consume(CLIENT_QUEUE):
+            now = time.time()
+            # The core answers job.create in the order it receives them
+            # and doesn't echo a correlation id, so match up in order
+            with self.lock:
+                self.create_latency.append(now - self.submitted.popleft())
+
+    def submit(self):
+        channel = self.broker.connection().channel()
+        body = json.dumps({'project': 'bench', 'dynamic': {}})
+        for n in xrange(self.releases):
+            self.slots.acquire()
+            props = pika.spec.BasicProperties(
+                reply_to=CLIENT_QUEUE, correlation_id=str(n))
+            with self.lock:
+                self.submitted.append(time.time())
+            channel.basic_publish(MQ_CONF['EXCHANGE'], 'job.create',
+                                  body, props)
+
+    def run(self, timeout):
+        self.install()
+        fakes.run_core(self.broker, MQ_CONF)
+        client = threading.Thread(target=self.client)
+        client.daemon = True
+        client.start()
+
+        started = time.time()
+        submitter = threading.Thread(target=self.submit)
+        submitter.daemon = True
+        submitter.start()
+        completed = self.done.wait(timeout)
+        elapsed = time.time() - started
+
+        return {
+            'steps': self.steps,
+            'concurrency': self.concurrency,
+            'releases': self.finished,
+            'timed_out': not completed,
+            'elapsed': round(elapsed, 3),
+            'releases_per_sec': round(self.finished / elapsed, 2),
+            'steps_per_sec': round(self.finished * self.steps / elapsed, 2),
+            'create_latency_ms': summarize(self.create_latency),
+            'step_latency_ms': summarize(self.step_latency),
+            'step_turnaround_ms': summarize(self.step_turnaround),
+            'release_duration_ms': summarize(self.release_duration),
+            'peak_rss_kb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+            'threads_at_end': threading.active_count(),
+            'db_bytes_per_release': (
+                getattr(self.database, 'bytes_written', 0) /
+                max(self.finished, 1)),
+            'mq_bytes_per_release': (
+                self.broker.bytes_published / max(self.finished, 1)),
+        }
+
+
+######################################################################
+def run_one(args):
+    """Child process: run exactly one scenario, print it as JSON"""
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    recore.journal.init_journal({'ENABLED': bool(args.journal),
+                                 'SNAPSHOT_EVERY': args.journal})
+    recore.mongo.PLAYBOOK_VERSIONS = args.versions
+    scratch = tempfile.mkdtemp()
+    wal = sqlite = None
+    if args.wal:
+        wal = os.path.join(scratch, 'state.wal')
+    if args.store == 'sqlite':
+        sqlite = os.path.join(scratch, 'recore.db')
+    scenario = Scenario(args.one[0], args.one[1], args.releases,
+                        args.plugins, args.workers or args.one[1],
+                        args.latency, args.db_latency, wal, sqlite)
+    print json.dumps(scenario.run(args.timeout))
+    sys.stdout.flush()
+    shutil.rmtree(scratch)
+    # FSM threads which never finished would keep us alive forever
+    os._exit(0)
+
+
+def run_all(args):
+    results = []
+    for steps in args.steps:
+        for concurrency in args.concurrency:
+            cmd = [sys.executable, os.path.abspath(__file__),
+                   '--one', str(steps), str(concurrency),
+                   '--releases', str(args.releases),
+                   '--plugins', str(args.plugins),
+                   '--workers', str(args.workers),
+                   '--latency', str(args.latency),
+                   '--timeout', str(args.timeout),
+                   '--journal', str(args.journal),
+                   '--db-latency', str(args.db_latency),
+                   '--store', args.store]
+            if args.wal:
+                cmd.append('--wal')
+            if args.versions:
+                cmd.append('--versions')
+            if args.verbose:
+                cmd.append('--verbose')
+            child = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            (stdout, _) = child.communicate()
+            try:
+                result = json.loads(stdout.strip().splitlines()[-1])
+            except (ValueError, IndexError):
+                result = {'steps': steps, 'concurrency': concurrency,
+                          'error': 'child exited %s' % child.returncode}
+            results.append(result)
+            report_line(result)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+HEADER = "%6s %5s %9s %10s %10s %10s %10s %10s %10s %10s" % (
+    'steps', 'conc', 'rel/s', 'step p50', 'step p99', 'turn p50',
+    'turn p99', 'create p99', 'peak MB', 'db B/rel')
+
+
+def ms(value):
+    """A latency figure for the report, n/a if nothing was measured"""
+    if value is None:
+        return '%10s' % 'n/a'
+    return '%10.3f' % value
+
+
+def report_line(r):
+    if 'error' in r:
+        print "%6s %5s  ERROR: %s" % (r['steps'], r['concurrency'],
+                                      r['error'])
+        return
+    print "%6s %5s %9.2f %s %s %s %s %s %10.1f %10d%s" % (
+        r['steps'], r['concurrency'], r['releases_per_sec'],
+        ms(r['step_latency_ms']['p50']), ms(r['step_latency_ms']['p99']),
+        ms(r['step_turnaround_ms']['p50']),
+        ms(r['step_turnaround_ms']['p99']),
+        ms(r['create_latency_ms']['p99']), r['peak_rss_kb'] / 1024.0,
+        r['db_bytes_per_release'],
+        ' (TIMED OUT)' if r['timed_out'] else '')
+    sys.stdout.flush()
+
+
+def compare(results, baseline_path):
+    baseline = json.load(open(baseline_path))
+    old = dict(((r['steps'], r['concurrency']), r)
+               for r in baseline['results'] if 'error' not in r)
+    print
+    print "Compared to %s (%s):" % (baseline_path, baseline['revision'])
+    print "%6s %5s %12s %12s %12s %12s" % (
+        'steps', 'conc', 'rel/s', 'step p99', 'turn p99', 'peak MB')
+
+    def delta(new, was):
+        if new is None or not was:
+            return '%12s' % 'n/a'
+        return '%+11.1f%%' % ((new - was) * 100.0 / was)
+
+    for r in results:
+        key = (r['steps'], r['concurrency'])
+        if 'error' in r or key not in old:
+            continue
+        o = old[key]
+        print "%6s %5s %s %s %s %s" % (
+            r['steps'], r['concurrency'],
+            delta(r['releases_per_sec'], o['releases_per_sec']),
+            # Runs saved before step latency was measured have none
+            delta(r['step_latency_ms']['p99'],
+                  o.get('step_latency_ms', {}).get('p99')),
+            delta(r['step_turnaround_ms']['p99'],
+                  o['step_turnaround_ms']['p99']),
+            delta(r['peak_rss_kb'], o['peak_rss_kb']))
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='re-core benchmark')
+    parser.add_argument('--steps', type=int_list, default=[1, 5, 20],
+                        help='Comma separated playbook sizes')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 10, 50],
+                        help='Comma separated numbers of releases in flight')
+    parser.add_argument('--releases', type=int, default=100,
+                        help='Releases to run per scenario')
+    parser.add_argument('--plugins', type=int, default=1,
+                        help='Spread steps over this many worker plugins')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Workers per plugin (default: concurrency)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Simulated seconds each step takes in a worker')
+    parser.add_argument('--timeout', type=float, default=300.0,
+                        help='Give up on a scenario after this many seconds')
+    parser.add_argument('--journal', type=int, default=0, metavar='N',
+                        help='Journal release state, snapshotting every '
+                        'N entries (default: update the state document)')
+    parser.add_argument('--db-latency', type=float, default=0.0,
+                        help='Simulated seconds each MongoDB write takes')
+    parser.add_argument('--store', choices=('fake', 'sqlite'),
+                        default='fake',
+                        help='Keep documents in the in-memory fake MongoDB '
+                        'or an SQLite file (--db-latency is fake only)')
+    parser.add_argument('--wal', action='store_true',
+                        help='Write state through a write-ahead log')
+    parser.add_argument('--versions', action='store_true',
+                        help='Reference stored playbook versions from '
+                        'state documents instead of copying the steps')
+    parser.add_argument('--output', help='Save the results as JSON here')
+    parser.add_argument('--compare', help='Compare against a saved run')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Let the core log at INFO')
+    parser.add_argument('--one', type=int, nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        run_one(args)
+
+    print "re-core benchmark @ %s" % git_revision()
+    print HEADER
+    results = run_all(args)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'when': datetime.datetime.utcnow().isoformat(),
+                'args': dict((k, v) for (k, v) in vars(args).iteritems()
+                             if k not in ('output', 'compare', 'one')),
+                'results': results,
+            }, fp, indent=4, sort_keys=True)
+        print "Saved results to %s" % args.output
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process stand-ins for RabbitMQ and MongoDB.
+
+These are just good enough to drive `recore.amqp.receive`,
+`recore.job.create.release` and `recore.fsm.FSM` without any servers
+running. The broker is the core's local transport
+(`recore.transport.local`) plus simulated outages. They are used by
+the benchmark and load generator scripts in this directory, NOT by
+the unit tests.
+"""
+
+import bson
+import collections
+import random
+import threading
+import time
+import pika.exceptions
+import pika.spec
+import pymongo.errors
+from bson.objectid import ObjectId
+import recore.transport.local
+from recore.store.query import apply_update, get, matches, project
+
+
+######################################################################
+# The broker
+class FakeBroker(recore.transport.local.Broker):
+    """The in-process broker, plus outages: partition() cuts the core
+off from it for a while.
+
+`observer`, if given, is called as ``observer('dispatched',
+correlation_id, timestamp)`` whenever a step is sent to a worker
+queue."""
+
+    def __init__(self, observer=None):
+        super(FakeBroker, self).__init__()
+        # Bumped by partition(), which breaks the core's connections
+        self.core_generation = 0
+        self.core_cut_off = False
+        self.observer = observer or (lambda *args: None)
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        if exchange == '' and routing_key.startswith('worker.'):
+            # Before it's routed: the worker may answer right away
+            self.observer('dispatched',
+                          getattr(properties, 'correlation_id', None),
+                          time.time())
+        return super(FakeBroker, self).publish(exchange, routing_key,
+                                               body, properties)
+
+    def connection(self, core=False):
+        """A new connection. Connections made with `core` set are the
+        core's, which partition() cuts off."""
+        if core and self.core_cut_off:
+            raise pika.exceptions.AMQPConnectionError(
+                "Connection refused (partitioned)")
+        return FakeConnection(self, core)
+
+    def partition(self, seconds):
+        """Cut the core off from the broker for `seconds`: its open
+        connections break and new ones are refused. Queues and
+        everybody else's connections are left alone. Returns at once."""
+        with self.lock:
+            self.core_cut_off = True
+            self.core_generation += 1
+
+        def heal():
+            time.sleep(seconds)
+            self.core_cut_off = False
+        t = threading.Thread(target=heal)
+        t.daemon = True
+        t.start()
+
+
+class FakeConnection(recore.transport.local.Connection):
+
+    def __init__(self, broker, core=False):
+        super(FakeConnection, self).__init__(broker)
+        self.core = core
+        self.generation = broker.core_generation
+
+    @property
+    def is_open(self):
+        if self.core and self.generation != self.broker.core_generation:
+            return False
+        return self._open
+
+
+class _CoreSide(object):
+    """A FakeBroker as the core's local transport sees it"""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def connection(self):
+        return self.broker.connection(core=True)
+
+
+######################################################################
+# The document store
+class FakeIndex(object):
+    """An index on `fields`. Only equality lookups on the first field
+use it, which is all recore needs."""
+
+    def __init__(self, fields, unique=False, sparse=False):
+        self.fields = fields
+        self.unique = unique
+        self.sparse = sparse
+        # first field's value: set of _ids
+        self.first = collections.defaultdict(set)
+        # all fields' values: _id, for unique indexes
+        self.keys = {}
+
+    def _key(self, doc):
+        values = tuple(get(doc, f) for f in self.fields)
+        if self.sparse and not values[0][1]:
+            return None
+        key = tuple(v for (v, _) in values)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def add(self, doc):
+        key = self._key(doc)
+        if key is None:
+            return
+        if self.unique and self.keys.get(key, doc['_id']) != doc['_id']:
+            raise pymongo.errors.DuplicateKeyError(
+                "E11000 duplicate key on %s: %s" % (self.fields, key))
+        self.keys[key] = doc['_id']
+        self.first[key[0]].add(doc['_id'])
+
+    def remove(self, doc):
+        key = self._key(doc)
+        if key is None:
+            return
+        if self.keys.get(key) == doc['_id']:
+            del self.keys[key]
+        self.first[key[0]].discard(doc['_id'])
+
+
+class FakeCollection(object):
+    """Documents are stored BSON encoded so reads and writes pay a
+    serialization cost like they would against a real server, and so
+    we can count how many bytes we push at the database."""
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.docs = {}
+        self.indexes = {}
+
+    def _encode(self, doc):
+        data = bson.BSON.encode(doc)
+        self.database.bytes_written += len(data)
+        return data
+
+    def _candidates(self, spec):
+        """The _ids of the documents which might match `spec`: found
+        through _id or an index if possible, otherwise all of them"""
+        for (key, value) in (spec or {}).iteritems():
+            if isinstance(value, dict):
+                continue
+            if key == '_id':
+                return [value] if value in self.docs else []
+            for index in self.indexes.itervalues():
+                if index.fields[0] == key:
+                    try:
+                        return list(index.first.get(value, ()))
+                    except TypeError:
+                        break
+        return self.docs.keys()
+
+    def _store(self, doc, old=None):
+        for index in self.indexes.itervalues():
+            if old is not None:
+                index.remove(old)
+            index.add(doc)
+        self.docs[doc['_id']] = self._encode(doc)
+
+    def insert(self, doc_or_docs, **kwargs):
+        docs = doc_or_docs
+        if isinstance(doc_or_docs, dict):
+            docs = [doc_or_docs]
+        ids = []
+        time.sleep(self.database.write_latency)
+        with self.database.lock:
+            for doc in docs:
+                doc.setdefault('_id', ObjectId())
+                self._store(doc)
+                ids.append(doc['_id'])
+            self.database.writes += 1
+        if isinstance(doc_or_docs, dict):
+            return ids[0]
+        return ids
+
+    def find(self, spec=None, fields=None, **kwargs):
+        with self.database.lock:
+            self.database.reads += 1
+            found = [bson.BSON(self.docs[_id]).decode()
+                     for _id in self._candidates(spec)]
+        return [project(d, fields) for d in found
+                if matches(d, spec or {})]
+
+    def find_one(self, spec_or_id=None, fields=None, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        spec_or_id = spec_or_id or {}
+        if '_id' in spec_or_id and not isinstance(spec_or_id['_id'], dict):
+            with self.database.lock:
+                self.database.reads += 1
+                data = self.docs.get(spec_or_id['_id'])
+            if data is None:
+                return None
+            doc = bson.BSON(data).decode()
+            if matches(doc, spec_or_id):
+                return project(doc, fields)
+            return None
+        found = self.find(spec_or_id, fields)
+        if found:
+            return found[0]
+        return None
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        n = 0
+        time.sleep(self.database.write_latency)
+        with self.database.lock:
+            self.database.writes += 1
+            for _id in self._candidates(spec):
+                old = bson.BSON(self.docs[_id]).decode()
+                if not matches(old, spec):
+                    continue
+                doc = bson.BSON(self.docs[_id]).decode()
+                apply_update(doc, document)
+                self._store(doc, old)
+                n += 1
+                if not multi:
+                    break
+            if n == 0 and upsert:
+                doc = dict((k, v) for (k, v) in spec.items()
+                           if not isinstance(v, dict))
+                apply_update(doc, document)
+                doc.setdefault('_id', ObjectId())
+                self._store(doc)
+        return {'n': n, 'updatedExisting': n > 0, 'ok': 1.0, 'err': None}
+
+    def remove(self, spec_or_id=None, **kwargs):
+        with self.database.lock:
+            self.database.writes += 1
+            if spec_or_id is not None and not isinstance(spec_or_id, dict):
+                spec_or_id = {'_id': spec_or_id}
+            for _id in self._candidates(spec_or_id):
+                doc = bson.BSON(self.docs[_id]).decode()
+                if matches(doc, spec_or_id or {}):
+                    for index in self.indexes.itervalues():
+                        index.remove(doc)
+                    del self.docs[_id]
+
+    def count(self):
+        return len(self.docs)
+
+    def ensure_index(self, key_or_list, unique=False, sparse=False,
+                     **kwargs):
+        if isinstance(key_or_list, basestring):
+            fields = (key_or_list,)
+        else:
+            fields = tuple(k for (k, _) in key_or_list)
+        with self.database.lock:
+            if fields in self.indexes:
+                return
+            index = FakeIndex(fields, unique, sparse)
+            for data in self.docs.itervalues():
+                index.add(bson.BSON(data).decode())
+            self.indexes[fields] = index
+
+    create_index = ensure_index
+
+
+class FakeDatabase(object):
+    """Looks enough like a pymongo Database for recore.mongo"""
+
+    def __init__(self, name='re'):
+        self.name = name
+        self.lock = threading.RLock()
+        self.collections = {}
+        self.reads = 0
+        self.writes = 0
+        self.bytes_written = 0
+        # Seconds each write takes to come back, like a round trip
+        self.write_latency = 0.0
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = FakeCollection(self, name)
+            return self.collections[name]
+
+
+######################################################################
+# The workers
+class SimulatedWorker(threading.Thread):
+    """Consumes step messages from `worker.<plugin>` and answers them
+the way a real worker would: a `started` reply, then after `latency()`
+seconds a `completed` (or, `failure_rate` of the time, `failed`)
+reply.
+
+`connect` is called from inside the worker thread and must return an
+open channel. Anything with the pika BlockingChannel consume/publish
+API will do, so the same worker runs against a FakeBroker or a real
+RabbitMQ server.
+
+`observer`, if given, is called as ``observer(event, correlation_id,
+timestamp)`` for each 'received' and 'replied' event so callers can
+measure how fast the core turns steps around.
+    """
+
+    def __init__(self, connect, plugin, latency=lambda: 0.0,
+                 failure_rate=0.0, observer=None, rng=None):
+        super(SimulatedWorker, self).__init__()
+        self.daemon = True
+        self.connect = connect
+        self.plugin = plugin
+        self.queue_name = 'worker.%s' % plugin
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.observer = observer or (lambda *args: None)
+        self.rng = rng or random.Random()
+        self.handled = 0
+        self.failed = 0
+
+    def reply(self, channel, properties, status):
+        props = pika.spec.BasicProperties(
+            correlation_id=properties.correlation_id)
+        channel.basic_publish(exchange='',
+                              routing_key=properties.reply_to,
+                              body='{"status": "%s"}' % status,
+                              properties=props)
+
+    def run(self):
+        channel = self.connect()
+        channel.queue_declare(queue=self.queue_name, durable=True)
+        channel.basic_qos(prefetch_count=1)
+        for (method, properties, body) in channel.consume(self.queue_name):
+            self.observer('received', properties.correlation_id, time.time())
+            self.reply(channel, properties, 'started')
+            delay = self.latency()
+            if delay > 0:
+                time.sleep(delay)
+            if self.rng.random() < self.failure_rate:
+                self.failed += 1
+                status = 'failed'
+            else:
+                status = 'completed'
+            self.observer('replied', properties.correlation_id, time.time())
+            self.reply(channel, properties, status)
+            channel.basic_ack(method.delivery_tag)
+            self.handled += 1
+
+
+######################################################################
+# The core
+def install_core(broker, database, mq_conf, on_finished=None):
+    """Point recore at `broker` and `database` instead of real servers.
+
+`on_finished`, if given, is called as ``on_finished(fsm, seconds)``
+when each FSM thread exits.
+    """
+    import recore.amqp
+    import recore.fsm
+    import recore.mongo
+    import recore.transport.local
+    original_run = recore.fsm.FSM.run
+
+    def run(fsm):
+        started = time.time()
+        try:
+            return original_run(fsm)
+        finally:
+            if on_finished:
+                on_finished(fsm, time.time() - started)
+
+    # recore.fsm.FSM refers to itself by name in super() calls, so
+    # patch the class in place rather than swapping in a subclass
+    recore.fsm.FSM.run = run
+    recore.mongo.database = database
+    recore.mongo.ensure_indexes(database)
+    recore.transport.local.broker = _CoreSide(broker)
+    recore.amqp.configure(dict(mq_conf, TRANSPORT='local'))
+
+
+def run_core(broker, mq_conf, timeout=10.0):
+    """The core's consumer loop, `recore.amqp.run_forever` over the
+local transport. Runs forever in a daemon thread. Returns once the core
+is consuming (or after `timeout` seconds): until then its queue isn't
+bound and job messages published to the exchange are dropped."""
+    import recore.amqp
+    t = threading.Thread(target=recore.amqp.run_forever,
+                         args=(recore.amqp.MQ_CONF,))
+    t.daemon = True
+    t.start()
+    give_up = time.time() + timeout
+    while not recore.amqp.consuming and time.time() < give_up:
+        time.sleep(0.01)
+    return t
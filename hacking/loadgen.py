@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load generator and simulated worker fleet for re-core.
+
+Fires `job.create` at a fixed rate (open loop: it does not wait for
+the core to catch up) and runs a fleet of simulated `worker.<plugin>`
+consumers which answer each step with `started` and then `completed`
+or `failed` after a configurable latency. Once a second it prints how
+well the core is keeping up.
+
+Against a real broker and a running core (the MQ section of the
+core's config file is used to connect):
+
+    ./hacking/loadgen.py -c settings.json --rate 20 --duration 120 \\
+        --project myproject --plugin shexec,workers=8,latency=exp:0.5
+
+Or with a core, broker and store all in this process, for capacity
+planning without any servers:
+
+    ./hacking/loadgen.py --local --rate 50 --steps 5 \\
+        --plugin shexec,workers=20,latency=lognormal:-1.5:0.5,failure=0.01
+
+A plugin's limit=N option caps its concurrent steps in the core
+(--local only).
+
+Latency distributions (seconds):
+    const:S  uniform:LO:HI  exp:MEAN  normal:MEAN:STDDEV  lognormal:MU:SIGMA
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import pika
+import pika.spec
+import recore.admission
+import recore.events
+import recore.fsm.throttle
+
+import fakes
+
+
+LOCAL_MQ = {
+    'NAME': 'loadgen',
+    'PASSWORD': 'loadgen',
+    'SERVER': 'localhost',
+    'PORT': 5672,
+    'EXCHANGE': 're',
+    'QUEUE': 're',
+}
+
+
+def latency_distribution(spec, rng):
+    """Turn a spec like 'exp:0.5' into a callable returning seconds"""
+    parts = spec.split(':')
+    name = parts[0]
+    args = [float(a) for a in parts[1:]]
+    dists = {
+        'const': (1, lambda s: s),
+        'uniform': (2, rng.uniform),
+        'exp': (1, lambda mean: rng.expovariate(1.0 / mean)),
+        'normal': (2, rng.normalvariate),
+        'lognormal': (2, rng.lognormvariate),
+    }
+    if name not in dists or len(args) != dists[name][0]:
+        raise argparse.ArgumentTypeError(
+            "Bad latency distribution: %s" % spec)
+    fn = dists[name][1]
+    return lambda: max(0.0, fn(*args))
+
+
+def plugin_spec(value):
+    """'name,workers=4,latency=exp:0.2,failure=0.01,limit=8' -> dict"""
+    parts = value.split(',')
+    spec = {'name': parts[0]}
+    for part in parts[1:]:
+        try:
+            (k, v) = part.split('=', 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError("Bad plugin option: %s" % part)
+        if k not in ('workers', 'latency', 'failure', 'limit'):
+            raise argparse.ArgumentTypeError("Unknown plugin option: %s" % k)
+        spec[k] = v
+    return spec
+
+
+def outage_spec(value):
+    """Parse --outage SECONDS:DURATION"""
+    try:
+        (at, seconds) = value.split(':')
+        return (float(at), float(seconds))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected SECONDS:DURATION")
+
+
+class Stats(object):
+    """Counters and latency samples for the current reporting interval
+plus running totals"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = collections.Counter()
+        self.interval = collections.Counter()
+        self.create_latency = []
+        self.turnaround = []
+        self.sent_at = collections.deque()
+        self._replied = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.totals[name] += n
+            self.interval[name] += n
+
+    def sent(self):
+        with self.lock:
+            self.sent_at.append(time.time())
+            self.totals['sent'] += 1
+            self.interval['sent'] += 1
+
+    def created(self, body):
+        now = time.time()
+        with self.lock:
+            # The core answers job.create in order without echoing a
+            # correlation id, so match replies up in order
+            if self.sent_at:
+                self.create_latency.append(now - self.sent_at.popleft())
+            try:
+                ok = json.loads(body).get('id') is not None
+            except ValueError:
+                ok = False
+            name = 'created' if ok else 'rejected'
+            self.totals[name] += 1
+            self.interval[name] += 1
+
+    def worker_event(self, event, correlation_id, when):
+        with self.lock:
+            if event == 'replied':
+                self._replied[correlation_id] = when
+            else:
+                self.totals['dispatched'] += 1
+                self.interval['dispatched'] += 1
+                if correlation_id in self._replied:
+                    self.turnaround.append(
+                        when - self._replied.pop(correlation_id))
+
+    def take(self):
+        """Return and reset this interval's numbers"""
+        with self.lock:
+            interval = self.interval
+            create = self.create_latency
+            turnaround = self.turnaround
+            self.interval = collections.Counter()
+            self.create_latency = []
+            self.turnaround = []
+            return (interval, create, turnaround)
+
+
+def pct(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[int(round(p / 100.0 * (len(ordered) - 1)))] * 1000
+
+
+class LoadGenerator(object):
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.stats = Stats()
+        self.workers = []
+        if args.local:
+            self.mq = LOCAL_MQ
+            self.broker = fakes.FakeBroker()
+            self.database = fakes.FakeDatabase()
+        else:
+            self.mq = json.load(open(args.config))['MQ']
+
+    # Connections ----------------------------------------------------
+    def channel(self):
+        """A new channel on a new connection. pika connections must
+        not be shared between threads."""
+        if self.args.local:
+            return self.broker.connection().channel()
+        creds = pika.credentials.PlainCredentials(
+            self.mq['NAME'], self.mq['PASSWORD'])
+        connection = pika.BlockingConnection(pika.ConnectionParameters(
+            host=str(self.mq['SERVER']), credentials=creds))
+        return connection.channel()
+
+    def queue_depth(self, channel, queue):
+        try:
+            return channel.queue_declare(
+                queue=queue, passive=True).method.message_count
+        except pika.exceptions.AMQPError:
+            return -1
+
+    # Setup ----------------------------------------------------------
+    def start_local_core(self):
+        def finished(fsm, seconds):
+            self.stats.count('finished')
+
+        fakes.install_core(self.broker, self.database, self.mq,
+                           on_finished=finished)
+        recore.admission.init_admission(
+            {'MAX_ACTIVE': self.args.max_active})
+        recore.events.init_events({'ENABLED': self.args.events})
+        recore.fsm.throttle.init_throttle(dict(
+            (p['name'], {'CONCURRENCY': p['limit']})
+            for p in self.args.plugin if 'limit' in p))
+        plugins = [p['name'] for p in self.args.plugin]
+        for project in self.args.project:
+            self.database['playbooks'].insert({
+                'project': project,
+                'steps': [{
+                    'name': 'step %d' % i,
+                    'plugin': plugins[i % len(plugins)],
+                    'parameters': {'index': i},
+                } for i in xrange(self.args.steps)]
+            })
+        fakes.run_core(self.broker, self.mq)
+
+    def start_outage(self):
+        """Cut the core off from the broker for a while, --outage AT:SECS"""
+        (at, seconds) = self.args.outage
+
+        def cut():
+            time.sleep(at)
+            print "-- partitioning the core from the broker for %ss" % seconds
+            self.broker.partition(seconds)
+        t = threading.Thread(target=cut)
+        t.daemon = True
+        t.start()
+
+    def start_workers(self):
+        for spec in self.args.plugin:
+            latency = latency_distribution(
+                spec.get('latency', self.args.latency), self.rng)
+            failure = float(spec.get('failure', self.args.failure))
+            for _ in xrange(int(spec.get('workers', self.args.workers))):
+                worker = fakes.SimulatedWorker(
+                    self.channel, spec['name'],
+                    latency=latency,
+                    failure_rate=failure,
+                    observer=self.stats.worker_event,
+                    rng=random.Random(self.rng.random()))
+                worker.start()
+                self.workers.append(worker)
+
+    def start_reply_listener(self):
+        channel = self.channel()
+        reply_queue = channel.queue_declare(
+            queue='', exclusive=True).method.queue
+
+        def listen():
+            for (method, properties, body) in channel.consume(reply_queue):
+                self.stats.created(body)
+                channel.basic_ack(method.delivery_tag)
+
+        t = threading.Thread(target=listen)
+        t.daemon = True
+        t.start()
+        return reply_queue
+
+    def start_event_listener(self):
+        """Count the release events the core publishes"""
+        channel = self.channel()
+        queue = channel.queue_declare(
+            queue='', exclusive=True).method.queue
+        channel.queue_bind(queue=queue, exchange=self.mq['EXCHANGE'],
+                           routing_key='release.#')
+
+        def listen():
+            for (method, properties, body) in channel.consume(queue):
+                self.stats.count('event ' + json.loads(body)['event'])
+                channel.basic_ack(method.delivery_tag)
+
+        t = threading.Thread(target=listen)
+        t.daemon = True
+        t.start()
+
+    # Running --------------------------------------------------------
+    def fire(self, reply_queue):
+        """Publish job.create at `rate` per second until told to stop"""
+        channel = self.channel()
+        dynamic = json.loads(self.args.dynamic)
+        interval = 1.0 / self.args.rate
+        started = time.time()
+        n = 0
+        while not self.stop.is_set():
+            if self.args.count and n >= self.args.count:
+                break
+            # Schedule against the start time so we don't drift when
+            # publishing gets slow; that's the core's problem to show
+            delay = started + n * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            project = self.args.project[n % len(self.args.project)]
+            props = pika.spec.BasicProperties(reply_to=reply_queue)
+            channel.basic_publish(
+                exchange=self.mq['EXCHANGE'],
+                routing_key='job.create',
+                body=json.dumps({'project': project, 'dynamic': dynamic}),
+                properties=props)
+            self.stats.sent()
+            n += 1
+
+    def report(self, elapsed, monitor):
+        (interval, create, turnaround) = self.stats.take()
+        totals = self.stats.totals
+        in_flight = totals['created'] - totals['finished']
+        backlog = self.queue_depth(monitor, self.mq['QUEUE'])
+        worker_backlog = sum(
+            max(self.queue_depth(monitor, 'worker.%s' % p['name']), 0)
+            for p in self.args.plugin)
+        line = ("%6.0fs  sent %4d  created %4d  dispatched %5d  "
+                "create p99 %8.1fms  turn p99 %8.1fms  core q %5d  "
+                "worker q %5d" % (
+                    elapsed, interval['sent'], interval['created'],
+                    interval['dispatched'], pct(create, 99),
+                    pct(turnaround, 99), backlog, worker_backlog))
+        if self.args.local:
+            line += "  finished %4d  in flight %5d  queued %5d" % (
+                interval['finished'], in_flight, recore.admission.queued())
+        print line
+        sys.stdout.flush()
+
+    def run(self):
+        if self.args.local:
+            self.start_local_core()
+            if self.args.outage:
+                self.start_outage()
+        self.start_workers()
+        if self.args.events:
+            self.start_event_listener()
+        reply_queue = self.start_reply_listener()
+
+        self.stop = threading.Event()
+        firing = threading.Thread(target=self.fire, args=(reply_queue,))
+        firing.daemon = True
+        started = time.time()
+        firing.start()
+
+        monitor = self.channel()
+        try:
+            while firing.is_alive() or self.args.drain:
+                time.sleep(1)
+                elapsed = time.time() - started
+                self.report(elapsed, monitor)
+                if self.args.duration and elapsed >= self.args.duration:
+                    self.stop.set()
+                    if not self.args.drain:
+                        break
+                if not firing.is_alive() and self.args.drain:
+                    totals = self.stats.totals
+                    if totals['created'] + totals['rejected'] >= \
+                            totals['sent'] and (
+                                not self.args.local or
+                                totals['finished'] >= totals['created']) and (
+                                not self.args.events or
+                                totals['event release.ended'] >=
+                                totals['finished']):
+                        break
+                    if elapsed >= self.args.duration + self.args.drain:
+                        break
+        except KeyboardInterrupt:
+            self.stop.set()
+        self.summary(time.time() - started)
+
+    def summary(self, elapsed):
+        t = self.stats.totals
+        print
+        print "Ran for %.1fs" % elapsed
+        print "  job.create sent:     %d (%.1f/s offered)" % (
+            t['sent'], t['sent'] / elapsed)
+        print "  releases created:    %d (%.1f/s)" % (
+            t['created'], t['created'] / elapsed)
+        print "  rejected:            %d" % t['rejected']
+        print "  steps dispatched:    %d (%.1f/s)" % (
+            t['dispatched'], t['dispatched'] / elapsed)
+        handled = sum(w.handled for w in self.workers)
+        failed = sum(w.failed for w in self.workers)
+        print "  steps answered:      %d (%d failed)" % (handled, failed)
+        if self.args.local:
+            print "  releases finished:   %d" % t['finished']
+            for (plugin, sat) in sorted(recore.fsm.throttle.saturation().items()):
+                print "  %-20s %d in flight, %d held back" % (
+                    plugin + ':', sat['in_flight'], sat['waiting'])
+        events = sorted((k[len('event '):], v) for (k, v) in t.items()
+                        if k.startswith('event '))
+        if self.args.events:
+            print "  release events:      %d" % sum(v for (_, v) in events)
+            for (event, n) in events:
+                print "    %-18s %d" % (event + ':', n)
+        if t['sent'] and t['created'] < t['sent']:
+            print "  !! core did not answer %d job.create requests" % (
+                t['sent'] - t['created'] - t['rejected'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='re-core load generator',
+        epilog=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('-c', '--config',
+                        help='re-core config file (for the MQ section)')
+    target.add_argument('--local', action='store_true',
+                        help='Run the core, broker and store in-process')
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help='job.create messages per second')
+    parser.add_argument('--duration', type=float, default=60.0,
+                        help='Seconds to generate load for (0: forever)')
+    parser.add_argument('--count', type=int, default=0,
+                        help='Stop after sending this many job.create')
+    parser.add_argument('--drain', type=float, default=0.0,
+                        help='After sending, wait up to this many seconds '
+                        'for outstanding work to finish')
+    parser.add_argument('--project', action='append',
+                        help='Project(s) to release, round robin')
+    parser.add_argument('--dynamic', default='{}',
+                        help='JSON dynamic data sent with each job.create')
+    parser.add_argument('--plugin', action='append', type=plugin_spec,
+                        help='Worker plugin to simulate: '
+                        'NAME[,workers=N][,latency=DIST][,failure=RATE]')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Default workers per plugin')
+    parser.add_argument('--latency', default='const:0',
+                        help='Default step latency distribution')
+    parser.add_argument('--failure', type=float, default=0.0,
+                        help='Default fraction of steps which fail')
+    parser.add_argument('--steps', type=int, default=3,
+                        help='Playbook length (--local only)')
+    parser.add_argument('--max-active', type=int, default=0,
+                        help='Admission control limit on running FSMs '
+                        '(--local only, default unlimited)')
+    parser.add_argument('--outage', type=outage_spec,
+                        help='Partition the core from the broker SECONDS '
+                        'into the run, for DURATION seconds: '
+                        'SECONDS:DURATION (--local only)')
+    parser.add_argument('--events', action='store_true',
+                        help='Count the release events the core publishes '
+                        '(with --local, turn them on)')
+    parser.add_argument('--seed', type=int, help='Random seed')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Let the core log at INFO (--local only)')
+    args = parser.parse_args()
+
+    args.project = args.project or ['loadgen']
+    args.plugin = args.plugin or [{'name': 'shexec'}]
+    for spec in args.plugin:
+        latency_distribution(spec.get('latency', args.latency), random)
+    if args.local and not args.verbose:
+        logging.disable(logging.INFO)
+    logging.getLogger('pika').setLevel(logging.CRITICAL)
+
+    LoadGenerator(args).run()
+    sys.stdout.flush()
+    # Don't wait around for (or trip over) the daemon worker threads
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
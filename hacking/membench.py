@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory benchmark: what does holding N in-flight releases cost?
+
+Compares the FSM's old per-release representation (the whole state
+document as decoded from MongoDB, with its own copy of every step)
+against `recore.fsm.state.ReleaseState`, where the steps of a playbook
+version are parsed once and shared.
+
+Each representation is measured in its own child process, both as the
+deep size of the retained objects and as growth in resident memory.
+
+    source hacking/setup-env
+    ./hacking/membench.py --releases 1000 --steps 20
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import subprocess
+import sys
+import types
+import bson
+
+from recore.fsm.state import ReleaseState
+
+
+def state_document(project, steps):
+    """A state document, BSON encoded, as it would sit in MongoDB"""
+    return bson.BSON.encode({
+        'project': project,
+        'created': datetime.datetime.utcnow(),
+        'reply_to': None,
+        'dynamic': {'cart': 'bigcart', 'environment': 'qa'},
+        'completed_steps': [],
+        'active_step': {},
+        'remaining_steps': [{
+            'name': 'step %d' % i,
+            'plugin': 'shexec',
+            'parameters': {'command': 'run-thing --index %d' % i},
+            'dynamic': ['cart'],
+            'notify': {'complete': {'irc': {'channel': '#ops'}}},
+        } for i in xrange(steps)],
+    })
+
+
+def old_representation(data):
+    """What FSM held per release: the decoded document plus the
+    dynamic dict it copied out of it"""
+    state = bson.BSON(data).decode()
+    dynamic = {}
+    dynamic.update(state['dynamic'])
+    return (state, dynamic)
+
+
+def new_representation(data):
+    return ReleaseState.from_document(bson.BSON(data).decode())
+
+
+SKIP = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+
+
+def deep_sizeof(roots):
+    """Bytes used by everything reachable from `roots`, counting shared
+    objects once"""
+    seen = set()
+    total = 0
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SKIP):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return total
+
+
+def rss_kb():
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024
+
+
+def measure(kind, releases, steps):
+    build = {'old': old_representation, 'new': new_representation}[kind]
+    # Every release gets its own bytes, as if separately read from
+    # MongoDB, but all releases are of the same playbook version
+    docs = [state_document('bench', steps) for _ in xrange(releases)]
+    gc.collect()
+    before = rss_kb()
+    held = [build(d) for d in docs]
+    gc.collect()
+    after = rss_kb()
+    return {
+        'kind': kind,
+        'deep_bytes': deep_sizeof([held]),
+        'rss_kb': after - before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--releases', type=int, default=1000)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--one', choices=('old', 'new'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        print json.dumps(measure(args.one, args.releases, args.steps))
+        return
+
+    results = {}
+    for kind in ('old', 'new'):
+        out = subprocess.check_output([
+            sys.executable, os.path.abspath(__file__), '--one', kind,
+            '--releases', str(args.releases), '--steps', str(args.steps)])
+        results[kind] = json.loads(out)
+
+    print "%d in-flight releases of a %d step playbook" % (
+        args.releases, args.steps)
+    print "%-6s %14s %14s %12s" % ('', 'deep bytes', 'per release',
+                                   'RSS growth')
+    for kind in ('old', 'new'):
+        r = results[kind]
+        print "%-6s %14d %14d %10d kB" % (
+            kind, r['deep_bytes'], r['deep_bytes'] / args.releases,
+            r['rss_kb'])
+    print "new/old: %.1f%% of the memory" % (
+        100.0 * results['new']['deep_bytes'] / results['old']['deep_bytes'])
+
+
+if __name__ == '__main__':
+    main()
@@ -27,7 +27,8 @@ setup(name='re-core',
       url='https://github.com/rhinception/re-core',
       license='AGPLv3',
       package_dir={ 'recore': 'src/recore' },
-      packages=['recore', 'recore.job', 'recore.fsm'],
+      packages=['recore', 'recore.job', 'recore.fsm', 'recore.store',
+                'recore.transport'],
       scripts=[
          'bin/re-core',
       ]
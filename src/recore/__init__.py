@@ -17,7 +17,18 @@
 import recore.utils
 import logging
 import recore.mongo
+import recore.store
+import recore.admission
 import recore.amqp
+import recore.archive
+import recore.backoff
+import recore.events
+import recore.journal
+import recore.prefork
+import recore.schedule
+import recore.wal
+import recore.fsm.throttle
+import recore.job.create
 import sys
 import pika.exceptions
 
@@ -64,16 +75,38 @@ def main(args):  # pragma: no cover
     """
     Main script entry point.
 
+    With more than one worker (from --workers, or WORKERS in the
+    PREFORK config section) the core runs as that many processes under
+    a supervisor; see `recore.prefork`.
+
     *Note*: Not covered for unittests as it glues tested code together.
     """
-    import pymongo.errors
-
     config = parse_config(args.config)
+    workers = getattr(args, 'workers', None)
+    if workers is None:
+        workers = config.get('PREFORK', {}).get('WORKERS', 1)
+    if int(workers) > 1:
+        recore.prefork.supervise(config, int(workers))
+    else:
+        run(config)
+
+
+def run(config):  # pragma: no cover
+    """
+    Run the core with the parsed `config` until it is stopped.
+
+    *Note*: Not covered for unittests as it glues tested code together.
+    """
+    import pymongo.errors
 
     out = logging.getLogger('recore')
     notify = logging.getLogger('recore.stdout')
     try:
-        recore.mongo.init_mongo(config['DB'])
+        recore.store.init_store(config['DB'])
+    except ValueError, ve:
+        out.fatal("Bad DB config: %s. Exiting ..." % ve)
+        notify.fatal("Bad DB config: %s. Exiting ..." % ve)
+        raise SystemExit(1)
     except pymongo.errors.ConnectionFailure, cfe:
         out.fatal("Connection failiure to Mongo: %s. Exiting ..." % cfe)
         notify.fatal("Connection failiure to Mongo: %s. Exiting ..." % cfe)
@@ -83,13 +116,39 @@ def main(args):  # pragma: no cover
         notify.fatal("Unknown failiure with Mongo: %s. Exiting ..." % cfe)
         raise SystemExit(1)
 
+    recore.job.create.init_idempotency(config.get('IDEMPOTENCY', {}))
+    recore.fsm.throttle.init_throttle(config.get('PLUGINS', {}))
+    recore.journal.init_journal(config.get('JOURNAL', {}))
+
+    recore.backoff.init_backoff(config.get('RECONNECT', {}))
+    try:
+        recore.wal.init_wal(config.get('WAL', {}), recore.mongo.database)
+    except (IOError, ValueError, pymongo.errors.PyMongoError), ex:
+        out.fatal("Unable to use the write-ahead log: %s" % ex)
+        notify.fatal("Unable to use the write-ahead log: %s" % ex)
+        raise SystemExit(1)
     try:
-        connection = recore.amqp.init_amqp(config['MQ'])
-        connection.ioloop.start()
+        recore.archive.init_archive(config.get('ARCHIVE', {}),
+                                    recore.mongo.database)
+    except (ValueError, pymongo.errors.PyMongoError), ex:
+        out.fatal("Unable to archive releases: %s" % ex)
+        notify.fatal("Unable to archive releases: %s" % ex)
+        raise SystemExit(1)
+
+    try:
+        recore.amqp.configure(config['MQ'])
+        recore.events.init_events(config.get('EVENTS', {}))
+        recore.admission.init_admission(config.get('ADMISSION', {}))
+        recore.schedule.init_schedule(config.get('SCHEDULE', {}))
+        recore.amqp.run_forever(config['MQ'])
     except KeyError, ke:
         out.fatal("Missing a required key in MQ config: %s" % ke)
         notify.fatal("Missing a required key in MQ config: %s" % ke)
         raise SystemExit(1)
+    except ValueError, ve:
+        out.fatal("Bad MQ config: %s" % ve)
+        notify.fatal("Bad MQ config: %s" % ve)
+        raise SystemExit(1)
     except pika.exceptions.ProbableAuthenticationError, paex:
         out.fatal("Authentication issue connecting to AMQP: %s" % paex)
         notify.fatal("Authentication issue connecting to AMQP: %s" % paex)
@@ -103,7 +162,9 @@ def main(args):  # pragma: no cover
     except KeyboardInterrupt:
         out.info("KeyboardInterrupt sent.")
         notify.info("Keyboard Interrupt sent.")
-        connection.ioloop.stop()
+        recore.amqp.stopping = True
+        if recore.amqp.connection:
+            recore.amqp.connection.ioloop.stop()
         raise SystemExit(0)
 
     out.info('FSM fully initialized')
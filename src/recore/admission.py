@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Admission control.
+
+Every release used to get its FSM thread as soon as it was created.
+Past some point that only makes every release slower. Instead, a new
+release is started only while the core has capacity:
+
+* fewer than MAX_ACTIVE FSMs are running,
+* MongoDB state updates take less than MAX_DB_LATENCY seconds (a
+  moving average), and
+* no release is already waiting.
+
+Otherwise the release's state document is marked with a 'queued'
+status and it waits its turn; the id is sent back right away either
+way. Each FSM that finishes lets the next queued releases start, and
+they're marked 'running'. Releases still queued when the core stops
+are picked up again by `init_admission`. A release only starts if its
+status can still be changed from 'queued' to 'running', so when
+several cores (or prefork workers) pick up the same queue each release
+runs once, and one cancelled elsewhere doesn't run at all. Set the
+limits in the config (0 means no limit, which is the default):
+
+    "ADMISSION": {
+        "MAX_ACTIVE": 200,
+        "MAX_DB_LATENCY": 0.5
+    }
+"""
+
+import collections
+import logging
+import threading
+import pymongo.errors
+import recore.fsm
+import recore.fsm.registry
+import recore.mongo
+
+QUEUED = 'queued'
+RUNNING = 'running'
+
+MAX_ACTIVE = 0
+MAX_DB_LATENCY = 0
+# Weight of the latest sample in the moving average
+DB_LATENCY_ALPHA = 0.2
+
+db_latency = 0.0
+# Ids of releases waiting to start, oldest first
+_queued = collections.deque()
+_lock = threading.RLock()
+
+out = logging.getLogger('recore')
+
+
+def init_admission(conf):
+    """Configure admission control from the ADMISSION config section and
+resume any releases left queued in the database"""
+    import recore.admission
+    recore.admission.MAX_ACTIVE = int(conf.get('MAX_ACTIVE', 0))
+    recore.admission.MAX_DB_LATENCY = float(conf.get('MAX_DB_LATENCY', 0))
+    with _lock:
+        _queued.clear()
+        _queued.extend(recore.mongo.lookup_queued(recore.mongo.database))
+    out.info("Admission control: at most %s active FSMs, %s queued "
+             "releases to resume" % (MAX_ACTIVE or 'unlimited',
+                                     len(_queued)))
+    drain()
+
+
+def observe_db_latency(seconds):
+    """Feed in how long a MongoDB state update took"""
+    import recore.admission
+    recore.admission.db_latency = (
+        DB_LATENCY_ALPHA * seconds +
+        (1 - DB_LATENCY_ALPHA) * recore.admission.db_latency)
+
+
+def has_capacity():
+    """Whether another FSM may start now"""
+    active = recore.fsm.registry.count()
+    if active == 0:
+        # Nothing running means nothing to refresh the signals either
+        return True
+    if MAX_ACTIVE and active >= MAX_ACTIVE:
+        return False
+    if MAX_DB_LATENCY and db_latency > MAX_DB_LATENCY:
+        return False
+    return True
+
+
+def queued():
+    """How many releases are waiting to start"""
+    return len(_queued)
+
+
+def position(id):
+    """How many queued releases will start before `id`, or None if it
+is not queued"""
+    with _lock:
+        try:
+            return list(_queued).index(id)
+        except ValueError:
+            return None
+
+
+def unqueue(id):
+    """Stop release `id` from ever being started. Returns False if it
+was not queued."""
+    with _lock:
+        try:
+            _queued.remove(id)
+        except ValueError:
+            return False
+    return True
+
+
+def _start(id):
+    runner = recore.fsm.FSM(id)
+    # Count it now, not once its thread gets going
+    recore.fsm.registry.add(runner)
+    runner.start()
+    return runner
+
+
+def start(id):
+    """Start an FSM for the new release `id`, or queue it if the core is
+at capacity. Returns True if it was started."""
+    with _lock:
+        drain()
+        if not _queued and has_capacity():
+            _start(id)
+            return True
+        # Only queue it here once it can be claimed from the database
+        recore.mongo.set_status(recore.mongo.database, id, QUEUED)
+        _queued.append(id)
+    out.info("At capacity (%s active FSMs, db latency %.3fs). Queued "
+             "release %s behind %s others" % (
+                 recore.fsm.registry.count(), db_latency, id,
+                 len(_queued) - 1))
+    return False
+
+
+def drain():
+    """Start queued releases while there is capacity. Call whenever an
+FSM finishes. If MongoDB is unavailable the releases stay queued until
+the next call."""
+    with _lock:
+        while _queued and has_capacity():
+            id = _queued.popleft()
+            try:
+                claimed = recore.mongo.change_status(
+                    recore.mongo.database, id, QUEUED, RUNNING)
+            except pymongo.errors.PyMongoError, e:
+                _queued.appendleft(id)
+                out.warn("Unable to start queued release %s, leaving "
+                         "%s releases queued: %s" % (id, len(_queued), e))
+                return
+            if not claimed:
+                out.info("Queued release %s was started or cancelled "
+                         "elsewhere" % id)
+                continue
+            out.info("Starting queued release %s" % id)
+            _start(id)
@@ -15,21 +15,44 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import json
+import socket
+import time
 import pika
+import pymongo.errors
+import recore.admission
+import recore.backoff
+import recore.codec
 import recore.fsm
+import recore.job.cancel
 import recore.job.create
+import recore.job.status
+import recore.schedule
+import recore.transport
 
 
 MQ_CONF = {}
 connection = None
+# Whether the current connection got as far as consuming
+consuming = False
+# Set to stop reconnecting
+stopping = False
 out = logging.getLogger('recore.amqp')
 
 
+def configure(mq):
+    """Take the MQ config section, without connecting anywhere"""
+    import recore.amqp
+    recore.amqp.MQ_CONF = mq
+    recore.transport.init_transport(mq)
+    recore.codec.configure(mq.get('CONTENT_TYPE'),
+                           mq.get('COMPRESS_THRESHOLD'))
+
+
 def init_amqp(mq):
     """Open a channel to our AMQP server"""
     import recore.amqp
-    recore.amqp.MQ_CONF = mq
+    configure(mq)
+    recore.amqp.consuming = False
 
     creds = pika.credentials.PlainCredentials(mq['NAME'], mq['PASSWORD'])
     params = pika.ConnectionParameters(
@@ -50,9 +73,77 @@ def on_open(connection):
     Call back when a connection is opened.
     """
     out.debug("Opened AMQP connection")
+    connection.add_on_close_callback(on_close)
     connection.channel(on_channel_open)
 
 
+def on_close(connection, reply_code, reply_text):
+    """
+    Call back when the connection closes. Stop its IO loop so
+    `run_forever` can connect again.
+    """
+    out.warn("AMQP connection closed (%s): %s" % (reply_code, reply_text))
+    connection.ioloop.stop()
+
+
+def run_forever(mq):
+    """Consume from the core's queue until `stopping` is set,
+reconnecting with a jittered exponential backoff whenever the
+connection is lost. Gives up, raising AMQPConnectionError, when the
+broker can't be reached for recore.backoff.DEADLINE seconds.
+Authentication errors are raised right away."""
+    import recore.amqp
+    attempt = 0
+    down_since = None
+    while not recore.amqp.stopping:
+        recore.amqp.consuming = False
+        try:
+            if recore.transport.TRANSPORT == recore.transport.LOCAL:
+                consume_local(mq)
+            else:
+                init_amqp(mq).ioloop.start()
+            error = "connection closed"
+        except pika.exceptions.ProbableAuthenticationError:
+            raise
+        except (pika.exceptions.AMQPConnectionError, socket.error), e:
+            error = e
+        if recore.amqp.stopping:
+            break
+        if recore.amqp.consuming:
+            # We were up, so this is a new outage
+            attempt = 0
+            down_since = None
+        if down_since is None:
+            down_since = time.time()
+        wait = recore.backoff.delay(attempt)
+        if time.time() + wait - down_since > recore.backoff.DEADLINE:
+            out.fatal("AMQP unreachable for %ds. Giving up" % (
+                time.time() - down_since))
+            raise pika.exceptions.AMQPConnectionError(error)
+        out.error("Lost AMQP connection (%s). Reconnecting in %.1fs" % (
+            error, wait))
+        time.sleep(wait)
+        attempt += 1
+
+
+def consume_local(mq):
+    """Consume from the core's queue over the local transport, doing
+what the SelectConnection of `init_amqp` does over AMQP. Nothing else
+sets up the in-process broker, so declare and bind the queue too."""
+    import recore.amqp
+    configure(mq)
+    channel = recore.transport.connect().channel()
+    channel.exchange_declare(exchange=mq['EXCHANGE'],
+                             durable=True,
+                             exchange_type='topic')
+    channel.queue_declare(queue=mq['QUEUE'], durable=True)
+    channel.queue_bind(queue=mq['QUEUE'], exchange=mq['EXCHANGE'],
+                       routing_key='job.#')
+    recore.amqp.consuming = True
+    for (method, properties, body) in channel.consume(mq['QUEUE']):
+        receive(channel, method, properties, body)
+
+
 def on_channel_open(channel):
     """
     Call back when a channel is opened.
@@ -64,6 +155,8 @@ def on_channel_open(channel):
     consumer_tag = channel.basic_consume(
         receive,
         queue=MQ_CONF['QUEUE'])
+    import recore.amqp
+    recore.amqp.consuming = True
     return consumer_tag
 
 
@@ -76,6 +169,21 @@ def reject(ch, method, requeue=False):
         requeue=requeue)
 
 
+def admit(id):
+    """
+    Start (or queue) the new release `id`, riding out MongoDB being
+    unavailable
+    """
+    try:
+        recore.admission.start(id)
+    except pymongo.errors.ConnectionFailure, cfe:
+        # The release was created, but could not be marked queued
+        logging.getLogger('recore.stdout').error(
+            "MongoDB unavailable, release %s not started: %s" % (id, cfe))
+        out.error("MongoDB unavailable, release %s not started: %s" % (
+            id, cfe))
+
+
 def receive(ch, method, properties, body):
     """
     Callback for watching the FSM queue
@@ -83,9 +191,9 @@ def receive(ch, method, properties, body):
     out = logging.getLogger('recore')
     notify = logging.getLogger('recore.stdout')
     try:
-        msg = json.loads(body)
+        msg = recore.codec.decode(body, properties)
     except ValueError, ve:
-        # Not JSON or not able to decode
+        # Not JSON (or whatever content_type says) or not able to decode
         out.debug("Unable to decode message. Rejecting: %s" % body)
         reject(ch, method, False)
         notify.info("Unable to decode message. Rejected.")
@@ -94,7 +202,28 @@ def receive(ch, method, properties, body):
     out.debug("Message: %s" % msg)
     ch.basic_ack(delivery_tag=method.delivery_tag)
 
-    if topic == 'job.create':
+    if topic == 'job.create' and 'releases' in msg:
+        if not isinstance(msg['releases'], list):
+            notify.info("Bad batch job create message: 'releases' must "
+                        "be a list")
+            out.error("Bad batch job create message: 'releases' must "
+                      "be a list")
+            return
+        notify.info("new batch job create for %s releases" % (
+            len(msg['releases'])))
+        out.info("New batch of %s releases requested" % (
+            len(msg['releases'])))
+        try:
+            ids = recore.job.create.release_batch(
+                ch, msg['releases'], properties.reply_to)
+        except pymongo.errors.ConnectionFailure, cfe:
+            notify.error("MongoDB unavailable, batch not created: %s" % cfe)
+            out.error("MongoDB unavailable, batch not created: %s" % cfe)
+            return
+        for id in ids:
+            if id:
+                admit(id)
+    elif topic == 'job.create':
         id = None
         try:
             # We need to get the name of the temporary
@@ -106,23 +235,51 @@ def receive(ch, method, properties, body):
             notify.debug("Job message: %s" % msg)
             reply_to = properties.reply_to
 
+            start_at = None
+            if msg.get('start_at') is not None:
+                start_at = recore.schedule.parse_start_at(msg['start_at'])
+                if not recore.schedule.is_future(start_at):
+                    start_at = None
+
             id = recore.job.create.release(
-                ch, msg['project'], reply_to, msg.get('dynamic', {}))
+                ch, msg['project'], reply_to, msg.get('dynamic', {}),
+                msg.get('idempotency_key'), start_at)
         except KeyError, ke:
             notify.info("Missing an expected key in message: %s" % ke)
             out.error("Missing an expected key in message: %s" % ke)
             # FIXME: eating errors can be dangerous! Double check this is OK.
             return
+        except ValueError, ve:
+            notify.info("Bad job create message: %s" % ve)
+            out.error("Bad job create message: %s" % ve)
+            return
+        except pymongo.errors.ConnectionFailure, cfe:
+            # Don't take the consumer down with MongoDB. The client
+            # gets no answer and can retry.
+            notify.error("MongoDB unavailable, job not created: %s" % cfe)
+            out.error("MongoDB unavailable, job not created: %s" % cfe)
+            return
 
-        if id:
-            # Skip this try/except until we work all the bugs out of the FSM
-            # try:
-            runner = recore.fsm.FSM(id)
-            runner.start()
-            # while runner.isAlive():
-            #     runner.join(0.3)
-            # except Exception, e:
-            # notify.error(str(e))
+        if id and start_at is not None:
+            recore.schedule.add(id, start_at)
+        elif id:
+            admit(id)
+    elif topic == 'job.cancel':
+        try:
+            notify.info("cancel requested for: %s" % msg['id'])
+            recore.job.cancel.cancel(ch, msg['id'], properties.reply_to)
+        except KeyError, ke:
+            notify.info("Missing an expected key in message: %s" % ke)
+            out.error("Missing an expected key in message: %s" % ke)
+            return
+    elif topic == 'job.status':
+        try:
+            recore.job.status.status(ch, msg['id'], properties.reply_to,
+                                     properties.correlation_id)
+        except KeyError, ke:
+            notify.info("Missing an expected key in message: %s" % ke)
+            out.error("Missing an expected key in message: %s" % ke)
+            return
     else:
         out.warn("Unknown routing key %s. Doing nothing ...")
         notify.info("IDK what this is: %s" % topic)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Archival of finished releases.
+
+State documents are never deleted, so without this the 'state'
+collection grows forever and finished releases share the working set
+with running ones. The archiver moves releases which ended more than
+AFTER_DAYS days ago, BATCH_SIZE at a time, to the 'state_archive'
+collection, every INTERVAL seconds:
+
+    "ARCHIVE": {
+        "AFTER_DAYS": 30,
+        "BATCH_SIZE": 100,
+        "INTERVAL": 3600,
+        "TTL_DAYS": 365
+    }
+
+An archived release keeps what job.status reports about it (project,
+created, ended, failed, cancelled, error and how many of how many
+steps completed) as plain fields. The rest is trimmed, each step down
+to its name and plugin, and stored zlib compressed BSON in 'data'; see
+`unpack`. Versioned releases keep their 'playbook_version', which
+still has the steps in full. Their journal entries are deleted.
+
+With TTL_DAYS MongoDB deletes archived releases that many days after
+they ended. Note an existing TTL index keeps the expiry it was created
+with. Leave AFTER_DAYS out to never archive.
+"""
+
+import datetime
+import itertools
+import logging
+import threading
+import time
+import zlib
+import bson
+import pymongo.errors
+
+COLLECTION = 'state_archive'
+
+AFTER_DAYS = None
+BATCH_SIZE = 100
+INTERVAL = 3600
+
+# What an archived release keeps as it is
+SUMMARY_FIELDS = ('project', 'created', 'ended', 'failed', 'cancelled',
+                  'error', 'playbook_version')
+# What is kept, compressed, of the rest
+DATA_FIELDS = ('reply_to', 'dynamic', 'completed_steps', 'active_step',
+               'remaining_steps', 'cached_steps', 'shared_steps')
+# What is kept of each step
+STEP_FIELDS = ('name', 'plugin')
+
+out = logging.getLogger('recore')
+
+archiver = None
+
+
+def init_archive(conf, d):
+    """Configure archival from the ARCHIVE config section. If it's
+enabled, create the indexes it needs in `d` and start archiving."""
+    import recore.archive
+    after = conf.get('AFTER_DAYS')
+    recore.archive.AFTER_DAYS = None if after is None else float(after)
+    recore.archive.BATCH_SIZE = int(conf.get('BATCH_SIZE', BATCH_SIZE))
+    recore.archive.INTERVAL = float(conf.get('INTERVAL', INTERVAL))
+    if after is None:
+        return
+    ensure_indexes(d, conf.get('TTL_DAYS'))
+    recore.archive.archiver = Archiver(d)
+    recore.archive.archiver.start()
+    out.info("Archiving releases %s days after they end" % after)
+
+
+def ensure_indexes(d, ttl_days=None):
+    """Index finished releases by when they ended and, with `ttl_days`,
+expire archived ones"""
+    # Only finished releases have ended
+    d['state'].ensure_index('ended', sparse=True)
+    if ttl_days is not None:
+        d[COLLECTION].ensure_index(
+            'ended', expireAfterSeconds=int(float(ttl_days) * 86400))
+
+
+def _trim(step):
+    if isinstance(step, dict):
+        return dict((k, step[k]) for k in STEP_FIELDS if k in step)
+    return step
+
+
+def archived_document(doc):
+    """The archive collection document for the finished release `doc`"""
+    archived = dict((k, doc[k]) for k in SUMMARY_FIELDS if k in doc)
+    data = {}
+    for key in DATA_FIELDS:
+        if doc.get(key) is not None:
+            data[key] = doc[key]
+    for key in ('completed_steps', 'remaining_steps'):
+        if key in data:
+            data[key] = [_trim(s) for s in data[key]]
+    if data.get('active_step'):
+        data['active_step'] = _trim(data['active_step'])
+
+    if 'playbook_version' in doc:
+        completed = doc.get('completed') or 0
+        total = doc.get('total') or 0
+    else:
+        completed = len(doc.get('completed_steps') or [])
+        total = (completed + len(doc.get('remaining_steps') or []) +
+                 (1 if doc.get('active_step') else 0))
+    archived.update({
+        '_id': doc['_id'],
+        'archived': datetime.datetime.utcnow(),
+        'completed': completed,
+        'total': total,
+        'data': bson.Binary(zlib.compress(bson.BSON.encode(data))),
+    })
+    return archived
+
+
+def unpack(archived):
+    """The trimmed step data (and dynamic data, reply_to, ...) of the
+archived release `archived`"""
+    return bson.BSON(zlib.decompress(archived['data'])).decode()
+
+
+def _insert(d, docs):
+    """Insert `docs` into the archive, skipping those already there
+(from a batch which was cut short)"""
+    try:
+        d[COLLECTION].insert(docs, continue_on_error=True)
+    except pymongo.errors.DuplicateKeyError:
+        for doc in docs:
+            try:
+                d[COLLECTION].insert(doc)
+            except pymongo.errors.DuplicateKeyError:
+                pass
+
+
+def archive_batch(d, before, limit=None):
+    """Move up to `limit` (default BATCH_SIZE) releases which ended
+before `before` from 'state' to the archive. Returns how many were
+moved."""
+    limit = limit or BATCH_SIZE
+    found = list(itertools.islice(
+        d['state'].find({'ended': {'$lt': before}}), limit))
+    if not found:
+        return 0
+    ids = [doc['_id'] for doc in found]
+    # Archive first: if we stop half way the next batch picks up the
+    # releases which are in both collections
+    _insert(d, [archived_document(doc) for doc in found])
+    d['state'].remove({'_id': {'$in': ids}})
+    d['journal'].remove({'release': {'$in': ids}})
+    return len(found)
+
+
+def archive(d, before):
+    """Archive every release which ended before `before`, a batch at a
+time. Returns how many there were."""
+    total = 0
+    while True:
+        moved = archive_batch(d, before)
+        total += moved
+        if moved < BATCH_SIZE:
+            return total
+
+
+class Archiver(threading.Thread):
+    """Archives what has become old enough every INTERVAL seconds"""
+
+    def __init__(self, d):
+        super(Archiver, self).__init__(name='recore-archive')
+        self.daemon = True
+        self.d = d
+
+    def run(self):  # pragma: no cover
+        while True:
+            self.sweep()
+            time.sleep(INTERVAL)
+
+    def sweep(self):
+        """Archive releases which ended more than AFTER_DAYS days ago.
+        Errors are logged and left for the next sweep."""
+        # 'ended' is recorded in local time
+        before = datetime.datetime.now() - datetime.timedelta(
+            days=AFTER_DAYS)
+        started = time.time()
+        try:
+            moved = archive(self.d, before)
+        except pymongo.errors.PyMongoError, e:
+            out.error("Unable to archive releases: %s" % e)
+            return None
+        if moved:
+            out.info("Archived %s releases which ended before %s in "
+                     "%.1fs" % (moved, before, time.time() - started))
+        return moved
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Retrying through outages.
+
+When the broker or MongoDB goes away the core keeps trying to get
+back, waiting a random time of up to BASE * 2**attempt seconds
+(capped at CAP) between attempts, and gives up after DEADLINE
+seconds. Set these in the config:
+
+    "RECONNECT": {
+        "BASE": 0.5,
+        "CAP": 30,
+        "DEADLINE": 300
+    }
+"""
+
+import logging
+import random
+import time
+
+BASE = 0.5
+CAP = 30.0
+DEADLINE = 300.0
+
+out = logging.getLogger('recore')
+
+
+def init_backoff(conf):
+    """Configure from the RECONNECT config section"""
+    import recore.backoff
+    recore.backoff.BASE = float(conf.get('BASE', BASE))
+    recore.backoff.CAP = float(conf.get('CAP', CAP))
+    recore.backoff.DEADLINE = float(conf.get('DEADLINE', DEADLINE))
+
+
+def delay(attempt):
+    """Seconds to wait before retry number `attempt` (counting from 0).
+The jitter keeps everything that lost its connection at once from
+coming back at once."""
+    return random.uniform(0, min(CAP, BASE * 2 ** attempt))
+
+
+def retry(fn, errors, what, deadline=None):
+    """Call `fn` until it doesn't raise one of `errors`, backing off
+between attempts. Re-raises the last error once `deadline` seconds
+(default DEADLINE) have passed. `what` describes the attempt for the
+log."""
+    if deadline is None:
+        deadline = DEADLINE
+    give_up = time.time() + deadline
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except errors, e:
+            wait = delay(attempt)
+            if time.time() + wait > give_up:
+                out.error("Giving up on %s: %s" % (what, e))
+                raise
+            out.warn("Failed %s (attempt %d): %s. Retrying in %.1fs" % (
+                what, attempt + 1, e, wait))
+            time.sleep(wait)
+            attempt += 1
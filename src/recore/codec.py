@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Message encoding.
+
+Incoming messages are decoded according to their AMQP `content_type`
+and `content_encoding` properties. A message without a content type,
+or with one we don't know (`text/plain`, say), is JSON, which is what
+everything spoke before there was a choice. Parameters of the media
+type, like `; charset=utf-8`, are ignored.
+
+Outgoing messages use the configured `CONTENT_TYPE` (JSON unless the
+MQ config says otherwise) and are compressed when their body is larger
+than `COMPRESS_THRESHOLD` bytes. Set these in the MQ config section:
+
+    "MQ": {
+        ...
+        "CONTENT_TYPE": "application/bson",
+        "COMPRESS_THRESHOLD": 16384
+    }
+
+BSON is always available (it comes with pymongo). MessagePack is
+available if the `msgpack` module is installed.
+"""
+
+import json
+import logging
+import zlib
+import bson
+import pika.spec
+
+JSON = 'application/json'
+BSON = 'application/bson'
+MSGPACK = 'application/x-msgpack'
+DEFLATE = 'deflate'
+GZIP = 'gzip'
+
+# What we encode outgoing messages with
+CONTENT_TYPE = JSON
+# Compress outgoing bodies larger than this many bytes. 0 to never.
+COMPRESS_THRESHOLD = 0
+
+out = logging.getLogger('recore')
+
+
+def _bson_loads(data):
+    return bson.BSON(data).decode()
+
+
+def _bson_dumps(obj):
+    return bson.BSON.encode(obj)
+
+
+# content_type: (loads, dumps)
+CODECS = {
+    JSON: (json.loads, json.dumps),
+    BSON: (_bson_loads, _bson_dumps),
+}
+
+try:
+    import msgpack
+    CODECS[MSGPACK] = (
+        lambda data: msgpack.unpackb(data, encoding='utf-8'),
+        lambda obj: msgpack.packb(obj, use_bin_type=True))
+except ImportError:  # pragma: no cover
+    pass
+
+
+def configure(content_type=None, compress_threshold=None):
+    """Set how outgoing messages are encoded. Raises ValueError if the
+`content_type` is not supported here."""
+    import recore.codec
+    if content_type is not None:
+        if content_type not in CODECS:
+            raise ValueError("Unsupported content type: %s" % content_type)
+        recore.codec.CONTENT_TYPE = content_type
+    if compress_threshold is not None:
+        recore.codec.COMPRESS_THRESHOLD = int(compress_threshold)
+    out.debug("Encoding messages as %s, compressing over %s bytes" % (
+        recore.codec.CONTENT_TYPE, recore.codec.COMPRESS_THRESHOLD))
+
+
+def media_type(content_type):
+    """The codec for incoming `content_type`: its media type without
+parameters, or JSON if that's not one we have a codec for"""
+    if content_type:
+        media = content_type.split(';', 1)[0].strip().lower()
+        if media in CODECS:
+            return media
+        out.debug("Decoding content type %s as JSON" % content_type)
+    return JSON
+
+
+def loads(data, content_type=None):
+    """Deserialize `data` of `content_type`. Raises ValueError."""
+    content_type = media_type(content_type)
+    (decode, _) = CODECS[content_type]
+    try:
+        return decode(data)
+    except ValueError:
+        raise
+    except Exception, e:
+        raise ValueError("Can not decode %s message: %s" % (
+            content_type, e))
+
+
+def dumps(obj, content_type=None):
+    """Serialize `obj` as `content_type`, by default CONTENT_TYPE"""
+    (_, encode) = CODECS[content_type or CONTENT_TYPE]
+    return encode(obj)
+
+
+def compress(body):
+    """Compress `body` if it's over COMPRESS_THRESHOLD. Returns a tuple
+of the (maybe) compressed body and its content encoding, or None."""
+    if COMPRESS_THRESHOLD and len(body) > COMPRESS_THRESHOLD:
+        return (zlib.compress(body), DEFLATE)
+    return (body, None)
+
+
+def decompress(body, content_encoding=None):
+    """Undo `content_encoding`. Raises ValueError."""
+    if not content_encoding:
+        return body
+    try:
+        if content_encoding == DEFLATE:
+            return zlib.decompress(body)
+        if content_encoding == GZIP:
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    except zlib.error, e:
+        raise ValueError("Can not decompress %s body: %s" % (
+            content_encoding, e))
+    raise ValueError("Unsupported content encoding: %s" % content_encoding)
+
+
+def decode(body, properties=None):
+    """Decode a message `body` according to its AMQP `properties`"""
+    content_type = getattr(properties, 'content_type', None)
+    content_encoding = getattr(properties, 'content_encoding', None)
+    return loads(decompress(body, content_encoding), content_type)
+
+
+def properties(content_encoding=None, **kwargs):
+    """BasicProperties describing a body we encoded, plus `kwargs`"""
+    return pika.spec.BasicProperties(content_type=CONTENT_TYPE,
+                                     content_encoding=content_encoding,
+                                     **kwargs)
+
+
+def encode(obj, **kwargs):
+    """Encode `obj` for sending. Returns a tuple of the body and the
+BasicProperties (including `kwargs`) to send it with."""
+    (body, content_encoding) = compress(dumps(obj))
+    return (body, properties(content_encoding, **kwargs))
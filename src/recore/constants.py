@@ -24,4 +24,9 @@ NEW_STATE_RECORD = {
     'completed_steps': [],
     'active_step': {},
     'remaining_steps': []
+    # Versioned records have these instead of the *_steps arrays:
+    # 'playbook_version': None,
+    # 'completed': 0,
+    # 'active': None,
+    # 'total': 0,
 }
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Release events.
+
+Instead of polling MongoDB, dashboards and front ends can subscribe to
+what releases are doing. Each time an FSM's state document changes (and
+only once the change is in MongoDB) a small event is published to the
+topic exchange, with the routing key
+
+    release.<project>.<state id>.<event>
+
+where <event> is one of step.started, step.completed, step.failed,
+release.cancelled and release.ended. Bind to `release.myproject.#` for
+one project or to `release.#.release.ended` for every release's end.
+Dots in project names are sent as underscores. The body is JSON (or
+whatever the MQ CONTENT_TYPE is) like:
+
+    {"id": ..., "project": ..., "event": "step.completed",
+     "step": "$NAME", "at": "$ISO8601"}
+
+FSMs never wait on this: events are handed to one publisher thread,
+with its own connection, which sends them in batches of up to
+BATCH_SIZE, waiting at most FLUSH_INTERVAL seconds for a batch to
+fill. While the broker is away up to BACKLOG events are kept; past
+that they are dropped. It is off unless enabled in the config:
+
+    "EVENTS": {
+        "ENABLED": true,
+        "EXCHANGE": "re",
+        "BATCH_SIZE": 100,
+        "FLUSH_INTERVAL": 0.1,
+        "BACKLOG": 10000
+    }
+
+EXCHANGE defaults to the MQ EXCHANGE. Make sure the core's own queue
+isn't bound to `release.#` there.
+"""
+
+import datetime
+import logging
+import Queue
+import threading
+import time
+import recore.amqp
+import recore.backoff
+import recore.codec
+import recore.fsm
+import recore.transport
+
+ENABLED = False
+EXCHANGE = None
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 0.1
+BACKLOG = 10000
+
+# (routing key, body) waiting to be published
+_queue = Queue.Queue()
+# Events thrown away because the backlog was full
+dropped = 0
+publisher = None
+
+out = logging.getLogger('recore')
+
+
+def init_events(conf):
+    """Configure events from the EVENTS config section, and start
+publishing if they're enabled"""
+    import recore.events
+    recore.events.ENABLED = bool(conf.get('ENABLED', False))
+    recore.events.EXCHANGE = conf.get('EXCHANGE')
+    recore.events.BATCH_SIZE = int(conf.get('BATCH_SIZE', BATCH_SIZE))
+    recore.events.FLUSH_INTERVAL = float(
+        conf.get('FLUSH_INTERVAL', FLUSH_INTERVAL))
+    recore.events.BACKLOG = int(conf.get('BACKLOG', BACKLOG))
+    if not recore.events.ENABLED:
+        return
+    if recore.events.publisher is None:
+        recore.events.publisher = Publisher()
+        recore.events.publisher.start()
+    out.info("Publishing release events in batches of %s" % BATCH_SIZE)
+
+
+def routing_key(project, state_id, event):
+    return 'release.%s.%s.%s' % (
+        str(project).replace('.', '_'), state_id, event)
+
+
+def emit(state_id, project, event, **fields):
+    """Publish `event` of release `state_id` of `project`, with any
+extra `fields` in its body. Does nothing unless events are enabled."""
+    import recore.events
+    if not ENABLED:
+        return
+    if _queue.qsize() >= BACKLOG:
+        recore.events.dropped += 1
+        out.warn("Release event backlog full. Dropped %s event of %s" % (
+            event, state_id))
+        return
+    body = dict(fields)
+    body.update({
+        'id': state_id,
+        'project': project,
+        'event': event,
+        'at': datetime.datetime.utcnow().isoformat(),
+    })
+    _queue.put((routing_key(project, state_id, event), body))
+
+
+def _connect():
+    """A channel, on a connection of its own, to publish on"""
+    mq = recore.amqp.MQ_CONF
+    channel = recore.transport.connect().channel()
+    channel.exchange_declare(exchange=EXCHANGE or mq['EXCHANGE'],
+                             durable=True,
+                             exchange_type='topic')
+    return channel
+
+
+def take():
+    """The next batch of events: whatever is waiting, up to BATCH_SIZE,
+waiting up to FLUSH_INTERVAL for more to come after the first one"""
+    batch = [_queue.get()]
+    deadline = time.time() + FLUSH_INTERVAL
+    while len(batch) < BATCH_SIZE:
+        remaining = deadline - time.time()
+        try:
+            if remaining > 0:
+                batch.append(_queue.get(True, remaining))
+            else:
+                batch.append(_queue.get_nowait())
+        except Queue.Empty:
+            break
+    return batch
+
+
+def publish(channel, batch):
+    """Send the events in `batch`, removing each one once it's sent"""
+    exchange = EXCHANGE or recore.amqp.MQ_CONF['EXCHANGE']
+    while batch:
+        (key, body) = batch[0]
+        (data, props) = recore.codec.encode(body)
+        channel.basic_publish(exchange=exchange,
+                              routing_key=key,
+                              body=data,
+                              properties=props)
+        batch.pop(0)
+
+
+class Publisher(threading.Thread):
+    """Publishes events as they come, reconnecting when it has to"""
+
+    def __init__(self):
+        super(Publisher, self).__init__(name='recore-events')
+        self.daemon = True
+        self.channel = None
+
+    def run(self):  # pragma: no cover
+        while True:
+            self.send(take())
+
+    def send(self, batch):
+        """Publish `batch`, reconnecting as needed. Gives up on it if
+        the broker stays away past the reconnect deadline."""
+        import recore.events
+        while batch:
+            try:
+                if self.channel is None:
+                    self.channel = recore.backoff.retry(
+                        _connect, recore.fsm.AMQP_ERRORS,
+                        "connecting to publish events")
+                publish(self.channel, batch)
+            except recore.fsm.AMQP_ERRORS, e:
+                if self.channel is None:
+                    recore.events.dropped += len(batch)
+                    out.error("Dropped %s release events: %s" % (
+                        len(batch), e))
+                    return
+                out.error("Lost AMQP connection publishing events: %s" % e)
+                self.channel = None
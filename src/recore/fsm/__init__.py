@@ -15,16 +15,60 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from bson.objectid import ObjectId
+import datetime
 import json
 from datetime import datetime as dt
+import recore.admission
+import recore.backoff
+import recore.codec
+import recore.events
+import recore.journal
 import recore.mongo
 import recore.amqp
+import recore.transport
+import recore.wal
+from recore.fsm.state import ReleaseState
+from recore.fsm import flights
+from recore.fsm import registry
+from recore.fsm import throttle
 import logging
+import socket
 import threading
+import time
 import pika.spec
 import pika.exceptions
 import pymongo.errors
 
+# Where the active step is at, as far as the worker is concerned
+DISPATCHED = 'dispatched'
+STARTED = 'started'
+
+# Losing the broker looks like one of these
+AMQP_ERRORS = (pika.exceptions.AMQPConnectionError, socket.error)
+# and losing MongoDB like this
+MONGO_ERRORS = (pymongo.errors.ConnectionFailure,)
+
+# Seconds an unused reply queue outlives its FSM
+REPLY_QUEUE_EXPIRES = 3600
+
+# AMQP message type of a request to cancel a release (to its FSM) or
+# a step (to its worker), and the status of a cancelled release
+CANCEL = 'cancel'
+CANCELLED = 'cancelled'
+# Seconds between checks for cancellation while waiting in the core
+CANCEL_POLL = 0.05
+
+
+def reply_queue_name(state_id):
+    """The reply queue of the FSM of release `state_id`"""
+    return 'recore.%s' % state_id
+
+
+def _isoformat(when):
+    if when is None:
+        return None
+    return when.isoformat()
+
 
 class FSM(threading.Thread):
     """The re-core Finite State Machine to oversee the execution of
@@ -50,24 +94,150 @@ a project's release steps."""
         # properties for later when we run() like the wind
         self.ch = None
         self.conn = None
+        # For publishing with confirms, opened when first needed
+        self.confirm_ch = None
         self.state_id = state_id
         self._id = {'_id': ObjectId(self.state_id)}
-        self.state = {}
-        self.dynamic = {}
+        # Loaded from the state document on the first _setup()
+        self.release = None
+        self.project = None
+        self._project_json = None
+        self._dynamic_json = None
         self.reply_queue = None
+        # (fingerprint, Flight) of the coalesced step we are leading
+        self._flight = None
+        # Plugin whose dispatch slot we hold
+        self._slot = None
+        # DISPATCHED, STARTED or None when the active step hasn't
+        # been sent yet
+        self._phase = None
+        # State updates MongoDB hasn't taken yet, oldest first
+        self._pending = []
+        # (update, event, fields) of events to publish once `update`
+        # is in MongoDB
+        self._events = []
+        # Set when the release fails for good
+        self._failed = False
+        # In journal mode: the seq of our last journal entry, and of
+        # the last one in the state document snapshot
+        self._seq = 0
+        self._snapshot_seq = 0
+        # With the write-ahead log: the LSN of our last update in it
+        self._wal_lsn = 0
+        # Set once we close the connection on purpose
+        self._finishing = False
+        # Whether our reply queue (and any answer in it) was lost
+        # while we were disconnected
+        self.reply_queue_lost = False
+        # Set (from another thread) to stop the release
+        self.cancelled = threading.Event()
+        # Where the worker running the active step takes cancels, if
+        # it said so
+        self._worker_queue = None
+        # When we started running, and when the active step did
+        self.started_at = None
+        self.step_started_at = None
 
     def run(self):  # pragma: no cover
+        self.started_at = datetime.datetime.utcnow()
+        registry.add(self)
         try:
-            self._run()
-        except pika.exceptions.ConnectionClosed:
-            # Don't know why, but pika likes to raise this exception
-            # when we intentionally close a connection...
-            self.app_logger.debug("Closed AMQP connection")
+            self._supervise()
+        finally:
+            registry.remove(self.state_id)
+            # Let a queued release have our place
+            recore.admission.drain()
         self.app_logger.info("Terminating")
         return True
 
+    def cancel(self):
+        """Ask the release to stop. Safe to call from any thread; the
+        FSM notices the next time it looks, or as soon as a CANCEL
+        message reaches its reply queue."""
+        self.cancelled.set()
+
+    def status(self):
+        """Where the release is at, for job.status. Called from other
+        threads, so this only reads what is already in memory."""
+        release = self.release
+        if release is None:
+            return {'id': self.state_id, 'status': 'starting'}
+        step = release.active_step
+        return {
+            'id': self.state_id,
+            'project': self.project,
+            'status': (CANCELLED if self.cancelled.is_set()
+                       else recore.admission.RUNNING),
+            'step': step.name if step is not None else None,
+            'phase': self._phase,
+            'completed': release.completed,
+            'total': len(release.steps),
+            'started': _isoformat(self.started_at),
+            'step_started': _isoformat(self.step_started_at),
+            # How busy the active step's plugin is in this core
+            'plugin': (dict(throttle.limiter(step.plugin).saturation(),
+                            name=step.plugin)
+                       if step is not None else None),
+        }
+
+    def _supervise(self):
+        """Run the release, reconnecting and carrying on from where we
+        were whenever the broker connection drops"""
+        carry_on = self._run
+        while True:
+            try:
+                return carry_on()
+            except AMQP_ERRORS, e:
+                if self._finishing:
+                    # Don't know why, but pika likes to raise this
+                    # exception when we intentionally close a
+                    # connection...
+                    self.app_logger.debug("Closed AMQP connection")
+                    return True
+                self.app_logger.error("Lost AMQP connection: %s" % e)
+            try:
+                self._reconnect()
+            except:
+                # Giving up on the release, so let others have what the
+                # active step still holds
+                self._land(flights.ABANDONED)
+                self._release_slot()
+                raise
+            carry_on = self._resume
+
+    def _reconnect(self):
+        """Open a new AMQP connection, backing off between attempts.
+        Raises the last connection error if the broker doesn't come
+        back in time."""
+        self.ch = self.conn = self.confirm_ch = None
+        recore.backoff.retry(self._setup, AMQP_ERRORS,
+                             "reconnecting to AMQP")
+        self.app_logger.info("Reconnected to AMQP")
+
+    def _resume(self):
+        """Carry on with the release after reconnecting. The active
+        step still has the slot and flight it held when the connection
+        dropped."""
+        if self.cancelled.is_set():
+            return self._cancelled()
+        step = self.release.active_step
+        if step is None:
+            return self._run()
+        self._flush_state(wait=True)
+        if self._phase is None or self.reply_queue_lost:
+            # Never sent, or the worker's answers went with the queue
+            self._phase = None
+            if self._slot is None:
+                return self._run_step(step)
+            return self._holding(self._dispatch, step)
+        if self._phase == DISPATCHED:
+            return self._holding(self._await_started)
+        return self._holding(self._await_ended)
+
     def _run(self):
         self._setup()
+        if self.cancelled.is_set():
+            return self._cancelled()
         try:
             # Pop a step off the remaining steps queue
             # - Reflect in MongoDB
@@ -81,110 +251,435 @@ a project's release steps."""
             self._cleanup()
             return True
 
+        return self._run_step(self.release.active_step)
+
+    def _run_step(self, step):
+        """Get the active `step` done, one way or another"""
+        if step.cacheable:
+            fingerprint = step.fingerprint(self._step_dynamic(step))
+            cached = recore.mongo.lookup_step_result(self.db, fingerprint)
+            if cached is not None:
+                self.app_logger.info(
+                    "Step '%s' already completed in release %s. "
+                    "Using the cached result" % (step.name,
+                                                 cached.get('release')))
+                self.move_active_to_completed(cached={
+                    'step': step.name,
+                    'fingerprint': fingerprint,
+                    'release': cached.get('release')})
+                return self._run()
+
+        while step.coalesce:
+            fingerprint = step.fingerprint(self._step_dynamic(step))
+            (flight, leading) = flights.join(fingerprint, self.state_id)
+            if leading:
+                self._flight = (fingerprint, flight)
+                break
+            self.app_logger.info(
+                "Step '%s' is already running for release %s. "
+                "Waiting for its outcome" % (step.name, flight.leader))
+            status = flight.wait(CANCEL_POLL)
+            while status is None:
+                if self.cancelled.is_set():
+                    return self._cancelled()
+                status = flight.wait(CANCEL_POLL)
+            if status == flights.COMPLETED:
+                self.move_active_to_completed(shared={
+                    'step': step.name,
+                    'fingerprint': fingerprint,
+                    'release': flight.leader})
+                return self._run()
+            if status == flights.FAILED:
+                return self._fail("Step '%s' failed in release %s" % (
+                    step.name, flight.leader))
+            # Abandoned: try to lead it ourselves
+
+        return self._holding(self._dispatch, step)
+
+    def _holding(self, work, *args):
+        """Call `work` for the active step, then give back its slot
+        and abandon its flight if that is still ours. Both are kept if
+        the broker connection drops: the worker may still be running
+        the step, and `_resume` carries on with them."""
+        lost = False
+        try:
+            return work(*args)
+        except AMQP_ERRORS:
+            lost = True
+            raise
+        finally:
+            if not lost:
+                # If we never got an outcome don't leave followers hanging
+                self._land(flights.ABANDONED)
+                self._release_slot()
+
+    def _dispatch(self, step):
+        """Send `step` to a worker and follow it through to the end"""
         # Parse the step into a message for the worker queue
-        props = pika.spec.BasicProperties()
-        props.correlation_id = self.state_id
-        props.reply_to = self.reply_queue
+        (body, encoding) = recore.codec.compress(self._step_body(step))
+        props = recore.codec.properties(encoding,
+                                        correlation_id=self.state_id,
+                                        reply_to=self.reply_queue)
 
-        params = self.active['parameters']
-        msg = {
-            'project': self.project,
-            'parameters': params,
-            'dynamic': self.dynamic
-        }
-        plugin_queue = "worker.%s" % self.active['plugin']
+        # Wait until the plugin's limits allow another step, unless we
+        # kept its slot through a reconnect
+        if self._slot is None:
+            if not throttle.acquire(step.plugin, 0):
+                self.app_logger.info(
+                    "Plugin %s is saturated. Holding step '%s'" % (
+                        step.plugin, step.name))
+                while not throttle.acquire(step.plugin, CANCEL_POLL):
+                    if self.cancelled.is_set():
+                        return self._cancelled()
+            self._slot = step.plugin
 
-        # Send message to the worker with instructions and dynamic data
-        self.ch.basic_publish(exchange='',
-                              routing_key=plugin_queue,
-                              body=json.dumps(msg),
-                              properties=props)
+        # Our reply queue exists by now, so a cancel coming after this
+        # check will be waiting in it
+        if self.cancelled.is_set():
+            return self._cancelled()
 
+        # Send message to the worker with instructions and dynamic data.
+        # Make sure something will get it, or we'd wait forever. With
+        # a confirm the broker's return (if no queue took the step)
+        # comes before its ack, so it's never missed, even for a
+        # worker queue which was there for the last step.
+        if not self._confirm_channel().basic_publish(
+                exchange='',
+                routing_key=step.routing_key,
+                body=body,
+                properties=props,
+                mandatory=True):
+            return self._unroutable(step)
+
+        self._phase = DISPATCHED
         self.app_logger.info("Sent plugin new job details")
+        self._await_started()
 
+    def _await_started(self):
         # Begin consuming from reply_queue
         self.app_logger.debug("Waiting for plugin to update us")
 
         for method, properties, body in self.ch.consume(self.reply_queue):
             self.ch.basic_ack(method.delivery_tag)
             self.ch.cancel()
+            if getattr(properties, 'type', None) == CANCEL:
+                return self._cancelled()
             self.on_started(self.ch, method, properties, body)
 
+    def _step_body(self, step):
+        """The (uncompressed) worker message for `step`. When sending
+        JSON only the parts which vary per release are serialized here.
+
+        A step which declares the `dynamic` variables it needs is only
+        sent those. Steps which declare none get all of them, and that
+        serialization is done once per release."""
+        dynamic = self._step_dynamic(step)
+        if recore.codec.CONTENT_TYPE != recore.codec.JSON:
+            return recore.codec.dumps({
+                'project': self.project,
+                'parameters': step.parameters,
+                'dynamic': dynamic
+            })
+
+        if self._project_json is None:
+            self._project_json = json.dumps(self.project)
+        if step.dynamic:
+            dynamic_json = json.dumps(dynamic)
+        else:
+            if self._dynamic_json is None:
+                self._dynamic_json = json.dumps(dynamic)
+            dynamic_json = self._dynamic_json
+        return step.body(self._project_json, dynamic_json)
+
+    def _confirm_channel(self):
+        if self.confirm_ch is None:
+            self.confirm_ch = self.conn.channel()
+            self.confirm_ch.confirm_delivery()
+        return self.confirm_ch
+
+    def _unroutable(self, step):
+        """Fail the release: nothing is there to run `step`"""
+        return self._fail("No worker queue %s for step '%s'" % (
+            step.routing_key, step.name))
+
+    def _fail(self, error=None):
+        """Fail the release for good, recording `error` if there is
+        more to say than that the active step failed"""
+        if error is not None:
+            self.app_logger.error(error)
+        self._land(flights.FAILED)
+        self._failed = True
+        _update_state = {
+            '$set': {
+                'failed': True,
+                'status': 'failed'
+            }
+        }
+        fields = {}
+        if error is not None:
+            _update_state['$set']['error'] = fields['error'] = error
+        self.update_state(_update_state)
+        self._event('step.failed', **fields)
+        self._cleanup()
+        return False
+
+    def _step_dynamic(self, step):
+        """The dynamic data `step` is sent: what it declares, or all of
+        it if it declares nothing"""
+        dynamic = self.release.dynamic
+        if step.dynamic:
+            dynamic = dict(
+                (k, dynamic[k]) for k in step.dynamic if k in dynamic)
+        return dynamic
+
+    def _cancelled(self):
+        """Stop the release now: tell the worker running the active step
+        to give up, then let go of everything we hold"""
+        step = self.release.active_step
+        if self._worker_queue is not None:
+            (body, props) = recore.codec.encode(
+                {'project': self.project, 'step': step.name},
+                type=CANCEL, correlation_id=self.state_id)
+            self.ch.basic_publish(exchange='',
+                                  routing_key=self._worker_queue,
+                                  body=body,
+                                  properties=props)
+            self.app_logger.info("Told the worker running step '%s' to "
+                                 "stop" % step.name)
+        elif self._phase is not None:
+            self.app_logger.warn("The worker running step '%s' takes no "
+                                 "cancels. Ignoring its outcome" % step.name)
+        self.app_logger.info("Release cancelled")
+        self._phase = None
+        self._worker_queue = None
+        self._land(flights.ABANDONED)
+        self._release_slot()
+        self.update_state({
+            '$set': {
+                'cancelled': True,
+                'status': CANCELLED
+            }
+        })
+        self._event('release.cancelled')
+        self._cleanup()
+        return False
+
     def on_started(self, channel, method_frame, header_frame, body):
+        self._phase = STARTED
+        # Workers which can be cancelled say where in their 'started'
+        self._worker_queue = getattr(header_frame, 'reply_to', None)
         self.app_logger.info("Plugin 'started' update received. "
                              "Waiting for next state update")
+        self._await_ended()
+
+    def _await_ended(self):
         self.app_logger.debug("Waiting for completed/errored message")
 
         # Consume from reply_queue, wait for completed/errored message
         for method, properties, body in self.ch.consume(self.reply_queue):
             self.ch.basic_ack(method.delivery_tag)
             self.ch.cancel()
+            if getattr(properties, 'type', None) == CANCEL:
+                return self._cancelled()
             self.on_ended(self.ch, method, properties, body)
 
     def on_ended(self, channel, method_frame, header_frame, body):
         self.app_logger.debug("Got completed/errored message back from the worker")
+        self._phase = None
+        self._worker_queue = None
 
-        msg = json.loads(body)
-        self.app_logger.debug(json.dumps(msg))
+        msg = recore.codec.decode(body, header_frame)
+        self.app_logger.debug("Worker said: %s" % msg)
+        self._release_slot()
 
         # Remove from active step, push onto completed steps
         # - Reflect in MongoDB
         if msg['status'] == 'completed':
             self.app_logger.info("State update received: Job finished without error")
             self.move_active_to_completed()
+            self._land(flights.COMPLETED)
             self._run()
         else:
             self.app_logger.error("State update received: Job finished with error(s)")
-            return False
+            return self._fail()
 
-    def move_active_to_completed(self):
-        finished_step = self.active
-        self.completed.append(finished_step)
-        self.active = None
+    def _release_slot(self):
+        """Give back the dispatch slot of the step we ran, if any"""
+        if self._slot is not None:
+            throttle.release(self._slot)
+            self._slot = None
 
-        _update_state = {
-            '$set': {
-                'active_step': self.active,
-                'completed_steps': self.completed
+    def _land(self, status):
+        """Share the outcome of the coalesced step we lead, if any"""
+        if self._flight is not None:
+            (fingerprint, flight) = self._flight
+            self._flight = None
+            flights.land(fingerprint, flight, status)
+
+    def move_active_to_completed(self, cached=None, shared=None):
+        """Mark the active step completed. `cached` (from the result
+        cache) or `shared` (from a coalesced step run by another
+        release) describes where the result came from when the step
+        was not run by us."""
+        step = self.release.active_step
+        if cached is None and shared is None and step.cacheable:
+            recore.mongo.record_step_result(
+                self.db, step.fingerprint(self._step_dynamic(step)),
+                self.state_id, step.name)
+        self.release.complete_active()
+
+        if self.release.version:
+            _update_state = {
+                '$set': {
+                    'active': None,
+                    'completed': self.release.completed
+                }
             }
-        }
-        self.update_state(_update_state)
+        else:
+            _update_state = {
+                '$set': {
+                    'active_step': None,
+                    'completed_steps': self.release.completed_docs()
+                }
+            }
+        event = {'step': step.name}
+        entry = {}
+        if cached is not None:
+            _update_state['$push'] = {'cached_steps': cached}
+            event['cached_from'] = cached.get('release')
+            entry['cached'] = cached
+        if shared is not None:
+            _update_state['$push'] = {'shared_steps': shared}
+            event['shared_from'] = shared.get('release')
+            entry['shared'] = shared
+        self._transition(_update_state, recore.journal.STEP_COMPLETED,
+                         **entry)
+        self._event('step.completed', **event)
 
     def dequeue_next_active_step(self):
         """Take the next remaining step off the queue and move it into active
         steps.
         """
-        self.active = self.remaining.pop(0)
-        _update_state = {
-            '$set': {
-                'active_step': self.active,
-                'remaining_steps': self.remaining
+        step = self.release.start_next()
+        self.step_started_at = datetime.datetime.utcnow()
+        if self.release.version:
+            _update_state = {'$set': {'active': self.release.active}}
+        else:
+            _update_state = {
+                '$set': {
+                    'active_step': step.doc,
+                    'remaining_steps': self.release.remaining_docs()
+                }
             }
-        }
-        self.update_state(_update_state)
+        self._transition(_update_state, recore.journal.STEP_STARTED)
+        self._event('step.started')
 
     def update_state(self, new_state):
         """
         Update the state document in Mongo for this release
+
+        If MongoDB can't be reached the update is kept, and sent
+        (after any kept before it) with the next update.
+
+        In journal mode the update (which must be a plain $set) is
+        appended to the journal instead.
         """
-        try:
-            _id_update_state = self.state_coll.update(self._id,
-                                                      new_state)
+        if recore.journal.ENABLED:
+            self._seq += 1
+            new_state = recore.journal.set_entry(
+                self.state_id, self._seq, new_state)
+        self._pending.append(new_state)
+        self._flush_state()
+
+    def _transition(self, new_state, type, **fields):
+        """Record a step transition: the `new_state` update, or in
+        journal mode just a `type` entry with `fields`"""
+        if not recore.journal.ENABLED:
+            return self.update_state(new_state)
+        self._seq += 1
+        self._pending.append(recore.journal.entry(
+            self.state_id, self._seq, type, **fields))
+        self._flush_state()
+
+    def _event(self, event, **fields):
+        """Publish release `event` (see recore.events), but only once
+        the state updates made before it are in MongoDB. The active
+        step is named in it unless `fields` names a step."""
+        if not recore.events.ENABLED:
+            return
+        step = self.release.active_step
+        if 'step' not in fields and step is not None:
+            fields['step'] = step.name
+        if self._pending:
+            self._events.append((self._pending[-1], event, fields))
+        else:
+            recore.events.emit(self.state_id, self.project, event, **fields)
+
+    def _flush_state(self, wait=False):
+        """Send the kept state updates, in order. With `wait` keep
+        trying until they're sent, or give up and raise."""
+        while self._pending:
+            new_state = self._pending[0]
+            try:
+                if wait:
+                    _id_update_state = recore.backoff.retry(
+                        lambda: self._send_state(new_state), MONGO_ERRORS,
+                        "updating state")
+                else:
+                    _id_update_state = self._send_state(new_state)
+            except MONGO_ERRORS, cfex:
+                if wait:
+                    raise
+                self.app_logger.warn(
+                    "MongoDB unavailable, keeping %s state updates to "
+                    "send later: %s" % (len(self._pending), cfex))
+                return
+            except pymongo.errors.PyMongoError, pmex:
+                self.app_logger.error(
+                    "Unable to update state with %s. "
+                    "Propagating PyMongo error: %s" % (new_state, pmex))
+                raise pmex
+            self._pending.pop(0)
+            while self._events and self._events[0][0] is new_state:
+                (_, event, fields) = self._events.pop(0)
+                recore.events.emit(self.state_id, self.project, event,
+                                   **fields)
 
             if _id_update_state:
                 self.app_logger.debug("Updated 'currently running' task")
             else:
                 self.app_logger.error("Failed to update 'currently running' task")
                 raise Exception("Failed to update 'currently running' task")
-        except pymongo.errors.PyMongoError, pmex:
-            self.app_logger.error(
-                "Unable to update state with %s. "
-                "Propagating PyMongo error: %s" % (new_state, pmex))
-            raise pmex
+
+        if recore.journal.ENABLED and \
+                self._seq - self._snapshot_seq >= recore.journal.SNAPSHOT_EVERY:
+            try:
+                self._snapshot_seq = recore.journal.snapshot(
+                    self.db, self.state_id)
+            except MONGO_ERRORS, cfex:
+                # Only costs a longer replay. Try again next time.
+                self.app_logger.warn("Could not snapshot state: %s" % cfex)
+
+    def _send_state(self, new_state):
+        if recore.wal.ENABLED:
+            if recore.journal.ENABLED:
+                self._wal_lsn = recore.wal.insert('journal', new_state)
+            else:
+                self._wal_lsn = recore.wal.update(
+                    'state', self._id, new_state)
+            return True
+        started = time.time()
+        if recore.journal.ENABLED:
+            result = recore.journal.append(self.db, new_state)
+        else:
+            result = self.state_coll.update(self._id, new_state)
+        recore.admission.observe_db_latency(time.time() - started)
+        return result
 
     def _cleanup(self):
         self.ch.queue_delete(queue=self.reply_queue)
         self.app_logger.debug("Deleted AMQP queue: %s" % self.reply_queue)
+        self._finishing = True
         self.conn.close()
         self.app_logger.debug("Closed AMQP connection")
 
@@ -194,8 +689,27 @@ a project's release steps."""
             }
         }
 
+        if self.cancelled.is_set():
+            outcome = CANCELLED
+        elif self._failed:
+            outcome = 'failed'
+        else:
+            outcome = 'completed'
+
         try:
             self.update_state(_update_state)
+            self._event('release.ended', status=outcome)
+            # Nothing after this will send kept updates for us
+            self._flush_state(wait=True)
+            if not recore.wal.wait(self._wal_lsn, recore.backoff.DEADLINE):
+                # It's safe in the log and gets there eventually
+                self.app_logger.warn("MongoDB is behind the write-ahead "
+                                     "log at release end")
+            if recore.journal.ENABLED:
+                # Leave a complete state document behind
+                self._snapshot_seq = recore.backoff.retry(
+                    lambda: recore.journal.snapshot(self.db, self.state_id),
+                    MONGO_ERRORS, "snapshotting state")
             self.app_logger.debug("Recorded release end time: %s" %
                                   _update_state['$set']['ended'])
         except Exception, e:
@@ -206,10 +720,7 @@ a project's release steps."""
 
     def _connect_mq(self):
         mq = recore.amqp.MQ_CONF
-        creds = pika.credentials.PlainCredentials(mq['NAME'], mq['PASSWORD'])
-        connection = pika.BlockingConnection(pika.ConnectionParameters(
-            host=str(mq['SERVER']),
-            credentials=creds))
+        connection = recore.transport.connect()
         self.app_logger.debug("Connection to MQ opened.")
         channel = connection.channel()
         self.app_logger.debug("MQ channel opened. Declaring exchange ...")
@@ -217,18 +728,50 @@ a project's release steps."""
                                  durable=True,
                                  exchange_type='topic')
         self.app_logger.debug("Exchange declared.")
-        result = channel.queue_declare(queue='',
-                                       exclusive=True,
-                                       durable=False)
+        # The reply queue is named after the release and not exclusive
+        # to this connection, so answers sent while we reconnect wait
+        # for us in it
+        name = reply_queue_name(self.state_id)
+        if self.reply_queue is not None:
+            self.reply_queue_lost = not self._queue_exists(connection, name)
+        result = channel.queue_declare(
+            queue=name,
+            exclusive=False,
+            durable=False,
+            auto_delete=False,
+            arguments={'x-expires': REPLY_QUEUE_EXPIRES * 1000})
         self.reply_queue = result.method.queue
         return (channel, connection)
 
-    def _setup(self):
+    def _queue_exists(self, connection, name):
+        # A passive declare of a missing queue closes the channel, so
+        # use a throwaway one
+        channel = connection.channel()
         try:
-            self.state.update(recore.mongo.lookup_state(self.state_id))
-        except TypeError:
-            self.app_logger.error("The given state document could not be located: %s" % self.state_id)
-            raise LookupError("The given state document could not be located: %s" % self.state_id)
+            channel.queue_declare(queue=name, passive=True)
+        except pika.exceptions.ChannelClosed:
+            return False
+        channel.close()
+        return True
+
+    def _setup(self):
+        # Only read the state document once. After that our in-memory
+        # release state is at least as fresh as what is in MongoDB.
+        if self.release is None:
+            state = recore.mongo.lookup_state(self.state_id)
+            if state is None:
+                self.app_logger.error("The given state document could not be located: %s" % self.state_id)
+                raise LookupError("The given state document could not be located: %s" % self.state_id)
+            if recore.journal.ENABLED:
+                self._snapshot_seq = state.get('journal_seq', 0)
+                state = recore.journal.replay(recore.mongo.database, state)
+                self._seq = state.get('journal_seq', 0)
+            steps = None
+            if state.get('playbook_version') is not None:
+                steps = recore.mongo.lookup_playbook_version(
+                    recore.mongo.database, state['playbook_version'])
+            self.release = ReleaseState.from_document(state, steps)
+            self.project = self.release.project
 
         try:
             if not self.ch and not self.conn:
@@ -238,10 +781,5 @@ a project's release steps."""
             self.app_logger.error("Couldn't connect to AMQP")
             raise e
 
-        self.project = self.state['project']
-        self.dynamic.update(self.state['dynamic'])
-        self.completed = self.state['completed_steps']
-        self.active = self.state['active_step']
-        self.remaining = self.state['remaining_steps']
         self.db = recore.mongo.database
         self.state_coll = self.db['state']
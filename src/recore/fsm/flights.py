@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Single-flight coalescing of identical steps.
+
+A step marked `"coalesce": true` is only dispatched once at a time per
+fingerprint (see `recore.playbook.Step.fingerprint`) by this core. The
+first FSM to reach it leads the flight and sends it to a worker; FSMs
+reaching an identical step meanwhile follow the flight and take its
+outcome instead of sending the worker a duplicate.
+"""
+
+import threading
+
+COMPLETED = 'completed'
+FAILED = 'failed'
+# The leader went away without an outcome. Followers have to run the
+# step themselves.
+ABANDONED = 'abandoned'
+
+# fingerprint: Flight
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+class Flight(object):
+    """One in-flight step. `leader` is the state id of the release
+which dispatched it."""
+    __slots__ = ('leader', 'status', 'landed')
+
+    def __init__(self, leader):
+        self.leader = leader
+        self.status = None
+        self.landed = threading.Event()
+
+    def wait(self, timeout=None):
+        """Wait for the outcome. Returns the status, or None on
+        timeout."""
+        self.landed.wait(timeout)
+        return self.status
+
+
+def join(fingerprint, state_id):
+    """Join the flight of the step with `fingerprint`, starting one if
+there is none. Returns a tuple of the Flight and whether `state_id`
+leads it."""
+    with _flights_lock:
+        flight = _flights.get(fingerprint)
+        if flight is not None:
+            return (flight, False)
+        flight = _flights[fingerprint] = Flight(state_id)
+        return (flight, True)
+
+
+def land(fingerprint, flight, status):
+    """Give the followers of `flight` its outcome. Only the first
+outcome counts."""
+    with _flights_lock:
+        if _flights.get(fingerprint) is flight:
+            del _flights[fingerprint]
+        if flight.landed.is_set():
+            return
+        flight.status = status
+        flight.landed.set()
+
+
+def in_flight():
+    """How many coalesced steps are running"""
+    return len(_flights)
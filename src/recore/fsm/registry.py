@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+The FSMs running in this process, by state id.
+"""
+
+import threading
+
+_live = {}
+_live_lock = threading.Lock()
+
+
+def add(fsm):
+    with _live_lock:
+        _live[fsm.state_id] = fsm
+
+
+def remove(state_id):
+    with _live_lock:
+        return _live.pop(state_id, None)
+
+
+def get(state_id):
+    """The running FSM of release `state_id`, or None"""
+    return _live.get(state_id)
+
+
+def count():
+    return len(_live)
+
+
+def state_ids():
+    with _live_lock:
+        return list(_live)
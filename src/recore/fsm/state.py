@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compact in-memory release state for the FSM.
+
+The compiled steps of a playbook version are shared by every release
+of that version (see `recore.playbook`). A `ReleaseState` then only
+needs to remember which of those shared steps it has completed and
+which one is active.
+
+State documents come in two shapes. Older ones carry their own copy of
+the steps, split into 'completed_steps', 'active_step' and
+'remaining_steps'. Versioned ones (see
+`recore.mongo.store_playbook_version`) reference the stored steps by
+'playbook_version' and record the same progress this class keeps:
+'completed' and 'active'.
+"""
+
+from recore.playbook import compile_steps
+
+
+class ReleaseState(object):
+    """Where one release is at. `steps` is the shared tuple from
+`compile_steps`, `completed` is how many of them have finished and
+`active` is the index of the running step, or None. `version` is the
+stored playbook version the state document references, if any."""
+    __slots__ = ('project', 'dynamic', 'steps', 'completed', 'active',
+                 'version')
+
+    def __init__(self, project, dynamic, steps, completed=0, active=None,
+                 version=None):
+        self.project = project
+        self.dynamic = dynamic
+        self.steps = steps
+        self.completed = completed
+        self.active = active
+        self.version = version
+
+    @classmethod
+    def from_document(cls, doc, steps=None):
+        """Build the release state from a 'state' collection document.
+        A versioned document needs the compiled `steps` of its
+        playbook version."""
+        if doc.get('playbook_version') is not None:
+            if steps is None:
+                raise ValueError("The steps of playbook version %s are "
+                                 "needed" % doc['playbook_version'])
+            return cls(doc['project'],
+                       doc.get('dynamic') or {},
+                       steps,
+                       completed=doc.get('completed') or 0,
+                       active=doc.get('active'),
+                       version=doc['playbook_version'])
+        completed = doc.get('completed_steps') or []
+        active = doc.get('active_step') or None
+        remaining = doc.get('remaining_steps') or []
+        playbook = list(completed)
+        if active:
+            playbook.append(active)
+        playbook.extend(remaining)
+        return cls(doc['project'],
+                   doc.get('dynamic') or {},
+                   compile_steps(playbook),
+                   completed=len(completed),
+                   active=len(completed) if active else None)
+
+    @property
+    def active_step(self):
+        if self.active is None:
+            return None
+        return self.steps[self.active]
+
+    def next_index(self):
+        """Index of the step which runs next"""
+        if self.active is None:
+            return self.completed
+        return self.active + 1
+
+    def start_next(self):
+        """Make the next step active. Raises IndexError if there are no
+        more steps."""
+        index = self.next_index()
+        if index >= len(self.steps):
+            raise IndexError("No steps remaining")
+        self.active = index
+        return self.steps[index]
+
+    def complete_active(self):
+        """Mark the active step completed"""
+        self.completed = self.active + 1
+        self.active = None
+
+    def completed_docs(self):
+        return [s.doc for s in self.steps[:self.completed]]
+
+    def remaining_docs(self):
+        return [s.doc for s in self.steps[self.next_index():]]
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Per-plugin dispatch limits.
+
+Before an FSM sends a step to `worker.<plugin>` it takes a slot for
+that plugin, and it gives the slot back once the step ends. A plugin
+may be limited to CONCURRENCY steps in flight and to RATE dispatches
+per second (a token bucket holding up to BURST tokens). A step over
+its plugin's limits waits here in the core, not in the broker. Set the
+limits per plugin in the config; plugins without limits are only
+counted:
+
+    "PLUGINS": {
+        "shexec": {"CONCURRENCY": 10, "RATE": 5, "BURST": 10}
+    }
+
+The limits hold for one core process. In prefork mode each worker gets
+its share of them (see `recore.prefork`).
+"""
+
+import logging
+import threading
+import time
+
+# plugin name: its configured limits
+PLUGIN_LIMITS = {}
+
+# plugin name: Limiter
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+out = logging.getLogger('recore')
+
+
+class Limiter(object):
+    """The in-flight count and token bucket of one plugin"""
+
+    def __init__(self, concurrency=0, rate=0, burst=0):
+        self.concurrency = concurrency
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.in_flight = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _delay(self):
+        """Seconds until a step could be dispatched, or None if that
+        depends on a step ending"""
+        if self.concurrency and self.in_flight >= self.concurrency:
+            return None
+        if self.rate and self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        return 0
+
+    def acquire(self, timeout=None):
+        """Wait for a slot. Returns False if `timeout` seconds passed
+        without getting one."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.time()
+                    self._refill(now)
+                    delay = self._delay()
+                    if delay == 0:
+                        break
+                    if deadline is not None:
+                        if now >= deadline:
+                            return False
+                        delay = min(delay or deadline - now, deadline - now)
+                    self.cond.wait(delay)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            if self.rate:
+                self.tokens -= 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    def saturation(self):
+        with self.cond:
+            self._refill(time.time())
+            return {
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'concurrency': self.concurrency,
+                'rate': self.rate,
+                'tokens': self.tokens if self.rate else None,
+            }
+
+
+def init_throttle(conf):
+    """Set the per-plugin limits from the PLUGINS config section"""
+    import recore.fsm.throttle
+    recore.fsm.throttle.PLUGIN_LIMITS = dict(
+        (name, dict((k.upper(), v) for (k, v) in limits.items()))
+        for (name, limits) in conf.items())
+    with _limiters_lock:
+        _limiters.clear()
+    for (name, limits) in PLUGIN_LIMITS.items():
+        out.info("Plugin %s limited to %s concurrent steps, %s per "
+                 "second" % (name, limits.get('CONCURRENCY') or 'unlimited',
+                             limits.get('RATE') or 'unlimited'))
+
+
+def limiter(plugin):
+    """The Limiter of `plugin`"""
+    with _limiters_lock:
+        if plugin not in _limiters:
+            limits = PLUGIN_LIMITS.get(plugin, {})
+            _limiters[plugin] = Limiter(int(limits.get('CONCURRENCY', 0)),
+                                        float(limits.get('RATE', 0)),
+                                        float(limits.get('BURST', 0)))
+        return _limiters[plugin]
+
+
+def acquire(plugin, timeout=None):
+    """Take a dispatch slot for `plugin`, waiting as long as its limits
+require"""
+    return limiter(plugin).acquire(timeout)
+
+
+def release(plugin):
+    """Give back the dispatch slot taken for `plugin`"""
+    limiter(plugin).release()
+
+
+def saturation():
+    """In-flight and waiting step counts, and limits, of every plugin
+which has had steps dispatched"""
+    with _limiters_lock:
+        limiters = _limiters.items()
+    return dict((name, l.saturation()) for (name, l) in limiters)
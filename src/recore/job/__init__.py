@@ -13,3 +13,31 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Handlers for the job.* topics.
+"""
+
+import logging
+import pika.exceptions
+import recore.codec
+
+
+def answer(ch, reply_to, msg, correlation_id=None):
+    """Send `msg` to `reply_to`, tagged with `correlation_id` if given.
+Losing the connection here must not stop the work we were asked for,
+so that is only logged."""
+    out = logging.getLogger('recore')
+    if correlation_id is None:
+        (body, props) = recore.codec.encode(msg)
+    else:
+        (body, props) = recore.codec.encode(
+            msg, correlation_id=correlation_id)
+    out.debug("Sending to routing key %s: %s" % (reply_to, msg))
+    try:
+        ch.basic_publish(exchange='',
+                         routing_key=reply_to,
+                         body=body,
+                         properties=props)
+    except pika.exceptions.AMQPError, e:
+        out.error("Could not answer %s: %s" % (reply_to, e))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+This is where we cancel jobs
+
+FSM will get {"id": "$STATE_ID"} with the topic of job.cancel and,
+optionally, a reply_to. It answers {"id": ..., "cancelled": true} if
+the release was running, waiting to start or scheduled, false
+otherwise.
+
+A running release is stopped right away, not when its active step
+ends: the worker running the step is told to give up, the release's
+state document is marked 'cancelled' and its thread, connection and
+reply queue are let go.
+
+The release may belong to another process: a prefork worker (see
+`recore.prefork`) or another core. A queued or scheduled one is then
+cancelled in MongoDB, which keeps whoever holds it from starting it. A
+running one is sent the same wake up message, which makes its FSM stop
+once it next waits for a worker.
+"""
+
+import logging
+import bson.errors
+import pymongo.errors
+import recore.admission
+import recore.codec
+import recore.fsm
+import recore.fsm.registry
+import recore.job
+import recore.mongo
+import recore.schedule
+
+
+def cancel(ch, id, reply_to=None):
+    """`ch` is an open AMQP channel
+
+    `id` is the state id of the release to cancel
+    `reply_to` is a temporary channel, or None for no answer
+
+Returns whether the release was found to cancel."""
+    out = logging.getLogger('recore')
+    notify = logging.getLogger('recore.stdout')
+    fsm = recore.fsm.registry.get(id)
+    if fsm is not None:
+        fsm.cancel()
+        # The FSM spends its time waiting on its reply queue. Wake it
+        # up. (If it hasn't declared the queue yet it will see the
+        # flag before it dispatches anything.)
+        wake(ch, id)
+        found = True
+    elif recore.admission.position(id) is not None or \
+            recore.schedule.is_scheduled(id):
+        found = cancel_waiting(ch, id)
+    else:
+        found = cancel_elsewhere(ch, id)
+
+    if found:
+        out.info("Cancelled release %s" % id)
+        notify.info("Cancelled release %s" % id)
+    else:
+        out.warn("Release %s is not running here. Can not cancel it" % id)
+    if reply_to:
+        recore.job.answer(ch, reply_to, {'id': id, 'cancelled': found})
+    return found
+
+
+def wake(ch, id):
+    """Tell the FSM of release `id` to stop, through its reply queue"""
+    (body, props) = recore.codec.encode(
+        {'id': id}, type=recore.fsm.CANCEL, correlation_id=id)
+    ch.basic_publish(exchange='',
+                     routing_key=recore.fsm.reply_queue_name(id),
+                     body=body,
+                     properties=props)
+
+
+def cancel_waiting(ch, id):
+    """Cancel release `id`, queued or scheduled here. It's cancelled
+in MongoDB first and only then forgotten here, so if MongoDB can't be
+reached it stays as it was. Returns whether it was cancelled."""
+    out = logging.getLogger('recore')
+    try:
+        cancelled = recore.mongo.cancel_waiting(recore.mongo.database, id)
+    except pymongo.errors.PyMongoError, e:
+        out.error("Unable to cancel release %s: %s" % (id, e))
+        return False
+    if not cancelled:
+        # Started meanwhile, maybe by another process
+        return cancel_elsewhere(ch, id)
+    recore.admission.unqueue(id)
+    recore.schedule.unschedule(id)
+    return True
+
+
+def cancel_elsewhere(ch, id):
+    """Cancel release `id`, which isn't ours, if some other process
+has it waiting or running. Returns whether it did."""
+    out = logging.getLogger('recore')
+    d = recore.mongo.database
+    try:
+        if recore.mongo.cancel_waiting(d, id):
+            return True
+        doc = recore.mongo.lookup_release_status(d, id)
+    except (bson.errors.InvalidId, pymongo.errors.PyMongoError), e:
+        out.error("Unable to look for release %s elsewhere: %s" % (id, e))
+        return False
+    if doc is None or doc.get('ended') or doc.get('archived'):
+        return False
+    out.info("Release %s is running elsewhere. Telling it to stop" % id)
+    wake(ch, id)
+    return True
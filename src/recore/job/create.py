@@ -21,31 +21,168 @@ FSM will get {"project": "$NAME"} with the topic of job.create and
 a reply_to set
 
 it expects a message with {"id": $an_int_here} back to the reply_to.
+
+Many releases can be started with one message by sending a batch
+instead:
+
+    {"releases": [{"project": "$NAME", "dynamic": {...}}, ...]}
+
+which is answered with {"ids": [...]}, one id (or null, if that
+release could not be created) per requested release, in order.
+
+A single job.create may also say when the release should start with a
+"start_at" time; see `recore.schedule`.
+
+A single job.create may carry an "idempotency_key". Clients retrying a
+request they never got an answer to should send the same key again:
+within IDEMPOTENCY_WINDOW seconds of the first request the id of the
+release it created is sent back and nothing new is started. Keys are
+remembered in a small LRU and, so they survive restarts and work
+across cores, in a unique index on the 'state' collection. Set these
+in the config:
+
+    "IDEMPOTENCY": {
+        "WINDOW": 3600,
+        "CACHE_SIZE": 4096
+    }
 """
 
-import recore.utils
+import datetime
+import recore.job
 import recore.mongo
+import recore.playbook
 import logging
+import pymongo.errors
+from collections import OrderedDict
+
+# Seconds during which a repeated idempotency key is a duplicate
+IDEMPOTENCY_WINDOW = 3600
+# How many recent keys to remember without asking MongoDB
+IDEMPOTENCY_CACHE_SIZE = 4096
+# idempotency key: (release id, created)
+_recent_keys = OrderedDict()
+
+
+def init_idempotency(conf):
+    """Configure idempotency keys from the IDEMPOTENCY config section"""
+    import recore.job.create
+    recore.job.create.IDEMPOTENCY_WINDOW = int(
+        conf.get('WINDOW', IDEMPOTENCY_WINDOW))
+    recore.job.create.IDEMPOTENCY_CACHE_SIZE = int(
+        conf.get('CACHE_SIZE', IDEMPOTENCY_CACHE_SIZE))
+    _recent_keys.clear()
+
+
+def remember_key(key, id, created):
+    """Add `key` to the LRU of recent idempotency keys"""
+    _recent_keys.pop(key, None)
+    _recent_keys[key] = (id, created)
+    while len(_recent_keys) > IDEMPOTENCY_CACHE_SIZE:
+        _recent_keys.popitem(last=False)
+
+
+def existing_release(key):
+    """The id of the release created with idempotency `key` within the
+window, or None. A release with the key from outside the window gives
+the key up so it can be used again."""
+    out = logging.getLogger('recore')
+    now = datetime.datetime.utcnow()
+    window = datetime.timedelta(seconds=IDEMPOTENCY_WINDOW)
+
+    if key in _recent_keys:
+        (id, created) = _recent_keys.pop(key)
+        if now - created <= window:
+            _recent_keys[key] = (id, created)
+            return id
+
+    found = recore.mongo.lookup_idempotent_release(
+        recore.mongo.database, key)
+    if found is None:
+        return None
+    if now - found['created'] <= window:
+        remember_key(key, str(found['_id']), found['created'])
+        return str(found['_id'])
+    out.debug("Idempotency key %s of release %s has expired" % (
+        key, found['_id']))
+    recore.mongo.release_idempotency_key(
+        recore.mongo.database, found['_id'])
+    return None
+
+
+def validate(project, playbook, dynamic):
+    """Compile the `playbook` of `project` and check the `dynamic`
+data covers everything its steps declare. Returns the compiled steps,
+or None (after logging why) if a release should not be created."""
+    out = logging.getLogger('recore')
+    notify = logging.getLogger('recore.stdout')
+    try:
+        steps = recore.playbook.compile_playbook(playbook)
+    except recore.playbook.InvalidPlaybook, ipe:
+        out.error("Playbook for project %s is invalid: %s" % (
+            project, ipe))
+        notify.error("Playbook for project %s is invalid: %s" % (
+            project, ipe))
+        return None
 
+    # Every dynamic variable a step asks for must be given up
+    # front, rather than the release failing when it gets there
+    if not isinstance(dynamic, dict):
+        out.error("Dynamic data for %s is not an object: %s" % (
+            project, dynamic))
+        notify.error("Dynamic data for %s is not an object" % project)
+        return None
+    missing = recore.playbook.missing_dynamic(steps, dynamic)
+    if missing:
+        out.error("Release of %s is missing dynamic items: %s" % (
+            project, ", ".join(missing)))
+        notify.error("Release of %s is missing dynamic items: %s" % (
+            project, ", ".join(missing)))
+        return None
+    return steps
 
-def release(ch, project, reply_to, dynamic):
+
+def reply(ch, reply_to, id):
+    """Tell whoever asked for a release its `id`"""
+    recore.job.answer(ch, reply_to, {'id': id})
+
+
+def release(ch, project, reply_to, dynamic, idempotency_key=None,
+            start_at=None):
     """`ch` is an open AMQP channel
 
     `project` is the name of a project to begin a release for.
     `reply_to` is a temporary channel
     `dynamic` is a dict storing dynamic input -- default is {}
+    `idempotency_key` optionally identifies this request across retries
+    `start_at` is the future UTC datetime to start it at, if not now
 
 Reference the project name against the database to retrieve a list of
-release steps to execute.
+release steps to execute. The steps are compiled (and so validated)
+here, before any state is created, so a release of a broken playbook,
+or one missing `dynamic` items its steps declare, never starts.
 
 We then generate a correlation_id by inserting a new document into the
 'state' collection. The correlation_id is equivalent to the
 automatically generated '_id' property of this document.
 
 Once we have a state document we are ready to initialize another FSM
-instance with that document ID."""
+instance with that document ID.
+
+If `idempotency_key` belongs to a recent release, that release's id is
+sent back instead and None is returned, as there is nothing new to
+run."""
     out = logging.getLogger('recore')
     notify = logging.getLogger('recore.stdout')
+    if idempotency_key is not None:
+        id = existing_release(idempotency_key)
+        if id is not None:
+            out.info("Release %s already exists for idempotency key %s" % (
+                id, idempotency_key))
+            notify.info("Duplicate request for %s. Job id: %s" % (
+                project, id))
+            reply(ch, reply_to, id)
+            return None
+
     out.debug("Checking mongo for info on project %s" % project)
     notify.debug(
         "new job submitted from rest for %s. Need to look it up "
@@ -57,22 +194,88 @@ instance with that document ID."""
     notify.debug("looked up project: %s" % project)
 
     if project_exists:
+        if validate(project, project_exists, dynamic) is None:
+            return None
+
         # Initialize state and include the dynamic items
-        id = str(recore.mongo.initialize_state(mongo_db, project, dynamic))
+        try:
+            id = str(recore.mongo.initialize_state(
+                mongo_db, project, dynamic,
+                steps=project_exists.get('steps', []),
+                idempotency_key=idempotency_key,
+                start_at=start_at))
+        except pymongo.errors.DuplicateKeyError:
+            # Another request with the same key got there first
+            id = existing_release(idempotency_key)
+            out.info("Release %s already exists for idempotency key %s" % (
+                id, idempotency_key))
+            if id is not None:
+                reply(ch, reply_to, id)
+            return None
         out.debug("State created for '%s' in mongo with id: %s" % (project, id))
+        if idempotency_key is not None:
+            remember_key(idempotency_key, id, datetime.datetime.utcnow())
     else:
         out.error("Project %s does not exists in mongo" % project)
         id = None
         return id
 
-    body = recore.utils.create_json_str({'id': id})
-
-    out.debug("Sending to routing key %s: %s" % (reply_to, body))
-    ch.basic_publish(exchange='',
-                     routing_key=reply_to,
-                     body=body)
+    reply(ch, reply_to, id)
     out.info("Emitted message to start new release for %s. Job id: %s" % (
         project, str(id)))
     notify.info("Emitted message to start new release for %s. Job id: %s" % (
         project, str(id)))
     return id
+
+
+def release_batch(ch, releases, reply_to):
+    """`ch` is an open AMQP channel
+
+    `releases` is a list of {"project": ..., "dynamic": {...}} dicts
+    `reply_to` is a temporary channel
+
+Like `release`, but for many releases at once: every playbook is
+looked up with one query and every state document is created with one
+bulk insert. Returns the list of ids, with None in place of any
+release which could not be created. The same list is sent back to
+`reply_to` as {"ids": [...]}."""
+    out = logging.getLogger('recore')
+    notify = logging.getLogger('recore.stdout')
+    mongo_db = recore.mongo.database
+
+    projects = set()
+    for r in releases:
+        if isinstance(r, dict) and 'project' in r:
+            projects.add(r['project'])
+    playbooks = recore.mongo.lookup_projects(mongo_db, list(projects))
+    out.debug("Looked up %s projects for a batch of %s releases" % (
+        len(playbooks), len(releases)))
+
+    ids = [None] * len(releases)
+    to_create = []
+    for (i, r) in enumerate(releases):
+        if not isinstance(r, dict) or 'project' not in r:
+            out.error("Batch item %s has no project. Skipping it" % i)
+            continue
+        project = r['project']
+        dynamic = r.get('dynamic', {})
+        if project not in playbooks:
+            out.error("Project %s does not exists in mongo" % project)
+            continue
+        if validate(project, playbooks[project], dynamic) is None:
+            continue
+        to_create.append(
+            (i, project, dynamic, playbooks[project].get('steps', [])))
+
+    if to_create:
+        created = recore.mongo.initialize_states(
+            mongo_db, [(p, d, s) for (_, p, d, s) in to_create])
+        for ((i, project, _, _), id) in zip(to_create, created):
+            ids[i] = str(id)
+
+    recore.job.answer(ch, reply_to, {'ids': ids})
+    out.info("Emitted message to start %s of %s batched releases" % (
+        len(to_create), len(releases)))
+    notify.info("Emitted message to start %s of %s batched releases" % (
+        len(to_create), len(releases)))
+    return ids
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+This is where we report on jobs
+
+FSM will get {"id": "$STATE_ID"} with the topic of job.status and a
+reply_to (and, if the client wants to match up answers, a
+correlation_id, which is sent back).
+
+Releases this core is running are answered from memory:
+
+    {"id": ..., "project": ..., "status": "running", "step": "$NAME",
+     "phase": "started", "completed": 2, "total": 5,
+     "started": "$ISO8601", "step_started": "$ISO8601",
+     "plugin": {"name": "shexec", "in_flight": 10, "waiting": 3,
+                "concurrency": 10, "rate": 5.0, "tokens": 0.4}}
+
+"plugin" says how saturated the active step's plugin is in this core
+(see `recore.fsm.throttle`): a step held back by its limits shows up
+as "waiting" there.
+
+Releases waiting to start here are "queued", with their "position" in
+line. Anything else is looked up in MongoDB, reading only the fields
+needed to give the same kind of answer (and, in journal mode, the
+journal entries since the last snapshot), or in the archive of
+finished releases. Scheduled releases also say when they "start_at".
+"""
+
+import logging
+import bson.errors
+import pymongo.errors
+import recore.admission
+import recore.fsm
+import recore.fsm.registry
+import recore.job
+import recore.journal
+import recore.mongo
+import recore.schedule
+
+
+def status(ch, id, reply_to, correlation_id=None):
+    """`ch` is an open AMQP channel
+
+    `id` is the state id of the release to report on
+    `reply_to` is a temporary channel, or None for no answer
+    `correlation_id` is sent back with the answer
+
+Returns the answer sent."""
+    fsm = recore.fsm.registry.get(id)
+    if fsm is not None:
+        report = fsm.status()
+    else:
+        position = recore.admission.position(id)
+        if position is not None:
+            report = {'id': id,
+                      'status': recore.admission.QUEUED,
+                      'position': position}
+        else:
+            report = stored_status(id)
+    if reply_to:
+        recore.job.answer(ch, reply_to, report, correlation_id)
+    return report
+
+
+def stored_status(id):
+    """The status of release `id` as recorded in MongoDB"""
+    out = logging.getLogger('recore')
+    try:
+        doc = recore.mongo.lookup_release_status(recore.mongo.database, id)
+        if doc is not None and recore.journal.ENABLED:
+            doc = recore.journal.replay(recore.mongo.database, doc)
+    except bson.errors.InvalidId:
+        doc = None
+    except pymongo.errors.ConnectionFailure, cfe:
+        out.error("MongoDB unavailable, can not look up %s: %s" % (id, cfe))
+        return {'id': id, 'error': 'MongoDB unavailable'}
+    if doc is None:
+        return {'id': id, 'status': 'unknown'}
+
+    if doc.get('playbook_version') is not None or doc.get('archived'):
+        (step, completed, total) = _counted_progress(doc)
+    else:
+        (step, completed, total) = _progress(doc)
+    if doc.get('cancelled'):
+        state = recore.fsm.CANCELLED
+    elif doc.get('failed'):
+        state = 'failed'
+    elif doc.get('ended'):
+        state = 'completed'
+    else:
+        state = doc.get('status') or recore.admission.RUNNING
+    report = {
+        'id': id,
+        'project': doc.get('project'),
+        'status': state,
+        'step': step,
+        'completed': completed,
+        'total': total,
+        'created': _isoformat(doc.get('created')),
+        'ended': _isoformat(doc.get('ended')),
+    }
+    if doc.get('error'):
+        report['error'] = doc['error']
+    if state == recore.schedule.SCHEDULED:
+        report['start_at'] = _isoformat(doc.get('start_at'))
+    return report
+
+
+def _progress(doc):
+    """(active step name, completed, total) of a state document with
+its own copy of the steps"""
+    completed = doc.get('completed_steps') or []
+    active = doc.get('active_step') or None
+    remaining = doc.get('remaining_steps') or []
+    return (active.get('name') if active else None,
+            len(completed),
+            len(completed) + len(remaining) + (1 if active else 0))
+
+
+def _counted_progress(doc):
+    """(active step name, completed, total) of a state document which
+references a playbook version, or of an archived release"""
+    out = logging.getLogger('recore')
+    name = None
+    if doc.get('active') is not None:
+        try:
+            steps = recore.mongo.lookup_playbook_version(
+                recore.mongo.database, doc['playbook_version'])
+            name = steps[doc['active']].name
+        except (LookupError, pymongo.errors.ConnectionFailure), e:
+            out.error("Can not name the active step of %s: %s" % (
+                doc['_id'], e))
+    return (name, doc.get('completed') or 0, doc.get('total') or 0)
+
+
+def _isoformat(when):
+    if when is None:
+        return None
+    return when.isoformat()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Event-sourced release state.
+
+By default the FSM rewrites its release's state document on every
+transition, arrays of step documents and all, and what it overwrites
+is gone. In journal mode each transition is instead appended to the
+'journal' collection as a small entry which is never changed:
+
+    {"release": ObjectId(...), "seq": 7, "at": ...,
+     "type": "step.completed", ...}
+
+The state document becomes a snapshot: every SNAPSHOT_EVERY entries,
+and when the release ends, it is brought up to date by replaying the
+entries since the last snapshot onto it, and records the "journal_seq"
+it includes. The current state of a release is always its snapshot
+plus the entries after it, which is also how an FSM recovers. Turn it
+on in the config:
+
+    "JOURNAL": {
+        "ENABLED": true,
+        "SNAPSHOT_EVERY": 20
+    }
+
+The entry types are 'step.started' (the next remaining step became
+active), 'step.completed' (the active step completed, with where its
+result came from if it was 'cached' or 'shared') and 'set' (other
+'fields' of the state document changed).
+"""
+
+import datetime
+import logging
+import pymongo.errors
+from bson.objectid import ObjectId
+
+ENABLED = False
+SNAPSHOT_EVERY = 20
+
+STEP_STARTED = 'step.started'
+STEP_COMPLETED = 'step.completed'
+SET = 'set'
+
+out = logging.getLogger('recore')
+
+
+def init_journal(conf):
+    """Configure journal mode from the JOURNAL config section"""
+    import recore.journal
+    recore.journal.ENABLED = bool(conf.get('ENABLED', False))
+    recore.journal.SNAPSHOT_EVERY = int(
+        conf.get('SNAPSHOT_EVERY', SNAPSHOT_EVERY))
+    if recore.journal.ENABLED:
+        out.info("Journaling release state, snapshotting every %s "
+                 "entries" % recore.journal.SNAPSHOT_EVERY)
+
+
+def entry(state_id, seq, type, **fields):
+    """Journal entry number `seq` of release `state_id`"""
+    doc = dict(fields)
+    doc.update({
+        'release': ObjectId(str(state_id)),
+        'seq': seq,
+        'at': datetime.datetime.utcnow(),
+        'type': type,
+    })
+    return doc
+
+
+def set_entry(state_id, seq, update):
+    """The entry for a plain {'$set': {...}} state `update`. Raises
+ValueError for anything else."""
+    if update.keys() != ['$set']:
+        raise ValueError("Can not journal update %s" % update)
+    return entry(state_id, seq, SET, fields=update['$set'])
+
+
+def append(d, doc):
+    """Add entry `doc` to the journal. Adding an entry which is already
+there (a retry after an unclear failure) is fine."""
+    try:
+        d['journal'].insert(doc)
+    except pymongo.errors.DuplicateKeyError:
+        out.debug("Journal entry %s of %s already written" % (
+            doc['seq'], doc['release']))
+    return True
+
+
+def apply(doc, e):
+    """Play journal entry `e` onto the state document `doc`"""
+    versioned = doc.get('playbook_version') is not None
+    if e['type'] == STEP_STARTED and versioned:
+        doc['active'] = doc.get('completed') or 0
+    elif e['type'] == STEP_STARTED:
+        remaining = doc.get('remaining_steps') or []
+        doc['active_step'] = remaining[0]
+        doc['remaining_steps'] = remaining[1:]
+    elif e['type'] == STEP_COMPLETED:
+        if versioned:
+            doc['completed'] = doc['active'] + 1
+            doc['active'] = None
+        else:
+            doc['completed_steps'] = (doc.get('completed_steps') or []) + [
+                doc['active_step']]
+            doc['active_step'] = None
+        for source in ('cached', 'shared'):
+            if e.get(source) is not None:
+                key = '%s_steps' % source
+                doc[key] = (doc.get(key) or []) + [e[source]]
+    elif e['type'] == SET:
+        doc.update(e['fields'])
+    else:
+        raise ValueError("Unknown journal entry type %s" % e['type'])
+    doc['journal_seq'] = e['seq']
+    return doc
+
+
+def replay(d, doc):
+    """Bring the snapshot `doc` of a release up to date with the
+entries after it. Returns `doc`, updated in place."""
+    found = d['journal'].find({'release': doc['_id'],
+                               'seq': {'$gt': doc.get('journal_seq', 0)}})
+    for e in sorted(found, key=lambda e: e['seq']):
+        apply(doc, e)
+    return doc
+
+
+def snapshot(d, state_id):
+    """Replay the journal of release `state_id` onto its state document
+and save that. Returns the seq of the last entry it includes."""
+    _id = ObjectId(str(state_id))
+    doc = replay(d, d['state'].find_one({'_id': _id}))
+    del doc['_id']
+    d['state'].update({'_id': _id}, {'$set': doc})
+    return doc.get('journal_seq', 0)
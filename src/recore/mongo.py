@@ -21,11 +21,22 @@ import pymongo.database
 import urllib
 import datetime
 import logging
+import threading
 import recore.constants
+import recore.playbook
 import recore.utils
 
 connection = None
 database = None
+# Seconds a cacheable step's result is reused for
+STEP_RESULT_TTL = 86400
+# Whether new state documents reference a stored playbook version
+# rather than carrying their own copy of its steps
+PLAYBOOK_VERSIONS = False
+
+# The playbook versions this process knows are stored
+_stored_versions = set()
+_stored_versions_lock = threading.Lock()
 
 
 def init_mongo(db):
@@ -39,6 +50,39 @@ def init_mongo(db):
         db['DATABASE'])
     recore.mongo.connection = c
     recore.mongo.database = d
+    configure(db)
+    ensure_indexes(d)
+
+
+def configure(db):
+    """Apply the DB config section's settings which don't depend on
+the backend"""
+    import recore.mongo
+    recore.mongo.STEP_RESULT_TTL = int(
+        db.get('STEP_RESULT_TTL', STEP_RESULT_TTL))
+    recore.mongo.PLAYBOOK_VERSIONS = bool(
+        db.get('PLAYBOOK_VERSIONS', PLAYBOOK_VERSIONS))
+
+
+def ensure_indexes(d):
+    """Create the indexes the core relies on, if they don't exist"""
+    out = logging.getLogger('recore')
+    # Only releases created with an idempotency key have one, and no
+    # two of them may share it
+    d['state'].ensure_index('idempotency_key', unique=True, sparse=True)
+    # Only some releases have a status: 'queued' or 'scheduled' ones,
+    # which then become 'running', and 'cancelled' or 'failed' ones.
+    # A release started at once has none unless it is cancelled or
+    # fails.
+    d['state'].ensure_index('status', sparse=True)
+    # MongoDB deletes cached step results once they expire. Note an
+    # existing index keeps the TTL it was created with.
+    d['step_results'].ensure_index('created',
+                                   expireAfterSeconds=STEP_RESULT_TTL)
+    # Journal entries are read back in order, and written only once
+    d['journal'].ensure_index([('release', pymongo.ASCENDING),
+                               ('seq', pymongo.ASCENDING)], unique=True)
+    out.debug("Ensured indexes on the state collection")
 
 
 def connect(host, port, user, password, db):
@@ -78,6 +122,26 @@ is either a hash or `None` if no matches were found.
         return {}
 
 
+def lookup_projects(d, projects):
+    """Given a mongodb database, `d`, look up every project named in the
+list `projects` from the 'playbooks' collection with a single
+query. Returns a dict of project name to playbook document, without
+entries for projects which don't exist.
+    """
+    out = logging.getLogger('recore')
+    try:
+        found = d['playbooks'].find({'project': {'$in': projects}})
+        playbooks = dict((p['project'], p) for p in found)
+        out.debug("Found %s of %s project definitions" % (
+            len(playbooks), len(projects)))
+        return playbooks
+    except KeyError, kex:
+        out.error(
+            "KeyError raised while trying to look up projects: %s."
+            "Returning {}" % kex)
+        return {}
+
+
 def lookup_state(c_id):
     """`c_id` is a correlation ID corresponding to the ObjectID value in
 MongoDB.
@@ -96,8 +160,184 @@ MongoDB.
     return project_state
 
 
-def initialize_state(d, project, dynamic={}):
-    """Initialize the state of a given project release"""
+def lookup_idempotent_release(d, key):
+    """Find the release which was created with the idempotency `key`.
+Returns its state document (only the '_id' and 'created' fields) or
+None."""
+    return d['state'].find_one({'idempotency_key': key},
+                               fields=['created'])
+
+
+def release_idempotency_key(d, id):
+    """Forget the idempotency key of release `id` so the key can be
+used again"""
+    d['state'].update({'_id': id}, {'$unset': {'idempotency_key': 1}})
+
+
+# What job.status reads of a release this core isn't running
+STATUS_FIELDS = ['project', 'status', 'failed', 'cancelled', 'error',
+                 'created', 'ended', 'active_step.name',
+                 'completed_steps.name', 'remaining_steps.name',
+                 'journal_seq', 'playbook_version', 'completed', 'active',
+                 'total', 'archived', 'start_at']
+
+
+def lookup_release_status(d, id):
+    """The parts of release `id`'s state document job.status needs (not
+the steps' parameters), or None. Archived releases are looked up in
+the archive (see `recore.archive`)."""
+    _id = ObjectId(str(id))
+    found = d['state'].find_one({'_id': _id}, fields=STATUS_FIELDS)
+    if found is None:
+        found = d['state_archive'].find_one({'_id': _id},
+                                            fields=STATUS_FIELDS)
+    return found
+
+
+def set_status(d, id, status):
+    """Record the admission `status` of release `id`"""
+    d['state'].update({'_id': ObjectId(str(id))},
+                      {'$set': {'status': status}})
+
+
+def lookup_queued(d):
+    """The ids of releases with a 'queued' status, oldest first"""
+    found = d['state'].find({'status': 'queued'}, fields=['created'])
+    return [str(s['_id']) for s in sorted(found, key=lambda s: s['created'])]
+
+
+def lookup_scheduled(d):
+    """(id, start_at) of every release with a 'scheduled' status"""
+    found = d['state'].find({'status': 'scheduled'}, fields=['start_at'])
+    return [(str(s['_id']), s['start_at']) for s in found]
+
+
+def change_status(d, id, old, new):
+    """Change the status of release `id` from `old` to `new`. Returns
+False if it didn't have the `old` status any more: another core (or
+process) got to it first, or it was cancelled."""
+    result = d['state'].update({'_id': ObjectId(str(id)), 'status': old},
+                               {'$set': {'status': new}})
+    return bool(result and result.get('n'))
+
+
+def cancel_waiting(d, id):
+    """Record that release `id` was cancelled, if it is still queued
+or scheduled. Returns False if it wasn't."""
+    result = d['state'].update(
+        {'_id': ObjectId(str(id)),
+         'status': {'$in': ['queued', 'scheduled']}},
+        {'$set': {'status': 'cancelled',
+                  'cancelled': True,
+                  'ended': datetime.datetime.now()}})
+    return bool(result and result.get('n'))
+
+
+def lookup_step_result(d, fingerprint):
+    """The cached result of a cacheable step with `fingerprint`, or
+None. Results older than STEP_RESULT_TTL are ignored even if MongoDB
+has not expired them yet."""
+    out = logging.getLogger('recore')
+    oldest = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=STEP_RESULT_TTL)
+    try:
+        return d['step_results'].find_one(
+            {'_id': fingerprint, 'created': {'$gt': oldest}})
+    except pymongo.errors.PyMongoError, pmex:
+        # Without the cache the step just runs again
+        out.error("Unable to look up step result %s: %s" % (
+            fingerprint, pmex))
+        return None
+
+
+def record_step_result(d, fingerprint, state_id, step_name):
+    """Remember that the cacheable step with `fingerprint` completed,
+in the release `state_id`"""
+    out = logging.getLogger('recore')
+    try:
+        d['step_results'].update(
+            {'_id': fingerprint},
+            {'$set': {'created': datetime.datetime.utcnow(),
+                      'release': str(state_id),
+                      'step': step_name}},
+            upsert=True)
+        out.debug("Cached the result of step %s as %s" % (
+            step_name, fingerprint))
+    except pymongo.errors.PyMongoError, pmex:
+        out.error("Unable to cache the result of step %s: %s" % (
+            step_name, pmex))
+
+
+def store_playbook_version(d, steps):
+    """Store the list of playbook `steps` in the 'playbook_versions'
+collection, unless it's there already. Versions are immutable and
+named by their content hash, which is returned."""
+    version = recore.playbook.playbook_version(steps)
+    with _stored_versions_lock:
+        if version in _stored_versions:
+            return version
+    try:
+        d['playbook_versions'].insert({
+            '_id': version,
+            'steps': steps,
+            'created': datetime.datetime.utcnow()})
+    except pymongo.errors.DuplicateKeyError:
+        # Stored by an earlier release (or another core)
+        pass
+    with _stored_versions_lock:
+        _stored_versions.add(version)
+    return version
+
+
+def lookup_playbook_version(d, version):
+    """The compiled steps of the stored playbook `version`. Raises
+LookupError if there is no such version."""
+    steps = recore.playbook.compiled_version(version)
+    if steps is not None:
+        return steps
+    found = d['playbook_versions'].find_one({'_id': version})
+    if found is None:
+        raise LookupError("No playbook version %s" % version)
+    return recore.playbook.compile_steps(found['steps'])
+
+
+def new_state_record(project, dynamic, steps, idempotency_key=None,
+                     version=None, start_at=None):
+    """A fresh state document for a release of `project`. With a
+`version` (see store_playbook_version) the document references the
+stored steps and only records its progress through them. With a
+`start_at` (UTC datetime) the release is 'scheduled' to start then."""
+    state0 = recore.constants.NEW_STATE_RECORD.copy()
+    state0.update({
+        'created': datetime.datetime.utcnow(),
+        'project': project,
+        'dynamic': dynamic,
+        'remaining_steps': steps
+    })
+    if version is not None:
+        for key in ('completed_steps', 'active_step', 'remaining_steps'):
+            del state0[key]
+        state0.update({
+            'playbook_version': version,
+            'completed': 0,
+            'active': None,
+            'total': len(steps),
+        })
+    # The unique index is sparse, so releases without a key must not
+    # have the field at all
+    if idempotency_key is not None:
+        state0['idempotency_key'] = idempotency_key
+    if start_at is not None:
+        state0.update({'status': 'scheduled', 'start_at': start_at})
+    return state0
+
+
+def initialize_state(d, project, dynamic={}, steps=None,
+                     idempotency_key=None, start_at=None):
+    """Initialize the state of a given project release. `steps` is the
+playbook's list of steps; it's looked up if not given. Raises
+DuplicateKeyError if a release with `idempotency_key` exists. A
+release with a `start_at` is recorded as scheduled."""
     # Just record the name now and insert an empty array to record the
     # result of steps. Oh, and when it started. Maybe we'll even add
     # who started it later!
@@ -110,16 +350,14 @@ def initialize_state(d, project, dynamic={}):
     # which when `str`'d returns a reasonable value.
     out = logging.getLogger('recore')
 
-    project_steps = lookup_project(d, project).get('steps', [])
+    if steps is None:
+        steps = lookup_project(d, project).get('steps', [])
 
-    # TODO: Validate dynamic before inserting state ...
-    state0 = recore.constants.NEW_STATE_RECORD.copy()
-    state0.update({
-        'created': datetime.datetime.utcnow(),
-        'project': project,
-        'dynamic': dynamic,
-        'remaining_steps': project_steps
-    })
+    version = None
+    if PLAYBOOK_VERSIONS:
+        version = store_playbook_version(d, steps)
+    state0 = new_state_record(project, dynamic, steps, idempotency_key,
+                              version, start_at)
 
     try:
         id = d['state'].insert(state0)
@@ -133,6 +371,28 @@ def initialize_state(d, project, dynamic={}):
     return id
 
 
+def initialize_states(d, releases):
+    """Initialize the state of many releases with one bulk insert.
+`releases` is a list of (project, dynamic, steps) tuples. Returns the
+list of new ObjectIDs, in the same order."""
+    out = logging.getLogger('recore')
+    states = []
+    for (p, dy, s) in releases:
+        version = None
+        if PLAYBOOK_VERSIONS:
+            version = store_playbook_version(d, s)
+        states.append(new_state_record(p, dy, s, version=version))
+    try:
+        ids = d['state'].insert(states)
+        out.info("Added %s new state records" % len(ids))
+    except pymongo.errors.PyMongoError, pmex:
+        out.error(
+            "Unable to save %s new state records. "
+            "Propagating PyMongo error: %s" % (len(states), pmex))
+        raise pmex
+    return ids
+
+
 def escape_credentials(n, p):
     """Return the RFC 2396 escaped version of name `n` and password `p` in
 a 2-tuple"""
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Playbook compilation.
+
+A playbook's steps are validated and compiled into `Step` objects once
+per playbook version. The resulting tuple is cached and shared by every
+release of that version. Compiling resolves each step's worker routing
+key and serializes its static parameters up front, so dispatching a
+step is mostly string concatenation, and a malformed playbook is
+rejected before a release of it is even created.
+
+A step marked `"cacheable": true` promises that its plugin, parameters
+and dynamic inputs fully determine its result. The FSM skips running
+such a step again while a result for its `fingerprint` is cached (see
+`recore.mongo.lookup_step_result`). A step marked `"coalesce": true`
+makes the same promise, but only about steps running at the same time
+(see `recore.fsm.flights`).
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+
+
+# How many distinct playbook versions to keep compiled steps for
+STEP_CACHE_SIZE = 256
+
+_step_cache = OrderedDict()
+_step_cache_lock = threading.Lock()
+
+
+class InvalidPlaybook(ValueError):
+    """The playbook (or one of its steps) can not be run"""
+    pass
+
+
+class Step(object):
+    """One compiled step of a playbook. Treat as immutable: instances
+are shared between releases."""
+    __slots__ = ('name', 'plugin', 'parameters', 'dynamic', 'cacheable',
+                 'coalesce', 'doc', 'routing_key', 'parameters_json')
+
+    def __init__(self, doc):
+        self.name = doc.get('name')
+        self.plugin = doc.get('plugin')
+        self.parameters = doc.get('parameters', {})
+        self.dynamic = tuple(doc.get('dynamic', ()))
+        self.cacheable = doc.get('cacheable', False)
+        self.coalesce = doc.get('coalesce', False)
+        # The step exactly as the playbook had it, for the state document
+        self.doc = doc
+        self.routing_key = "worker.%s" % self.plugin
+        self.parameters_json = json.dumps(self.parameters)
+
+    def __repr__(self):
+        return "<Step %r plugin=%s>" % (self.name, self.plugin)
+
+    def body(self, project_json, dynamic_json):
+        """The worker message for this step, given the already
+        serialized project name and dynamic data"""
+        return '{"project": %s, "parameters": %s, "dynamic": %s}' % (
+            project_json, self.parameters_json, dynamic_json)
+
+    def fingerprint(self, dynamic):
+        """A content hash of everything which determines the result of
+        this step, given the `dynamic` data it is sent"""
+        return hashlib.sha1(json.dumps(
+            [self.plugin, self.parameters, dynamic], sort_keys=True,
+            separators=(',', ':'), default=str)).hexdigest()
+
+
+def validate_step(index, doc):
+    """Raise InvalidPlaybook unless `doc` is a step we can run"""
+    where = "Step %d" % index
+    if isinstance(doc, list):
+        raise InvalidPlaybook(
+            "%s: concurrent steps are not supported" % where)
+    if not isinstance(doc, dict):
+        raise InvalidPlaybook("%s: must be an object" % where)
+    if isinstance(doc.get('name'), basestring):
+        where = "Step %d (%s)" % (index, doc['name'])
+    elif 'name' in doc:
+        raise InvalidPlaybook("%s: 'name' must be a string" % where)
+
+    plugin = doc.get('plugin')
+    if not isinstance(plugin, basestring) or not plugin:
+        raise InvalidPlaybook("%s: 'plugin' is required" % where)
+    if plugin.strip() != plugin or '.' in plugin or ' ' in plugin:
+        raise InvalidPlaybook(
+            "%s: '%s' is not a valid plugin name" % (where, plugin))
+
+    if not isinstance(doc.get('parameters', {}), dict):
+        raise InvalidPlaybook("%s: 'parameters' must be an object" % where)
+    try:
+        json.dumps(doc.get('parameters', {}))
+    except (TypeError, ValueError), e:
+        raise InvalidPlaybook(
+            "%s: 'parameters' can not be serialized: %s" % (where, e))
+
+    dynamic = doc.get('dynamic', [])
+    if not isinstance(dynamic, list) or \
+            not all(isinstance(d, basestring) for d in dynamic):
+        raise InvalidPlaybook(
+            "%s: 'dynamic' must be a list of names" % where)
+
+    for flag in ('cacheable', 'coalesce'):
+        if not isinstance(doc.get(flag, False), bool):
+            raise InvalidPlaybook(
+                "%s: '%s' must be true or false" % (where, flag))
+
+
+def missing_dynamic(steps, dynamic):
+    """The names the compiled `steps` declare in their 'dynamic' lists
+which are not keys of the `dynamic` data given for a release, sorted"""
+    declared = set()
+    for step in steps:
+        declared.update(step.dynamic)
+    return sorted(declared.difference(dynamic))
+
+
+def playbook_version(steps):
+    """A content hash identifying the list of playbook `steps`"""
+    return hashlib.sha1(json.dumps(
+        steps, sort_keys=True, separators=(',', ':'),
+        default=str)).hexdigest()
+
+
+def compiled_version(version):
+    """The cached compiled steps of playbook `version`, or None"""
+    with _step_cache_lock:
+        compiled = _step_cache.pop(version, None)
+        if compiled is not None:
+            _step_cache[version] = compiled
+        return compiled
+
+
+def compile_steps(steps):
+    """Return the shared tuple of compiled `Step` objects for the list
+of step dicts `steps`, validating and compiling them only the first
+time this version is seen. Raises InvalidPlaybook."""
+    if not isinstance(steps, list):
+        raise InvalidPlaybook("'steps' must be a list")
+    version = playbook_version(steps)
+    compiled = compiled_version(version)
+    if compiled is not None:
+        return compiled
+
+    for (index, doc) in enumerate(steps):
+        validate_step(index, doc)
+    compiled = tuple(Step(doc) for doc in steps)
+
+    with _step_cache_lock:
+        # Another thread may have compiled the same version meanwhile;
+        # whoever got there first wins so the steps stay shared
+        compiled = _step_cache.pop(version, compiled)
+        _step_cache[version] = compiled
+        while len(_step_cache) > STEP_CACHE_SIZE:
+            _step_cache.popitem(last=False)
+    return compiled
+
+
+def compile_playbook(playbook):
+    """Compile the steps of a 'playbooks' collection document"""
+    return compile_steps(playbook.get('steps', []))
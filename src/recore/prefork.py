@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Prefork mode.
+
+One core process does all its decoding, encoding and logging on one
+CPU, however many FSM threads it runs. In prefork mode a supervisor
+process starts WORKERS worker processes instead. Each one is a whole
+core, with its own connection to the broker and its own MongoDB
+client, consuming from the same queue: the broker hands each job
+message to one of them. Turn it on in the config, or with --workers:
+
+    "PREFORK": {
+        "WORKERS": 4,
+        "STATS_INTERVAL": 60
+    }
+
+The supervisor does nothing but watch. A worker which exits is started
+again, at once if it had been running for a while and otherwise after
+a growing delay (see `recore.backoff`). Every STATS_INTERVAL seconds
+each worker reports how many releases it has running, queued and
+scheduled, and how many steps of each plugin it has in flight and
+holds back (see `recore.fsm.throttle`). The supervisor logs the
+totals.
+
+Workers share the database, so a release waiting in one worker can be
+cancelled through another (see `recore.job.cancel`) and no queued or
+scheduled release is started twice. Each worker gets its own
+write-ahead log, PATH with the worker's number appended. Before it
+starts any worker the supervisor writes what is left in PATH and in
+every PATH.<n> to MongoDB, so changing the number of workers loses
+nothing. The sqlite store only works with a single process.
+
+Everything else a worker knows is its own, so admission control's
+MAX_ACTIVE and the per-plugin CONCURRENCY, RATE and BURST limits (see
+`recore.fsm.throttle`) are split between the workers, each getting its
+share of the configured value. A MAX_ACTIVE or CONCURRENCY smaller
+than the number of workers, or a BURST below one per worker, can't be
+split that finely: each worker gets one, so the real limit is the
+number of workers. Workers don't lend each other their shares, so one
+may be at its limit while another has room. Coalescing (see
+`recore.fsm.flights`) only joins identical steps running in the same
+worker.
+"""
+
+import copy
+import logging
+import multiprocessing
+import os
+import Queue
+import signal
+import threading
+import time
+import pymongo.errors
+import recore.admission
+import recore.backoff
+import recore.fsm.registry
+import recore.fsm.throttle
+import recore.mongo
+import recore.schedule
+import recore.wal
+
+STATS_INTERVAL = 60.0
+# Seconds after which a worker counts as having started fine, so the
+# next time it exits it is started again without a delay
+HEALTHY_AFTER = 60.0
+
+# In a worker process, its number
+WORKER = None
+
+out = logging.getLogger('recore')
+
+
+def worker_config(config, index, workers):
+    """The config worker number `index` of `workers` runs with.
+Raises ValueError if `config` can't be shared by several processes."""
+    if config.get('DB', {}).get('BACKEND') == 'sqlite':
+        raise ValueError("The sqlite store can only be used by one "
+                         "process")
+    config = copy.deepcopy(config)
+    wal = config.get('WAL', {})
+    if wal.get('PATH'):
+        wal['PATH'] = '%s.%d' % (wal['PATH'], index)
+    admission = config.get('ADMISSION', {})
+    if admission.get('MAX_ACTIVE'):
+        admission['MAX_ACTIVE'] = share(
+            int(admission['MAX_ACTIVE']), workers, index)
+    for limits in config.get('PLUGINS', {}).itervalues():
+        for (key, value) in limits.items():
+            if not value:
+                continue
+            if key.upper() == 'CONCURRENCY':
+                limits[key] = share(int(value), workers, index)
+            elif key.upper() == 'RATE':
+                limits[key] = float(value) / workers
+            elif key.upper() == 'BURST':
+                # A bucket holding less than a token never dispatches
+                limits[key] = max(float(value) / workers, 1.0)
+    return config
+
+
+def share(limit, workers, index):
+    """Worker number `index`'s part of the integer `limit`, split
+between `workers` workers. Never less than one."""
+    part = limit // workers + (1 if index < limit % workers else 0)
+    return max(part, 1)
+
+
+def replay_logs(config):
+    """Write what the write-ahead logs of an earlier run left to
+MongoDB: the single process log and those of however many workers it
+had. Runs before the workers are started, with a MongoDB client of
+its own which is closed again before forking."""
+    conf = config.get('WAL', {})
+    path = conf.get('PATH')
+    if not path:
+        return
+    paths = [p for p in [path] + recore.wal.worker_logs(path)
+             if os.path.exists(p)]
+    if not paths:
+        return
+    db = config['DB']
+    (connection, d) = recore.mongo.connect(
+        db['SERVERS'][0],
+        db['PORT'],
+        db['NAME'],
+        db['PASSWORD'],
+        db['DATABASE'])
+    try:
+        size = int(conf.get('SIZE', 64 << 20))
+        for p in paths:
+            recore.wal.replay(d, p, size)
+    finally:
+        connection.close()
+
+
+def stats():
+    """What this process reports to the supervisor"""
+    return {
+        'pid': os.getpid(),
+        'active': recore.fsm.registry.count(),
+        'queued': recore.admission.queued(),
+        'scheduled': recore.schedule.scheduled(),
+        'plugins': dict(
+            (plugin, {'in_flight': sat['in_flight'],
+                      'waiting': sat['waiting']})
+            for (plugin, sat) in
+            recore.fsm.throttle.saturation().iteritems()),
+    }
+
+
+def merge(reports):
+    """Add up the latest `reports` (worker number: stats()) of every
+worker"""
+    total = {'workers': len(reports), 'active': 0, 'queued': 0,
+             'scheduled': 0, 'plugins': {}}
+    for report in reports.itervalues():
+        for key in ('active', 'queued', 'scheduled'):
+            total[key] += report.get(key, 0)
+        for (plugin, sat) in report.get('plugins', {}).iteritems():
+            plugin_total = total['plugins'].setdefault(
+                plugin, {'in_flight': 0, 'waiting': 0})
+            for key in ('in_flight', 'waiting'):
+                plugin_total[key] += sat.get(key, 0)
+    return total
+
+
+class Reporter(threading.Thread):
+    """Sends the supervisor this worker's stats() every `interval`
+seconds"""
+
+    def __init__(self, index, queue, interval):
+        super(Reporter, self).__init__(name='recore-stats')
+        self.daemon = True
+        self.index = index
+        self.queue = queue
+        self.interval = interval
+
+    def run(self):  # pragma: no cover
+        while True:
+            time.sleep(self.interval)
+            self.queue.put((self.index, stats()))
+
+
+def _worker(config, index, queue, interval):  # pragma: no cover
+    """Worker process number `index`: a core of its own"""
+    import recore
+    import recore.prefork
+    recore.prefork.WORKER = index
+    # The supervisor's handler was inherited
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    Reporter(index, queue, interval).start()
+    out.info("Prefork worker %s started" % index)
+    recore.run(config)
+
+
+class Supervisor(object):
+    """Keeps `workers` processes running `target`, which is called
+as target(config, index, queue, interval)"""
+
+    def __init__(self, config, workers, target=_worker,
+                 interval=STATS_INTERVAL):
+        self.config = config
+        self.workers = workers
+        self.target = target
+        self.interval = interval
+        self.queue = multiprocessing.Queue()
+        # worker number: Process
+        self.children = {}
+        # worker number: when it was started
+        self.started = {}
+        # worker number: exits in a row without running HEALTHY_AFTER
+        self.attempts = {}
+        # worker number: when to start it again
+        self.restart_at = {}
+        # worker number: its latest stats()
+        self.reports = {}
+        self.stopping = False
+
+    def spawn(self, index):
+        """Start worker number `index`"""
+        child = multiprocessing.Process(
+            target=self.target, name='recore-worker-%d' % index,
+            args=(worker_config(self.config, index, self.workers), index,
+                  self.queue, self.interval))
+        child.start()
+        self.children[index] = child
+        self.started[index] = time.time()
+        out.info("Started worker %s as pid %s" % (index, child.pid))
+        return child
+
+    def check(self, now=None):
+        """Notice workers which exited and start them again once their
+        delay is up"""
+        if now is None:
+            now = time.time()
+        for (index, child) in self.children.items():
+            if child.is_alive():
+                continue
+            if index not in self.restart_at:
+                lived = now - self.started[index]
+                if lived >= HEALTHY_AFTER:
+                    attempt = 0
+                else:
+                    attempt = self.attempts.get(index, -1) + 1
+                self.attempts[index] = attempt
+                wait = recore.backoff.delay(attempt)
+                self.restart_at[index] = now + wait
+                self.reports.pop(index, None)
+                out.error("Worker %s (pid %s) exited with %s after %.0fs. "
+                          "Starting it again in %.1fs" % (
+                              index, child.pid, child.exitcode, lived,
+                              wait))
+            elif now >= self.restart_at[index]:
+                del self.restart_at[index]
+                self.spawn(index)
+
+    def collect(self, timeout):
+        """Take in the workers' stats reports, waiting up to `timeout`
+        seconds for the first"""
+        try:
+            (index, report) = self.queue.get(True, timeout)
+            while True:
+                self.reports[index] = report
+                (index, report) = self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):  # pragma: no cover
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in xrange(self.workers):
+            self.spawn(index)
+        logged = time.time()
+        while not self.stopping:
+            self.collect(1.0)
+            self.check()
+            if time.time() - logged >= self.interval:
+                logged = time.time()
+                total = merge(self.reports)
+                out.info("%(workers)s workers: %(active)s active FSMs, "
+                         "%(queued)s queued and %(scheduled)s scheduled "
+                         "releases" % total)
+                for (plugin, sat) in sorted(total['plugins'].items()):
+                    out.info("Plugin %s: %s steps in flight, %s held "
+                             "back" % (plugin, sat['in_flight'],
+                                       sat['waiting']))
+        self.shutdown()
+
+    def shutdown(self, timeout=10.0):
+        """Stop every worker"""
+        out.info("Stopping %s workers" % len(self.children))
+        for child in self.children.itervalues():
+            if child.is_alive():
+                child.terminate()
+        for child in self.children.itervalues():
+            child.join(timeout)
+
+
+def supervise(config, workers):  # pragma: no cover
+    """Run the core as `workers` processes until told to stop"""
+    conf = config.get('PREFORK', {})
+    notify = logging.getLogger('recore.stdout')
+    try:
+        worker_config(config, 0, workers)
+    except ValueError, ve:
+        out.fatal("Can not run %s workers: %s" % (workers, ve))
+        notify.fatal("Can not run %s workers: %s" % (workers, ve))
+        raise SystemExit(1)
+    try:
+        replay_logs(config)
+    except (KeyError, IOError, ValueError, pymongo.errors.PyMongoError), ex:
+        out.fatal("Unable to replay the write-ahead logs: %s" % ex)
+        notify.fatal("Unable to replay the write-ahead logs: %s" % ex)
+        raise SystemExit(1)
+    notify.info("Starting %s worker processes" % workers)
+    Supervisor(config, workers,
+               interval=float(conf.get('STATS_INTERVAL',
+                                       STATS_INTERVAL))).run()
+    raise SystemExit(0)
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Scheduled releases.
+
+A job.create may say when the release should start:
+
+    {"project": "$NAME", "start_at": "2014-06-01T02:00:00Z"}
+
+`start_at` is an ISO 8601 UTC time or seconds since the epoch. A
+release due in the future is answered with its id right away, as
+usual. Its state document gets a 'scheduled' status and its
+'start_at', and it is started (through admission control) once it is
+due. Until then job.status reports it 'scheduled' and job.cancel
+cancels it.
+
+Pending releases are kept in a hashed timer wheel of SLOTS slots, each
+TICK seconds wide. Scheduling or cancelling a release is a dict
+operation, and each tick only looks at the releases in one slot, so
+thousands of pending releases cost next to nothing. Releases further
+out than one turn of the wheel wait in their slot for as many turns as
+it takes. When the core starts, the releases still scheduled are
+loaded with one query on the (indexed) status. A release is claimed in
+the database before it is started, so when several cores load the
+same schedule only one of them runs each release.
+
+    "SCHEDULE": {
+        "TICK": 1.0,
+        "SLOTS": 3600
+    }
+"""
+
+import calendar
+import datetime
+import logging
+import math
+import threading
+import time
+import pymongo.errors
+import recore.admission
+import recore.mongo
+
+SCHEDULED = 'scheduled'
+
+TICK = 1.0
+SLOTS = 3600
+# Seconds before a release which could not be started is tried again
+RETRY_AFTER = 5.0
+
+wheel = None
+scheduler = None
+_lock = threading.Lock()
+# Ids claimed in the database (marked running) which could neither be
+# started nor given back, so the next try skips the claim
+_claimed = set()
+
+out = logging.getLogger('recore')
+
+
+class TimerWheel(object):
+    """Ids waiting for their due time. Not thread safe."""
+
+    def __init__(self, slots=SLOTS, tick=TICK, now=None):
+        if now is None:
+            now = time.time()
+        self.tick = tick
+        self.slots = [{} for _ in xrange(slots)]
+        # The last tick whose slot has been handled
+        self.current = int(now // tick)
+        # id: the tick it's due at
+        self.due = {}
+
+    def __len__(self):
+        return len(self.due)
+
+    def __contains__(self, id):
+        return id in self.due
+
+    def add(self, id, when):
+        """Have `id` come out of advance() once it's `when` (seconds
+        since the epoch). Overdue ids come out on the next tick."""
+        self.remove(id)
+        tick = max(int(math.ceil(when / self.tick)), self.current + 1)
+        self.slots[tick % len(self.slots)][id] = tick
+        self.due[id] = tick
+
+    def remove(self, id):
+        """Forget `id`. Returns False if it wasn't waiting."""
+        tick = self.due.pop(id, None)
+        if tick is None:
+            return False
+        del self.slots[tick % len(self.slots)][id]
+        return True
+
+    def advance(self, now):
+        """Move the wheel on to `now`. Returns the ids which are due,
+        earliest first."""
+        target = int(now // self.tick)
+        if target - self.current > len(self.slots):
+            # Asleep for over a turn: every slot is due for a look
+            self.current = target - len(self.slots)
+        found = []
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            for (id, tick) in slot.items():
+                if tick <= self.current:
+                    del slot[id]
+                    del self.due[id]
+                    found.append((tick, id))
+        return [id for (_, id) in sorted(found)]
+
+
+def parse_start_at(value):
+    """The naive UTC datetime a job.create's `start_at` stands for.
+Raises ValueError."""
+    if isinstance(value, bool):
+        raise ValueError("Bad start_at: %s" % value)
+    if isinstance(value, (int, long, float)):
+        return datetime.datetime.utcfromtimestamp(value)
+    if not isinstance(value, basestring):
+        raise ValueError("Bad start_at: %s" % value)
+    text = value.strip()
+    if text.endswith('Z'):
+        text = text[:-1]
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f',
+                   '%Y-%m-%dT%H:%M'):
+        try:
+            return datetime.datetime.strptime(text, format)
+        except ValueError:
+            pass
+    raise ValueError("Bad start_at (want ISO 8601 UTC): %s" % value)
+
+
+def _epoch(when):
+    return calendar.timegm(when.utctimetuple()) + when.microsecond / 1e6
+
+
+def is_future(start_at):
+    """Whether the UTC datetime `start_at` is still to come"""
+    return start_at is not None and start_at > datetime.datetime.utcnow()
+
+
+def init_schedule(conf):
+    """Configure the scheduler from the SCHEDULE config section, load
+the releases still scheduled in the database and start ticking"""
+    import recore.schedule
+    recore.schedule.TICK = float(conf.get('TICK', TICK))
+    recore.schedule.SLOTS = int(conf.get('SLOTS', SLOTS))
+    recore.schedule.wheel = TimerWheel(recore.schedule.SLOTS,
+                                       recore.schedule.TICK)
+    pending = recore.mongo.lookup_scheduled(recore.mongo.database)
+    with _lock:
+        for (id, start_at) in pending:
+            wheel.add(id, _epoch(start_at))
+    out.info("Scheduler: %s scheduled releases to resume" % len(pending))
+    recore.schedule.scheduler = Scheduler()
+    recore.schedule.scheduler.start()
+
+
+def add(id, start_at):
+    """Start release `id` at the UTC datetime `start_at`. Its state
+document must already say it's scheduled."""
+    with _lock:
+        wheel.add(id, _epoch(start_at))
+    out.info("Release %s is scheduled to start at %sZ" % (
+        id, start_at.isoformat()))
+
+
+def is_scheduled(id):
+    """Whether release `id` is waiting for its time here"""
+    if wheel is None:
+        return False
+    with _lock:
+        return id in wheel
+
+
+def unschedule(id):
+    """Stop the scheduled release `id` from ever being started.
+Returns False if it was not scheduled here."""
+    if wheel is None:
+        return False
+    with _lock:
+        return wheel.remove(id)
+
+
+def scheduled():
+    """How many releases are waiting for their time"""
+    if wheel is None:
+        return 0
+    return len(wheel)
+
+
+def run_due(now=None):
+    """Start the releases which are due by `now`. Returns their ids."""
+    with _lock:
+        due = wheel.advance(time.time() if now is None else now)
+    started = []
+    for id in due:
+        try:
+            if id not in _claimed and not recore.mongo.change_status(
+                    recore.mongo.database, id, SCHEDULED,
+                    recore.admission.RUNNING):
+                out.info("Scheduled release %s was taken elsewhere" % id)
+                continue
+            out.info("Scheduled release %s is due" % id)
+            _claimed.add(id)
+            recore.admission.start(id)
+        except pymongo.errors.PyMongoError, e:
+            out.error("Unable to start scheduled release %s, retrying "
+                      "in %ss: %s" % (id, RETRY_AFTER, e))
+            _give_back(id)
+            with _lock:
+                wheel.add(id, time.time() + RETRY_AFTER)
+            continue
+        _claimed.discard(id)
+        started.append(id)
+    return started
+
+
+def _give_back(id):
+    """Mark the claimed release `id` scheduled again, if we can, so
+it can still be cancelled or taken by another core"""
+    if id not in _claimed:
+        return
+    try:
+        if recore.mongo.change_status(recore.mongo.database, id,
+                                      recore.admission.RUNNING, SCHEDULED):
+            _claimed.discard(id)
+    except pymongo.errors.PyMongoError, e:
+        out.warn("Unable to mark release %s scheduled again: %s" % (id, e))
+
+
+class Scheduler(threading.Thread):
+    """Turns the wheel every TICK seconds"""
+
+    def __init__(self):
+        super(Scheduler, self).__init__(name='recore-schedule')
+        self.daemon = True
+
+    def run(self):  # pragma: no cover
+        while True:
+            time.sleep(TICK)
+            try:
+                run_due()
+            except Exception, e:
+                out.error("Scheduler tick failed: %s" % e)
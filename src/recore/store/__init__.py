@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Where the core keeps its documents.
+
+Everything the core stores goes through the functions in
+`recore.mongo` (lookup_project, initialize_state, lookup_state, ...)
+and a handful of modules which update documents directly. They all
+work on a database `d` where `d[name]` is a collection of documents
+with this subset of the pymongo 2 Collection interface:
+
+    find(spec, fields=None)
+    find_one(spec_or_id, fields=None)
+    insert(doc_or_docs, continue_on_error=False)
+    update(spec, document, upsert=False, multi=False)
+    remove(spec_or_id)
+    ensure_index(key_or_list, unique=False, sparse=False,
+                 expireAfterSeconds=None)
+
+with queries of equality and $gt, $gte, $lt, $lte, $ne, $in and
+$exists, and the $set, $unset, $inc, $push, $pop and $addToSet update
+operators. Errors are the pymongo.errors ones: ConnectionFailure when
+the store can't be reached, DuplicateKeyError for a unique index
+violation and OperationFailure for anything else.
+
+A store is picked by the BACKEND of the DB config section:
+
+    "mongo" (the default) is a MongoDB server, configured with
+    SERVERS, PORT, NAME, PASSWORD and DATABASE.
+
+    "sqlite" keeps everything in the SQLite database file at PATH,
+    in the core's own process (see `recore.store.sqlite`). Handy for
+    small installs, it does away with the round trip of every state
+    update. Only one core may use the file. SYNCHRONOUS is the SQLite
+    synchronous pragma: NORMAL (the default) may lose the last
+    updates if the machine crashes, FULL doesn't.
+
+    "DB": {
+        "BACKEND": "sqlite",
+        "PATH": "/var/lib/recore/recore.db"
+    }
+"""
+
+import logging
+
+out = logging.getLogger('recore')
+
+
+def init_store(db):
+    """Open the store described by the DB config section. Raises
+ValueError for an unknown BACKEND."""
+    import recore.mongo
+    import recore.store.sqlite
+    backend = db.get('BACKEND', 'mongo')
+    if backend == 'mongo':
+        return recore.mongo.init_mongo(db)
+    if backend != 'sqlite':
+        raise ValueError("Unknown DB BACKEND: %s" % backend)
+    recore.mongo.database = recore.store.sqlite.Database(
+        db['PATH'], synchronous=db.get('SYNCHRONOUS', 'NORMAL'))
+    recore.mongo.configure(db)
+    recore.mongo.ensure_indexes(recore.mongo.database)
+    out.info("Storing documents in SQLite database %s" % db['PATH'])
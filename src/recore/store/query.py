@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Evaluating the subset of MongoDB queries, updates and projections the
+core uses (see `recore.store`) on documents in memory, for stores
+which aren't MongoDB. Anything else raises OperationFailure, as
+MongoDB would for a query or update it can't run.
+"""
+
+import pymongo.errors
+
+
+def get(doc, dotted):
+    """The value at the `dotted` path of `doc`, and whether it's there"""
+    for part in dotted.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return None, False
+        doc = doc[part]
+    return doc, True
+
+
+def _pick(value, parts, into):
+    """Copy the `parts` path of `value` into `into`, the way a mongo
+projection does: through embedded documents and arrays of them"""
+    if isinstance(value, list):
+        if not isinstance(into, list):
+            into = [{} for v in value if isinstance(v, dict)]
+        docs = [v for v in value if isinstance(v, dict)]
+        for (v, i) in zip(docs, into):
+            _pick(v, parts, i)
+        return into
+    if parts[0] in value:
+        if len(parts) == 1:
+            into[parts[0]] = value[parts[0]]
+        elif isinstance(value[parts[0]], (dict, list)):
+            into[parts[0]] = _pick(value[parts[0]], parts[1:],
+                                   into.get(parts[0], {}))
+    return into
+
+
+def project(doc, fields):
+    """Just the `fields` (a list of dotted paths, or a dict of them to
+true) of `doc`, and its _id"""
+    if not fields:
+        return doc
+    if isinstance(fields, dict):
+        fields = [k for (k, v) in fields.iteritems() if v]
+    keep = {}
+    for k in fields:
+        _pick(doc, k.split('.'), keep)
+    keep['_id'] = doc['_id']
+    return keep
+
+
+def matches(doc, spec):
+    """Does `doc` satisfy the query `spec`?"""
+    for (key, cond) in spec.iteritems():
+        (value, present) = get(doc, key)
+        if isinstance(cond, dict) and cond and \
+                all(k.startswith('$') for k in cond):
+            for (op, arg) in cond.iteritems():
+                if op == '$exists':
+                    if present != bool(arg):
+                        return False
+                elif op == '$in':
+                    if value not in arg:
+                        return False
+                elif op == '$ne':
+                    if value == arg:
+                        return False
+                elif op == '$lt':
+                    if not present or not value < arg:
+                        return False
+                elif op == '$lte':
+                    if not present or not value <= arg:
+                        return False
+                elif op == '$gt':
+                    if not present or not value > arg:
+                        return False
+                elif op == '$gte':
+                    if not present or not value >= arg:
+                        return False
+                else:
+                    raise pymongo.errors.OperationFailure(
+                        "Unsupported query operator %s" % op)
+        elif value != cond:
+            return False
+    return True
+
+
+def apply_update(doc, update):
+    """Apply the `update` document to `doc`"""
+    if not any(k.startswith('$') for k in update):
+        replacement = dict(update)
+        replacement['_id'] = doc['_id']
+        doc.clear()
+        doc.update(replacement)
+        return
+    for (op, fields) in update.iteritems():
+        for (key, value) in fields.iteritems():
+            if op == '$set':
+                doc[key] = value
+            elif op == '$unset':
+                doc.pop(key, None)
+            elif op == '$inc':
+                doc[key] = doc.get(key, 0) + value
+            elif op == '$push':
+                doc.setdefault(key, []).append(value)
+            elif op == '$addToSet':
+                if value not in doc.setdefault(key, []):
+                    doc[key].append(value)
+            elif op == '$pop':
+                if doc.get(key):
+                    doc[key].pop(0 if value < 0 else -1)
+            else:
+                raise pymongo.errors.OperationFailure(
+                    "Unsupported update operator %s" % op)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An embedded document store in an SQLite database file.
+
+Each collection is a table of BSON encoded documents keyed by their
+_id. Every field of an index gets a column of its own holding the
+field's value, when that is a string, number, ObjectId or date, and
+SQLite indexes those columns. Lookups by _id or by equality (or $in)
+on an indexed field read just the rows which can match; the query is
+then evaluated by `recore.store.query`. Unique indexes are SQLite
+unique indexes, and a TTL index removes expired documents at most
+every TTL_INTERVAL seconds, as MongoDB does.
+
+All threads share the one connection, and each operation is a
+transaction of its own.
+"""
+
+import calendar
+import contextlib
+import datetime
+import sqlite3
+import threading
+import time
+import bson
+import pymongo.errors
+from bson.objectid import ObjectId
+from recore.store.query import apply_update, get, matches, project
+
+# Seconds between removals of expired documents
+TTL_INTERVAL = 60
+SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL')
+
+
+def _key(value):
+    """How the _id `value` is kept"""
+    return sqlite3.Binary(bson.BSON.encode({'_id': value}))
+
+
+def _column(value):
+    """How `value` is kept in an index column, None if it can't be"""
+    if isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, basestring):
+        return u's' + unicode(value)
+    if isinstance(value, ObjectId):
+        return u'o' + unicode(value)
+    if isinstance(value, datetime.datetime):
+        return (calendar.timegm(value.utctimetuple()) +
+                value.microsecond / 1e6)
+    return None
+
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class Database(object):
+    """The collections in the SQLite database file at `path`"""
+
+    def __init__(self, path, synchronous='NORMAL'):
+        if synchronous.upper() not in SYNCHRONOUS:
+            raise ValueError("SYNCHRONOUS must be one of %s" % (
+                ', '.join(SYNCHRONOUS)))
+        self.path = path
+        self.lock = threading.RLock()
+        self.collections = {}
+        try:
+            self.connection = sqlite3.connect(
+                path, check_same_thread=False, isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'PRAGMA synchronous=%s' % synchronous.upper())
+        except sqlite3.Error, e:
+            raise pymongo.errors.ConnectionFailure(
+                "Can not open %s: %s" % (path, e))
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = Collection(self, name)
+            return self.collections[name]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the block in a transaction, as a pymongo error if it
+        fails"""
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                yield self.connection
+                self.connection.execute('COMMIT')
+            except sqlite3.IntegrityError, e:
+                self.connection.execute('ROLLBACK')
+                raise pymongo.errors.DuplicateKeyError(str(e))
+            except sqlite3.Error, e:
+                self.connection.execute('ROLLBACK')
+                raise pymongo.errors.OperationFailure(str(e))
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class Collection(object):
+    """Documents in the table `name`, see the module docstring"""
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.table = _quote(name)
+        # Indexed field: its column
+        self.columns = {}
+        # (field, seconds) of the TTL index, if there is one
+        self.ttl = None
+        self._expired = 0
+        with database.transaction() as c:
+            c.execute('CREATE TABLE IF NOT EXISTS %s '
+                      '(_id BLOB PRIMARY KEY, doc BLOB NOT NULL)' %
+                      self.table)
+            for row in c.execute('PRAGMA table_info(%s)' % self.table):
+                if row[1].startswith('f_'):
+                    self.columns[row[1][2:]] = _quote(row[1])
+
+    def _candidates(self, c, spec):
+        """The rows which might match `spec`: found by _id or an
+        indexed field if possible, otherwise all of them"""
+        for (field, cond) in (spec or {}).iteritems():
+            if field == '_id' and not isinstance(cond, dict):
+                return c.execute('SELECT _id, doc FROM %s WHERE _id = ?' %
+                                 self.table, (_key(cond),))
+            if field not in self.columns:
+                continue
+            if isinstance(cond, dict) and cond.keys() == ['$in']:
+                values = [_column(v) for v in cond['$in']]
+                if values and None not in values:
+                    return c.execute(
+                        'SELECT _id, doc FROM %s WHERE %s IN (%s)' % (
+                            self.table, self.columns[field],
+                            ', '.join('?' * len(values))), values)
+            elif _column(cond) is not None:
+                return c.execute('SELECT _id, doc FROM %s WHERE %s = ?' % (
+                    self.table, self.columns[field]), (_column(cond),))
+        return c.execute('SELECT _id, doc FROM %s' % self.table)
+
+    def _found(self, c, spec):
+        """(key, document) of the documents matching `spec`"""
+        for (key, data) in self._candidates(c, spec).fetchall():
+            doc = bson.BSON(str(data)).decode()
+            if matches(doc, spec or {}):
+                yield (key, doc)
+
+    def _values(self, doc):
+        """The document's row, minus the _id, as (columns, values)"""
+        columns = ['doc']
+        values = [sqlite3.Binary(bson.BSON.encode(doc))]
+        for (field, column) in self.columns.iteritems():
+            columns.append(column)
+            values.append(_column(get(doc, field)[0]))
+        return (columns, values)
+
+    def _insert(self, c, doc):
+        doc.setdefault('_id', ObjectId())
+        (columns, values) = self._values(doc)
+        c.execute('INSERT INTO %s (_id, %s) VALUES (?, %s)' % (
+            self.table, ', '.join(columns), ', '.join('?' * len(values))),
+            [_key(doc['_id'])] + values)
+        return doc['_id']
+
+    def _expire(self, c):
+        if self.ttl is None or time.time() - self._expired < TTL_INTERVAL:
+            return
+        (field, seconds) = self.ttl
+        c.execute('DELETE FROM %s WHERE %s < ?' % (
+            self.table, self.columns[field]), (time.time() - seconds,))
+        self._expired = time.time()
+
+    def find(self, spec=None, fields=None, **kwargs):
+        with self.database.transaction() as c:
+            return [project(doc, fields) for (_, doc) in self._found(c, spec)]
+
+    def find_one(self, spec_or_id=None, fields=None, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        with self.database.transaction() as c:
+            for (_, doc) in self._found(c, spec_or_id):
+                return project(doc, fields)
+        return None
+
+    def insert(self, doc_or_docs, continue_on_error=False, **kwargs):
+        docs = doc_or_docs
+        if isinstance(doc_or_docs, dict):
+            docs = [doc_or_docs]
+        ids = []
+        duplicate = None
+        with self.database.transaction() as c:
+            for doc in docs:
+                try:
+                    ids.append(self._insert(c, doc))
+                except sqlite3.IntegrityError, e:
+                    if not continue_on_error:
+                        raise
+                    duplicate = e
+        if duplicate is not None:
+            raise pymongo.errors.DuplicateKeyError(str(duplicate))
+        if isinstance(doc_or_docs, dict):
+            return ids[0]
+        return ids
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        n = 0
+        with self.database.transaction() as c:
+            self._expire(c)
+            for (key, doc) in list(self._found(c, spec)):
+                apply_update(doc, document)
+                (columns, values) = self._values(doc)
+                c.execute('UPDATE %s SET %s WHERE _id = ?' % (
+                    self.table, ', '.join('%s = ?' % k for k in columns)),
+                    values + [key])
+                n += 1
+                if not multi:
+                    break
+            if n == 0 and upsert:
+                doc = dict((k, v) for (k, v) in spec.items()
+                           if not isinstance(v, dict))
+                apply_update(doc, document)
+                self._insert(c, doc)
+        return {'n': n, 'updatedExisting': n > 0, 'ok': 1.0, 'err': None}
+
+    def remove(self, spec_or_id=None, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        with self.database.transaction() as c:
+            for (key, _) in list(self._found(c, spec_or_id)):
+                c.execute('DELETE FROM %s WHERE _id = ?' % self.table,
+                          (key,))
+
+    def ensure_index(self, key_or_list, unique=False, sparse=False,
+                     expireAfterSeconds=None, **kwargs):
+        if isinstance(key_or_list, basestring):
+            fields = [key_or_list]
+        else:
+            fields = [k for (k, _) in key_or_list]
+        with self.database.transaction() as c:
+            added = [f for f in fields if f not in self.columns]
+            for field in added:
+                self.columns[field] = _quote('f_' + field)
+                c.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                    self.table, self.columns[field]))
+            if added:
+                # Fill in the new columns
+                for (key, doc) in list(self._found(c, None)):
+                    (columns, values) = self._values(doc)
+                    c.execute('UPDATE %s SET %s WHERE _id = ?' % (
+                        self.table, ', '.join('%s = ?' % k for k in columns)),
+                        values + [key])
+            c.execute('CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)' % (
+                'UNIQUE ' if unique else '',
+                _quote('%s_%s' % (self.name, '_'.join(fields))),
+                self.table, ', '.join(self.columns[f] for f in fields)))
+        if expireAfterSeconds is not None:
+            self.ttl = (fields[0], expireAfterSeconds)
+
+    create_index = ensure_index
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+How the core exchanges messages with clients and workers.
+
+The FSMs, the event publisher and the job handlers all use a blocking
+connection, from `connect()`, and channels with this subset of pika's
+BlockingConnection and BlockingChannel API:
+
+    connection.channel(), connection.close(), connection.is_open
+    channel.exchange_declare(exchange, exchange_type, durable)
+    channel.queue_declare(queue, passive, durable, exclusive,
+                          auto_delete, arguments)
+    channel.queue_bind(queue, exchange, routing_key)
+    channel.queue_delete(queue)
+    channel.basic_publish(exchange, routing_key, body, properties,
+                          mandatory)
+    channel.basic_ack(delivery_tag), channel.basic_reject(delivery_tag,
+                                                          requeue)
+    channel.basic_qos(prefetch_count), channel.confirm_delivery()
+    channel.consume(queue) -> (method, properties, body), ...
+    channel.cancel(), channel.close()
+
+and losing the transport raises pika.exceptions.AMQPConnectionError
+(or socket.error). The TRANSPORT of the MQ config section picks what
+is behind it:
+
+    "amqp" (the default) is a RabbitMQ server at SERVER, logged into
+    as NAME with PASSWORD.
+
+    "local" is the in-process broker of `recore.transport.local`.
+    Only threads of the core's own process can reach it, so it is for
+    running a core and simulated workers together (see hacking/).
+"""
+
+import pika
+
+AMQP = 'amqp'
+LOCAL = 'local'
+TRANSPORTS = (AMQP, LOCAL)
+
+TRANSPORT = AMQP
+
+
+def init_transport(mq):
+    """Pick the transport named by the MQ config section. Raises
+ValueError for an unknown one."""
+    import recore.transport
+    import recore.transport.local
+    transport = mq.get('TRANSPORT', AMQP)
+    if transport not in TRANSPORTS:
+        raise ValueError("Unknown MQ TRANSPORT: %s" % transport)
+    recore.transport.TRANSPORT = transport
+    if transport == LOCAL and recore.transport.local.broker is None:
+        recore.transport.local.broker = recore.transport.local.Broker()
+
+
+def connect():
+    """A new blocking connection over the configured transport"""
+    import recore.amqp
+    import recore.transport.local
+    if TRANSPORT == LOCAL:
+        return recore.transport.local.broker.connection()
+    mq = recore.amqp.MQ_CONF
+    creds = pika.credentials.PlainCredentials(mq['NAME'], mq['PASSWORD'])
+    return pika.BlockingConnection(pika.ConnectionParameters(
+        host=str(mq['SERVER']),
+        credentials=creds))
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An in-process message broker.
+
+Queues, topic exchanges and the default exchange, kept in memory and
+shared by every thread of the process, behind the same connection
+and channel API as pika's BlockingConnection (see `recore.transport`).
+Good for running a core together with its workers in one process, for
+integration runs and capacity experiments, but nothing outside the
+process can reach it and nothing in it survives a restart.
+
+Differences from RabbitMQ worth knowing: exchanges need no declaring
+and any name is a topic exchange; queue arguments such as x-expires,
+durability and prefetch limits are ignored; publishing returns
+whether any queue took the message, confirms or not. Unacked messages
+are given back when their connection closes.
+"""
+
+import itertools
+import Queue
+import re
+import threading
+import pika.exceptions
+import pika.spec
+
+# The broker everything in this process shares
+broker = None
+
+
+class Method(object):
+    """Looks enough like a pika Basic.Deliver frame"""
+    def __init__(self, exchange, routing_key, delivery_tag):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.delivery_tag = delivery_tag
+
+
+class DeclareOk(object):
+    """Looks enough like the result of a pika queue_declare()"""
+    def __init__(self, queue, message_count, consumer_count):
+        self.method = self
+        self.queue = queue
+        self.message_count = message_count
+        self.consumer_count = consumer_count
+
+
+def topic_to_regex(pattern):
+    """Translate an AMQP topic binding `pattern` into a compiled regex"""
+    words = []
+    for word in pattern.split('.'):
+        if word == '*':
+            words.append(r'[^.]+')
+        elif word == '#':
+            words.append(r'.*')
+        else:
+            words.append(re.escape(word))
+    return re.compile(r'^%s$' % r'\.'.join(words))
+
+
+def _requeue(q, items):
+    """Put `items` back at the front of Queue.Queue `q`, in order, the
+way RabbitMQ returns unacked messages to where they were"""
+    with q.mutex:
+        q.queue.extendleft(reversed(items))
+        q.not_empty.notify_all()
+
+
+class Broker(object):
+    """Queues, topic bindings and the default exchange, all in memory"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.consumers = {}
+        self.bindings = []
+        self._tags = itertools.count(1)
+        self._names = itertools.count(1)
+        self.published = 0
+        self.bytes_published = 0
+
+    def connection(self):
+        return Connection(self)
+
+    def queue(self, name):
+        """Return the Queue.Queue for `name`, creating it if needed"""
+        with self.lock:
+            if name not in self.queues:
+                self.queues[name] = Queue.Queue()
+                self.consumers[name] = 0
+            return self.queues[name]
+
+    def declare(self, name='', passive=False):
+        if passive:
+            with self.lock:
+                if name not in self.queues:
+                    raise pika.exceptions.ChannelClosed(
+                        404, "NOT_FOUND - no queue '%s'" % name)
+        if not name:
+            name = 'amq.gen-%d' % next(self._names)
+        q = self.queue(name)
+        return DeclareOk(name, q.qsize(), self.consumers[name])
+
+    def delete(self, name):
+        with self.lock:
+            self.queues.pop(name, None)
+            self.consumers.pop(name, None)
+            self.bindings = [b for b in self.bindings if b[2] != name]
+
+    def bind(self, exchange, queue, routing_key):
+        self.queue(queue)
+        with self.lock:
+            # Binding twice is the same as binding once
+            for (e, _, q, key) in self.bindings:
+                if (e, q, key) == (exchange, queue, routing_key):
+                    return
+            self.bindings.append(
+                (exchange, topic_to_regex(routing_key), queue, routing_key))
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """Route a message. Returns True if at least one queue got it."""
+        properties = properties or pika.spec.BasicProperties()
+        with self.lock:
+            if exchange == '':
+                targets = [routing_key] if routing_key in self.queues else []
+            else:
+                targets = [q for (e, rx, q, _) in self.bindings
+                           if e == exchange and rx.match(routing_key)]
+            queues = [self.queues[t] for t in targets]
+            self.published += 1
+            self.bytes_published += len(body)
+        for q in queues:
+            method = Method(exchange, routing_key, next(self._tags))
+            q.put((method, properties, body))
+        return bool(queues)
+
+    def add_consumer(self, queue, count=1):
+        if count > 0:
+            self.queue(queue)
+        with self.lock:
+            if queue in self.consumers:
+                self.consumers[queue] += count
+
+
+class Connection(object):
+    """Looks enough like a pika BlockingConnection"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self._open = True
+        self._channels = []
+
+    @property
+    def is_open(self):
+        return self._open
+
+    def channel(self):
+        if not self.is_open:
+            raise pika.exceptions.ConnectionClosed()
+        channel = Channel(self)
+        self._channels.append(channel)
+        return channel
+
+    def close(self):
+        self._open = False
+        for channel in self._channels:
+            channel.requeue()
+
+
+class _Consumer(object):
+    __slots__ = ('queue', 'cancelled')
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.cancelled = False
+
+
+class Channel(object):
+    """Looks enough like a pika BlockingChannel"""
+
+    #: How long consume() waits on an empty queue before re-checking
+    #: for cancellation or a closed connection
+    POLL = 0.05
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self._consumers = []
+        # delivery tag: (queue, message) consumed but not acked yet
+        self._unacked = {}
+
+    def _check(self):
+        if not self.connection.is_open:
+            self.requeue()
+            raise pika.exceptions.ConnectionClosed()
+
+    def requeue(self):
+        """Give back the messages we never acked"""
+        with self.broker.lock:
+            unacked = sorted(self._unacked.iteritems())
+            self._unacked.clear()
+        by_queue = {}
+        for (_, (q, item)) in unacked:
+            by_queue.setdefault(q, []).append(item)
+        for (q, items) in by_queue.iteritems():
+            _requeue(q, items)
+
+    def exchange_declare(self, exchange=None, exchange_type='direct',
+                         durable=False, **kwargs):
+        self._check()
+
+    def queue_declare(self, queue='', passive=False, durable=False,
+                      exclusive=False, auto_delete=False, **kwargs):
+        self._check()
+        return self.broker.declare(queue, passive=passive)
+
+    def queue_bind(self, queue, exchange, routing_key=None, **kwargs):
+        self._check()
+        self.broker.bind(exchange, queue, routing_key)
+
+    def queue_delete(self, queue='', **kwargs):
+        self._check()
+        self.broker.delete(queue)
+
+    def basic_publish(self, exchange, routing_key, body,
+                      properties=None, mandatory=False, immediate=False):
+        self._check()
+        return self.broker.publish(exchange, routing_key, body, properties)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._check()
+        self._unacked.pop(delivery_tag, None)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self._check()
+        unacked = self._unacked.pop(delivery_tag, None)
+        if requeue and unacked is not None:
+            (q, item) = unacked
+            _requeue(q, [item])
+
+    def confirm_delivery(self, nowait=False):
+        pass
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, **kwargs):
+        pass
+
+    def consume(self, queue, no_ack=False, exclusive=False):
+        consumer = _Consumer(queue)
+        self._consumers.append(consumer)
+        self.broker.add_consumer(queue)
+        q = self.broker.queue(queue)
+        try:
+            while True:
+                self._check()
+                if consumer.cancelled:
+                    return
+                try:
+                    item = q.get(timeout=self.POLL)
+                except Queue.Empty:
+                    continue
+                if not no_ack:
+                    self._unacked[item[0].delivery_tag] = (q, item)
+                yield item
+        finally:
+            self.broker.add_consumer(queue, -1)
+            if not self.connection.is_open:
+                self.requeue()
+
+    def cancel(self):
+        for consumer in self._consumers:
+            consumer.cancelled = True
+        self._consumers = []
+
+    def close(self):
+        self.cancel()
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local write-ahead log for release state.
+
+Normally every state update an FSM makes is a MongoDB round trip
+before it dispatches the next step, and if MongoDB is away for longer
+than the FSM is willing to keep updates in memory the release fails.
+With a write-ahead log the update (or in journal mode the journal
+entry) is instead appended to a memory-mapped file, which is as fast
+as copying it into memory, and the FSM carries on. A flusher thread
+writes what is in the log to MongoDB in batches of up to BATCH_SIZE
+records, merging successive $set updates of a document into one, and
+keeps trying through outages. When the core starts it first writes
+whatever an earlier run left in the log, and in the logs of any
+prefork workers (PATH.0, PATH.1, ...; see `recore.prefork`) an
+earlier run had. Give the log a path to use it:
+
+    "WAL": {
+        "PATH": "/var/lib/recore/state.wal",
+        "SIZE": 67108864,
+        "BATCH_SIZE": 500,
+        "SYNC": false
+    }
+
+The log is SIZE bytes and is reused from the start whenever MongoDB
+has everything in it. If it fills up during a long outage appending
+waits for the flusher to make room. Records written to the map
+survive the core crashing but not the machine; with SYNC each append
+is also synced to disk, which costs about as much as the MongoDB
+write it replaces.
+
+MongoDB lags the log by up to a batch, so "in MongoDB" in the rest of
+the core (release events, for one) means "in the log" with it on.
+
+A record MongoDB refuses to take, rather than being unavailable for
+(a state document grown over 16MB, say), is logged and set aside in
+PATH.rejected, as BSON, so the records after it still get written.
+"""
+
+import collections
+import glob
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+import bson
+import pymongo.errors
+import recore.admission
+import recore.backoff
+
+ENABLED = False
+BATCH_SIZE = 500
+# Seconds the flusher waits for records when the log is empty
+FLUSH_INTERVAL = 0.05
+
+MAGIC = 'RECOREW1'
+# Magic, offset of the first record MongoDB doesn't have yet
+HEADER = struct.Struct('!8sQ')
+# Length and CRC32 of the BSON body which follows. A zero length ends
+# the log.
+RECORD = struct.Struct('!II')
+
+# What losing MongoDB looks like
+MONGO_ERRORS = (pymongo.errors.ConnectionFailure,)
+
+log = None
+flusher = None
+
+out = logging.getLogger('recore')
+
+
+class WriteAheadLog(object):
+    """An append-only log of BSON records in a memory-mapped file of
+`size` bytes. Records are numbered by the byte count appended before
+them ever (their LSN) so they can be waited for across reuses of the
+file."""
+
+    def __init__(self, path, size):
+        self.path = path
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if os.path.getsize(path) < size:
+            self.file.truncate(size)
+        self.size = os.path.getsize(path)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.sync = False
+        self.cond = threading.Condition()
+        (magic, head) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            if exists:
+                raise ValueError("%s is not a write-ahead log" % path)
+            head = HEADER.size
+            self._write_header(head)
+            self._terminate(head)
+        self.head = head
+        self.tail = self._scan(head)
+        # LSNs: how far we have appended, and how far MongoDB has it
+        self.flushed = 0
+        self.appended = self.tail - self.head
+
+    def _write_header(self, head):
+        HEADER.pack_into(self.map, 0, MAGIC, head)
+
+    def _terminate(self, offset):
+        if offset + RECORD.size <= self.size:
+            RECORD.pack_into(self.map, offset, 0, 0)
+
+    def _read(self, offset):
+        """The body of the record at `offset` and where the next one
+        starts, or None at the end of the log"""
+        if offset + RECORD.size > self.size:
+            return None
+        (length, crc) = RECORD.unpack_from(self.map, offset)
+        start = offset + RECORD.size
+        if length == 0 or start + length > self.size:
+            return None
+        body = self.map[start:start + length]
+        if zlib.crc32(body) & 0xffffffff != crc:
+            # Torn by a crash while it was written, so never flushed
+            return None
+        return (body, start + length)
+
+    def _scan(self, offset):
+        """Where the log ends, reading from `offset`"""
+        while True:
+            found = self._read(offset)
+            if found is None:
+                return offset
+            offset = found[1]
+
+    def append(self, record):
+        """Add `record` (a dict) to the log. Waits for room if the log
+        is full. Returns the LSN just past it."""
+        body = bson.BSON.encode(record)
+        needed = RECORD.size + len(body)
+        if HEADER.size + needed + RECORD.size > self.size:
+            raise ValueError("Record of %s bytes is too big for the log" %
+                             len(body))
+        with self.cond:
+            if self.tail + needed + RECORD.size > self.size:
+                out.warn("Write-ahead log full, waiting for MongoDB")
+                while self.head != self.tail:
+                    self.cond.wait()
+            start = self.tail
+            end = start + needed
+            # Terminate first so the new record is never followed by
+            # a stale one from before the log was last reused
+            self._terminate(end)
+            self.map[start + RECORD.size:end] = body
+            RECORD.pack_into(self.map, start, len(body),
+                             zlib.crc32(body) & 0xffffffff)
+            if self.sync:
+                self._sync(start, end + RECORD.size)
+            self.tail = end
+            self.appended += needed
+            self.cond.notify_all()
+            return self.appended
+
+    def _sync(self, start, end):
+        page = start - start % mmap.PAGESIZE
+        self.map.flush(page, min(end, self.size) - page)
+
+    def pending(self, limit, timeout=None):
+        """Up to `limit` records MongoDB doesn't have yet, as a list of
+        (record, offset after it). Waits up to `timeout` seconds for
+        one if there are none."""
+        with self.cond:
+            if self.head == self.tail and timeout:
+                self.cond.wait(timeout)
+            records = []
+            offset = self.head
+            while offset < self.tail and len(records) < limit:
+                (body, offset) = self._read(offset)
+                records.append((bson.BSON(body).decode(), offset))
+            return records
+
+    def advance(self, offset):
+        """MongoDB has everything before `offset`. Starts the log over
+        once it has everything."""
+        with self.cond:
+            self.flushed += offset - self.head
+            if offset == self.tail:
+                offset = self.tail = HEADER.size
+                self._terminate(offset)
+            self.head = offset
+            self._write_header(offset)
+            self.cond.notify_all()
+
+    def wait(self, lsn, timeout=None):
+        """Wait until MongoDB has everything up to `lsn`. Returns
+        whether it does."""
+        give_up = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.flushed < lsn:
+                remaining = None
+                if give_up is not None:
+                    remaining = give_up - time.time()
+                    if remaining <= 0:
+                        return False
+                self.cond.wait(remaining)
+            return True
+
+    def set_aside(self, record):
+        """Keep `record`, which MongoDB refused, in PATH.rejected"""
+        with open(self.path + '.rejected', 'ab') as rejected:
+            rejected.write(bson.BSON.encode(record))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def init_wal(conf, d):
+    """Configure the write-ahead log from the WAL config section. If
+it's enabled, write what an earlier run left in it to MongoDB `d` and
+start flushing to it."""
+    import recore.wal
+    path = conf.get('PATH')
+    recore.wal.ENABLED = bool(path)
+    recore.wal.BATCH_SIZE = int(conf.get('BATCH_SIZE', BATCH_SIZE))
+    if not path:
+        return
+    size = int(conf.get('SIZE', 64 << 20))
+    for worker_log in worker_logs(path):
+        replay(d, worker_log, size)
+    recore.wal.log = WriteAheadLog(path, size)
+    recore.wal.log.sync = bool(conf.get('SYNC', False))
+    _replay(d, recore.wal.log)
+    recore.wal.flusher = Flusher(d, recore.wal.log)
+    recore.wal.flusher.start()
+    out.info("Logging state updates to %s" % path)
+
+
+def worker_logs(path):
+    """The logs of prefork workers using `path`, which there are
+whatever number of workers the run that left them had"""
+    return sorted(
+        (p for p in glob.glob(path + '.*') if p[len(path) + 1:].isdigit()),
+        key=lambda p: int(p[len(path) + 1:]))
+
+
+def replay(d, path, size):
+    """Write what is left in the log at `path` to MongoDB `d`"""
+    log = WriteAheadLog(path, size)
+    try:
+        _replay(d, log)
+    finally:
+        log.close()
+
+
+def _replay(d, log):
+    if log.tail > log.head:
+        out.info("Replaying %s bytes of write-ahead log %s" % (
+            log.tail - log.head, log.path))
+        recore.backoff.retry(lambda: drain(d, log), MONGO_ERRORS,
+                             "replaying the write-ahead log")
+
+
+def update(collection, spec, document):
+    """Log an update of the `collection` document matching `spec`.
+Returns its LSN."""
+    return log.append({'c': collection, 'q': spec, 'u': document})
+
+
+def insert(collection, doc):
+    """Log inserting `doc` into `collection`. Inserting a document
+that is already there is ignored. Returns its LSN."""
+    return log.append({'c': collection, 'i': doc})
+
+
+def wait(lsn, timeout=None):
+    """Wait for MongoDB to have everything up to `lsn`. True if it
+does, or if the log is off."""
+    if not ENABLED:
+        return True
+    return log.wait(lsn, timeout)
+
+
+def _merge(last, document):
+    """`document` folded into the update `last` before it, or None if
+they can't be merged"""
+    if last.keys() == ['$set'] and document.keys() == ['$set']:
+        merged = dict(last['$set'])
+        merged.update(document['$set'])
+        return {'$set': merged}
+    return None
+
+
+def _idempotent(document):
+    # Records may be written twice if we stop between writing them
+    # and advancing the log. A $push of a step record would then be
+    # repeated; $addToSet isn't.
+    if '$push' in document:
+        document = dict(document)
+        document['$addToSet'] = document.pop('$push')
+    return document
+
+
+def write(d, records):
+    """Write `records` to MongoDB `d`. Updates of a document are made
+in order, with successive $set updates merged; inserts are batched
+per collection."""
+    updates = collections.OrderedDict()
+    inserts = collections.OrderedDict()
+    for record in records:
+        if 'i' in record:
+            inserts.setdefault(record['c'], []).append(record['i'])
+            continue
+        key = (record['c'], bson.BSON.encode(record['q']))
+        pending = updates.setdefault(key, (record['q'], []))[1]
+        merged = pending and _merge(pending[-1], record['u'])
+        if merged:
+            pending[-1] = merged
+        else:
+            pending.append(record['u'])
+    for (collection, docs) in inserts.iteritems():
+        try:
+            d[collection].insert(docs, continue_on_error=True)
+        except pymongo.errors.DuplicateKeyError:
+            for doc in docs:
+                try:
+                    d[collection].insert(doc)
+                except pymongo.errors.DuplicateKeyError:
+                    pass
+    for ((collection, _), (spec, documents)) in updates.iteritems():
+        for document in documents:
+            d[collection].update(spec, _idempotent(document))
+
+
+def drain(d, wal):
+    """Write everything in `wal` to MongoDB `d`, a batch at a time"""
+    while True:
+        records = wal.pending(BATCH_SIZE)
+        if not records:
+            return
+        started = time.time()
+        write_batch(d, wal, records)
+        observe_latency(started, records)
+
+
+def write_batch(d, wal, records):
+    """Write `records`, pending in `wal`, to MongoDB `d` and advance
+the log past them. If MongoDB refuses the batch they are written one
+at a time, and any record it refuses is set aside. Raises
+MONGO_ERRORS if MongoDB is unavailable."""
+    try:
+        write(d, [r for (r, _) in records])
+    except MONGO_ERRORS:
+        raise
+    except pymongo.errors.PyMongoError, e:
+        out.error("MongoDB refused a batch of %s write-ahead log "
+                  "records. Writing them one at a time: %s" % (
+                      len(records), e))
+        for (record, offset) in records:
+            try:
+                write(d, [record])
+            except MONGO_ERRORS:
+                raise
+            except pymongo.errors.PyMongoError, e:
+                out.error("MongoDB refused %s. Setting it aside in "
+                          "%s.rejected: %s" % (
+                              _describe(record), wal.path, e))
+                wal.set_aside(record)
+            wal.advance(offset)
+    else:
+        wal.advance(records[-1][1])
+
+
+def _describe(record):
+    if 'i' in record:
+        return "insert into %s of %s" % (
+            record['c'], record['i'].get('_id'))
+    return "update of %s %s" % (record['c'], record['q'])
+
+
+def observe_latency(started, records):
+    """Feed admission control how long writing `records`, started at
+`started`, took. It compares that with how long one state update may
+take, so a batch counts as its time per record."""
+    recore.admission.observe_db_latency(
+        (time.time() - started) / len(records))
+
+
+class Flusher(threading.Thread):
+    """Writes the log to MongoDB as records come, retrying through
+outages for as long as it takes"""
+
+    def __init__(self, d, wal):
+        super(Flusher, self).__init__(name='recore-wal')
+        self.daemon = True
+        self.d = d
+        self.wal = wal
+
+    def run(self):  # pragma: no cover
+        while True:
+            try:
+                self.flush()
+            except Exception, e:
+                # Dying would leave every FSM waiting for room in the
+                # log forever
+                out.error("Write-ahead log flush failed, retrying in "
+                          "%ss: %s" % (recore.backoff.CAP, e))
+                time.sleep(recore.backoff.CAP)
+
+    def flush(self):
+        """Write one batch, if there is one, backing off for as long
+        as MongoDB is away"""
+        records = self.wal.pending(BATCH_SIZE, FLUSH_INTERVAL)
+        if not records:
+            return
+        attempt = 0
+        while True:
+            started = time.time()
+            try:
+                write_batch(self.d, self.wal, records)
+                break
+            except MONGO_ERRORS, e:
+                wait = recore.backoff.delay(attempt)
+                out.warn("MongoDB unavailable, %s records wait in the "
+                         "write-ahead log. Retrying in %.1fs: %s" % (
+                             len(records), wait, e))
+                time.sleep(wait)
+                attempt += 1
+                # Any written one at a time are behind us
+                records = self.wal.pending(BATCH_SIZE)
+        observe_latency(started, records)
@@ -0,0 +1,116 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from . import TestCase, unittest
+import mock
+
+from recore import admission
+from recore.fsm import registry
+
+
+class TestAdmission(TestCase):
+
+    def setUp(self):
+        self.fsm = mock.patch('recore.fsm.FSM').start()
+        self.fsm.side_effect = lambda id: mock.Mock(state_id=id)
+        self.mongo = mock.patch('recore.admission.recore.mongo').start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        registry._live.clear()
+        admission._queued.clear()
+        admission.MAX_ACTIVE = 0
+        admission.MAX_DB_LATENCY = 0
+        admission.db_latency = 0.0
+
+    def test_start_with_capacity(self):
+        """Releases start right away while there is capacity"""
+        admission.MAX_ACTIVE = 2
+        self.assertTrue(admission.start('a'))
+        self.assertTrue(admission.start('b'))
+        self.assertEqual(registry.count(), 2)
+        self.assertEqual(self.mongo.set_status.call_count, 0)
+
+    def test_start_queues_over_high_water(self):
+        """Past MAX_ACTIVE releases are queued, then started in order
+        as FSMs finish"""
+        admission.MAX_ACTIVE = 1
+        self.assertTrue(admission.start('a'))
+        self.assertFalse(admission.start('b'))
+        self.assertFalse(admission.start('c'))
+        self.assertEqual(admission.queued(), 2)
+        self.mongo.set_status.assert_called_with(
+            self.mongo.database, 'c', admission.QUEUED)
+
+        registry.remove('a')
+        admission.drain()
+        self.assertEqual(registry.state_ids(), ['b'])
+        self.mongo.change_status.assert_called_with(
+            self.mongo.database, 'b', admission.QUEUED, admission.RUNNING)
+        self.assertEqual(admission.queued(), 1)
+
+        # MongoDB is away: 'c' keeps its place for the next time
+        import pymongo.errors
+        self.mongo.change_status.side_effect = (
+            pymongo.errors.AutoReconnect('failover'))
+        registry.remove('b')
+        admission.drain()
+        self.assertEqual(registry.state_ids(), [])
+        self.assertEqual(admission.position('c'), 0)
+        self.mongo.change_status.side_effect = None
+
+        # 'c' was taken by another process meanwhile
+        self.mongo.change_status.return_value = False
+        admission.drain()
+        self.assertEqual(registry.state_ids(), [])
+        self.assertEqual(admission.queued(), 0)
+
+    def test_unqueue(self):
+        """A queued release can be taken out of the queue"""
+        admission.MAX_ACTIVE = 1
+        admission.start('a')
+        admission.start('b')
+        self.assertEqual(admission.position('b'), 0)
+        self.assertEqual(admission.position('a'), None)
+        self.assertTrue(admission.unqueue('b'))
+        self.assertFalse(admission.unqueue('b'))
+        self.assertEqual(admission.queued(), 0)
+
+        registry.remove('a')
+        admission.drain()
+        self.assertEqual(registry.state_ids(), [])
+
+    def test_db_latency(self):
+        """Slow MongoDB updates hold new releases back, unless nothing
+        is running"""
+        admission.MAX_DB_LATENCY = 0.5
+        for _ in range(20):
+            admission.observe_db_latency(2.0)
+        self.assertTrue(admission.db_latency > 0.5)
+        self.assertTrue(admission.start('a'))
+        self.assertFalse(admission.start('b'))
+
+        for _ in range(20):
+            admission.observe_db_latency(0.01)
+        admission.drain()
+        self.assertEqual(admission.queued(), 0)
+
+    def test_init_admission(self):
+        """Configuration is read and queued releases are resumed"""
+        self.mongo.lookup_queued.return_value = ['a', 'b']
+        admission.init_admission({'MAX_ACTIVE': '1'})
+        self.assertEqual(admission.MAX_ACTIVE, 1)
+        self.assertEqual(registry.state_ids(), ['a'])
+        self.assertEqual(admission.queued(), 1)
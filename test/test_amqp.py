@@ -13,6 +13,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bson
+import datetime
 import mock
 import json
 import pika
@@ -75,6 +77,60 @@ class TestAMQP(TestCase):
             amqp.on_open(connection)
             connection.channel.assert_called_once_with(amqp.on_channel_open)
 
+    def test_on_close(self):
+        """
+        Make sure a closed connection stops its IO loop
+        """
+        with mock.patch('pika.connection') as connection:
+            amqp.on_open(connection)
+            connection.add_on_close_callback.assert_called_once_with(
+                amqp.on_close)
+            amqp.on_close(connection, 320, 'CONNECTION_FORCED')
+            connection.ioloop.stop.assert_called_once_with()
+
+    @mock.patch('recore.amqp.time.sleep')
+    def test_run_forever(self, sleep):
+        """
+        Verify the consumer reconnects until it's stopped
+        """
+        def outage():
+            yield pika.exceptions.AMQPConnectionError('refused')
+            yield pika.exceptions.AMQPConnectionError('refused')
+
+            def stop():
+                amqp.stopping = True
+            conn = mock.Mock()
+            conn.ioloop.start.side_effect = stop
+            yield conn
+        try:
+            with mock.patch('recore.amqp.init_amqp',
+                            side_effect=outage()) as init:
+                amqp.run_forever(MQ)
+            self.assertEqual(init.call_count, 3)
+            self.assertEqual(sleep.call_count, 2)
+        finally:
+            amqp.stopping = False
+
+    @mock.patch('recore.amqp.time.sleep')
+    def test_run_forever_gives_up(self, sleep):
+        """
+        Verify the consumer gives up after the deadline, and at once on
+        authentication errors
+        """
+        now = [0.0]
+        sleep.side_effect = lambda s: now.__setitem__(0, now[0] + s)
+        with mock.patch('recore.amqp.time.time', lambda: now[0]):
+            with mock.patch(
+                    'recore.amqp.init_amqp',
+                    side_effect=pika.exceptions.AMQPConnectionError):
+                self.assertRaises(pika.exceptions.AMQPConnectionError,
+                                  amqp.run_forever, MQ)
+        with mock.patch(
+                'recore.amqp.init_amqp',
+                side_effect=pika.exceptions.ProbableAuthenticationError):
+            self.assertRaises(pika.exceptions.ProbableAuthenticationError,
+                              amqp.run_forever, MQ)
+
     def test_on_channel_open(self):
         """
         Make sure that on_channel_open chains properly
@@ -96,6 +152,22 @@ class TestAMQP(TestCase):
 
             assert result == consumer_tag
 
+    def test_consume_local(self):
+        """Over the local transport the core sets up its own queue and
+        feeds what arrives in it to receive"""
+        channel = mock.MagicMock()
+        channel.consume.return_value = [('method', 'properties', 'body')]
+        with mock.patch('recore.amqp.recore.transport') as transport:
+            transport.connect.return_value.channel.return_value = channel
+            with mock.patch('recore.amqp.receive') as receive:
+                amqp.consume_local(MQ)
+                receive.assert_called_once_with(
+                    channel, 'method', 'properties', 'body')
+        channel.queue_bind.assert_called_once_with(
+            queue=MQ['QUEUE'], exchange=MQ['EXCHANGE'], routing_key='job.#')
+        channel.consume.assert_called_once_with(MQ['QUEUE'])
+        self.assertTrue(amqp.consuming)
+
     def test_job_create(self):
         """
         Verify when topic job.create is received the FSM handles it properly
@@ -118,11 +190,149 @@ class TestAMQP(TestCase):
 
                     # Verify the items which should have triggered
                     amqp.recore.job.create.release.assert_called_once_with(
-                        channel, project, REPLY_TO, {})
+                        channel, project, REPLY_TO, {}, None, None)
                     # Verify a new thread of the FSM is started for
                     # this one specific release
                     amqp.recore.fsm.FSM.call_count == 1
 
+    def test_job_create_with_idempotency_key(self):
+        """
+        Verify the idempotency key of a job.create is passed along and
+        no FSM is started when no new release was created
+        """
+        body = '{"project": "p", "dynamic": {}, "idempotency_key": "k"}'
+
+        method = mock.MagicMock(routing_key='job.create')
+        with mock.patch('recore.job.create') as amqp.recore.job.create:
+            amqp.recore.job.create.release.return_value = None
+            with mock.patch('recore.fsm') as amqp.recore.fsm:
+                amqp.receive(channel, method, PROPERTIES, body)
+
+                amqp.recore.job.create.release.assert_called_once_with(
+                    channel, 'p', REPLY_TO, {}, 'k', None)
+                assert amqp.recore.fsm.FSM.call_count == 0
+
+    def test_job_create_scheduled(self):
+        """
+        Verify a job.create with a future start_at is scheduled rather
+        than started, and a bad start_at creates nothing
+        """
+        body = '{"project": "p", "dynamic": {}, "start_at": "2999-01-01T02:00:00Z"}'
+        method = mock.MagicMock(routing_key='job.create')
+        with mock.patch('recore.job.create') as amqp.recore.job.create:
+            amqp.recore.job.create.release.return_value = 'abc'
+            with mock.patch('recore.amqp.recore.admission') as admission:
+                with mock.patch('recore.amqp.recore.schedule.add') as add:
+                    amqp.receive(channel, method, PROPERTIES, body)
+                    start_at = datetime.datetime(2999, 1, 1, 2, 0, 0)
+                    amqp.recore.job.create.release.assert_called_once_with(
+                        channel, 'p', REPLY_TO, {}, None, start_at)
+                    add.assert_called_once_with('abc', start_at)
+                    self.assertFalse(admission.start.called)
+
+                    amqp.recore.job.create.release.reset_mock()
+                    amqp.receive(channel, method, PROPERTIES,
+                                 '{"project": "p", "start_at": "soon"}')
+                    self.assertFalse(amqp.recore.job.create.release.called)
+
+    def test_job_create_mongo_down(self):
+        """
+        Verify losing MongoDB while creating a job doesn't take the
+        consumer down
+        """
+        import pymongo.errors
+        body = '{"project": "p", "dynamic": {}}'
+        method = mock.MagicMock(routing_key='job.create')
+        with mock.patch('recore.job.create') as amqp.recore.job.create:
+            amqp.recore.job.create.release.side_effect = (
+                pymongo.errors.AutoReconnect('failover'))
+            with mock.patch('recore.fsm') as amqp.recore.fsm:
+                amqp.receive(channel, method, PROPERTIES, body)
+                assert amqp.recore.fsm.FSM.call_count == 0
+
+            # Or while queueing the release it created
+            amqp.recore.job.create.release.side_effect = None
+            amqp.recore.job.create.release.return_value = 'abc'
+            with mock.patch('recore.amqp.recore.admission') as admission:
+                admission.start.side_effect = (
+                    pymongo.errors.AutoReconnect('failover'))
+                amqp.receive(channel, method, PROPERTIES, body)
+                admission.start.assert_called_once_with('abc')
+
+    def test_job_cancel(self):
+        """
+        Verify job.cancel is handed to recore.job.cancel
+        """
+        body = '{"id": "abc123"}'
+        method = mock.MagicMock(routing_key='job.cancel')
+        with mock.patch('recore.job.cancel') as amqp.recore.job.cancel:
+            amqp.receive(channel, method, PROPERTIES, body)
+            amqp.recore.job.cancel.cancel.assert_called_once_with(
+                channel, 'abc123', REPLY_TO)
+
+    def test_job_status(self):
+        """
+        Verify job.status is handed to recore.job.status
+        """
+        body = '{"id": "abc123"}'
+        method = mock.MagicMock(routing_key='job.status')
+        with mock.patch('recore.job.status') as amqp.recore.job.status:
+            amqp.receive(channel, method, PROPERTIES, body)
+            amqp.recore.job.status.status.assert_called_once_with(
+                channel, 'abc123', REPLY_TO, PROPERTIES.correlation_id)
+
+    def test_job_create_batch(self):
+        """
+        Verify a batched job.create starts an FSM for every release
+        which was created
+        """
+        body = '{"releases": [{"project": "a"}, {"project": "b"}]}'
+
+        method = mock.MagicMock(routing_key='job.create')
+        with mock.patch('recore.job.create') as amqp.recore.job.create:
+            amqp.recore.job.create.release_batch.return_value = [
+                '111', None]
+            with mock.patch('recore.fsm') as amqp.recore.fsm:
+                amqp.receive(channel, method, PROPERTIES, body)
+
+                amqp.recore.job.create.release_batch.assert_called_once_with(
+                    channel, [{"project": "a"}, {"project": "b"}], REPLY_TO)
+                assert amqp.recore.job.create.release.call_count == 0
+                amqp.recore.fsm.FSM.assert_called_once_with('111')
+
+    def test_job_create_batch_bad(self):
+        """
+        Verify a batched job.create which can not be created, or whose
+        releases can not be started, doesn't take the consumer down
+        """
+        import pymongo.errors
+        method = mock.MagicMock(routing_key='job.create')
+        with mock.patch('recore.job.create') as amqp.recore.job.create:
+            with mock.patch('recore.amqp.recore.admission') as admission:
+                # Not a list of releases
+                amqp.receive(channel, method, PROPERTIES, '{"releases": 5}')
+                self.assertFalse(
+                    amqp.recore.job.create.release_batch.called)
+
+                # MongoDB down while creating them
+                amqp.recore.job.create.release_batch.side_effect = (
+                    pymongo.errors.AutoReconnect('failover'))
+                amqp.receive(channel, method, PROPERTIES,
+                             '{"releases": [{"project": "a"}]}')
+                self.assertFalse(admission.start.called)
+
+                # MongoDB down while queueing them
+                amqp.recore.job.create.release_batch.side_effect = None
+                amqp.recore.job.create.release_batch.return_value = [
+                    '111', '222']
+                admission.start.side_effect = (
+                    pymongo.errors.AutoReconnect('failover'))
+                amqp.receive(channel, method, PROPERTIES,
+                             '{"releases": [{"project": "a"}, '
+                             '{"project": "b"}]}')
+                self.assertEqual(admission.start.call_args_list, [
+                    mock.call('111'), mock.call('222')])
+
     def test_job_create_failure(self):
         """
         Verify when topic job.create is received with bad data it's
@@ -189,3 +399,23 @@ class TestAMQP(TestCase):
                     assert amqp.recore.fsm.FSM.call_count == 0
                     amqp.reject.assert_called_once_with(
                         channel, method, False)
+
+    def test_job_create_bson(self):
+        """
+        Verify job.create messages are decoded by their content type
+        """
+        project = 'testproject'
+        body = bson.BSON.encode({"project": project, "dynamic": {}})
+        props = pika.spec.BasicProperties(
+            correlation_id=CORR_ID,
+            reply_to=REPLY_TO,
+            content_type='application/bson')
+        release_id = 12345
+
+        method = mock.MagicMock(routing_key='job.create')
+        with mock.patch('recore.job.create') as amqp.recore.job.create:
+            amqp.recore.job.create.release.return_value = release_id
+            with mock.patch('recore.fsm') as amqp.recore.fsm:
+                amqp.receive(channel, method, props, body)
+                amqp.recore.job.create.release.assert_called_once_with(
+                    channel, project, REPLY_TO, {}, None, None)
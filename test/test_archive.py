@@ -0,0 +1,145 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import mock
+import os
+import shutil
+import tempfile
+import pymongo.errors
+from bson import BSON
+from bson.objectid import ObjectId
+
+from . import TestCase, unittest
+
+from recore import archive
+from recore.store.sqlite import Database
+
+NOW = datetime.datetime(2014, 6, 1, 12, 0, 0)
+STEPS = [{'name': 'one', 'plugin': 'shexec',
+          'parameters': {'command': 'ls ' * 100}},
+         {'name': 'two', 'plugin': 'juicer', 'parameters': {}}]
+
+
+def finished(days_ago, **fields):
+    doc = {
+        '_id': ObjectId(),
+        'project': 'example',
+        'created': NOW - datetime.timedelta(days=days_ago, hours=1),
+        'ended': NOW - datetime.timedelta(days=days_ago),
+        'dynamic': {'cart': 'c'},
+        'completed_steps': STEPS,
+        'active_step': None,
+        'remaining_steps': [],
+    }
+    doc.update(fields)
+    return doc
+
+
+class TestArchive(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.d = Database(os.path.join(self.dir, 'recore.db'))
+        archive.ensure_indexes(self.d, ttl_days=365)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_archived_document(self):
+        """Archived releases keep a summary, and their trimmed step
+        data compressed"""
+        doc = finished(40, failed=True, active_step=STEPS[1],
+                       completed_steps=STEPS[:1])
+        archived = archive.archived_document(doc)
+        self.assertEqual(archived['_id'], doc['_id'])
+        self.assertTrue(archived['failed'])
+        self.assertEqual((archived['completed'], archived['total']), (1, 2))
+        self.assertNotIn('completed_steps', archived)
+        data = archive.unpack(archived)
+        self.assertEqual(data['completed_steps'],
+                         [{'name': 'one', 'plugin': 'shexec'}])
+        self.assertEqual(data['active_step'],
+                         {'name': 'two', 'plugin': 'juicer'})
+        self.assertEqual(data['dynamic'], {'cart': 'c'})
+        self.assertLess(len(archived['data']), len(BSON.encode(doc)) / 2)
+
+        versioned = finished(40, playbook_version='v1', completed=2,
+                             active=None, total=2)
+        for key in ('completed_steps', 'active_step', 'remaining_steps'):
+            del versioned[key]
+        archived = archive.archived_document(versioned)
+        self.assertEqual(archived['playbook_version'], 'v1')
+        self.assertEqual((archived['completed'], archived['total']), (2, 2))
+
+    def test_archive(self):
+        """Only releases which ended long enough ago are moved, along
+        with their journal entries, a batch at a time"""
+        old = [finished(40) for _ in range(5)]
+        recent = finished(2)
+        running = finished(50)
+        del running['ended']
+        for doc in old + [recent, running]:
+            self.d['state'].insert(doc)
+            self.d['journal'].insert({'release': doc['_id'], 'seq': 1})
+
+        before = NOW - datetime.timedelta(days=30)
+        with mock.patch('recore.archive.BATCH_SIZE', 2):
+            self.assertEqual(archive.archive_batch(self.d, before), 2)
+            self.assertEqual(archive.archive(self.d, before), 3)
+        self.assertEqual(archive.archive(self.d, before), 0)
+
+        left = set(s['_id'] for s in self.d['state'].find({}))
+        self.assertEqual(left, set([recent['_id'], running['_id']]))
+        archived = self.d[archive.COLLECTION].find({})
+        self.assertEqual(sorted(a['_id'] for a in archived),
+                         sorted(doc['_id'] for doc in old))
+        self.assertEqual(len(self.d['journal'].find({})), 2)
+
+    def test_archive_again(self):
+        """A batch which was cut short after archiving is finished by
+        the next one"""
+        doc = finished(40)
+        self.d['state'].insert(doc)
+        self.d[archive.COLLECTION].insert(archive.archived_document(doc))
+        self.assertEqual(archive.archive(self.d, NOW), 1)
+        self.assertEqual(self.d['state'].find({}), [])
+        self.assertEqual(len(self.d[archive.COLLECTION].find({})), 1)
+
+    def test_sweep(self):
+        """Sweeps archive what is old enough and survive errors"""
+        archiver = archive.Archiver(mock.MagicMock())
+        with mock.patch('recore.archive.AFTER_DAYS', 30):
+            with mock.patch('recore.archive.archive',
+                            return_value=3) as run:
+                self.assertEqual(archiver.sweep(), 3)
+                before = run.call_args[0][1]
+                self.assertLess(before, datetime.datetime.now() -
+                                datetime.timedelta(days=29))
+                run.side_effect = pymongo.errors.AutoReconnect('gone')
+                self.assertIsNone(archiver.sweep())
+
+    def test_init_archive(self):
+        """Archiving only starts when AFTER_DAYS is given"""
+        with mock.patch('recore.archive.Archiver') as archiver:
+            archive.init_archive({}, self.d)
+            self.assertFalse(archiver.called)
+            self.assertIsNone(archive.AFTER_DAYS)
+            archive.init_archive({'AFTER_DAYS': 7, 'BATCH_SIZE': 10},
+                                 self.d)
+            archiver.assert_called_once_with(self.d)
+            self.assertTrue(archiver.return_value.start.called)
+        self.assertEqual((archive.AFTER_DAYS, archive.BATCH_SIZE), (7, 10))
+        archive.init_archive({}, self.d)
@@ -0,0 +1,61 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import mock
+
+from . import TestCase, unittest
+
+from recore import backoff
+
+
+class TestBackoff(TestCase):
+
+    def tearDown(self):
+        backoff.init_backoff({})
+
+    def test_delay(self):
+        """Delays grow exponentially up to the cap, with jitter"""
+        backoff.init_backoff({'BASE': 1, 'CAP': 8})
+        with mock.patch('recore.backoff.random.uniform',
+                        side_effect=lambda lo, hi: hi):
+            self.assertEqual(
+                [backoff.delay(a) for a in range(6)], [1, 2, 4, 8, 8, 8])
+        for _ in range(100):
+            self.assertTrue(0 <= backoff.delay(2) <= 4)
+
+    @mock.patch('recore.backoff.time.sleep')
+    def test_retry(self, sleep):
+        """Calls are retried until they work"""
+        fn = mock.Mock(side_effect=[IOError('down'), IOError('down'), 'ok'])
+        self.assertEqual(backoff.retry(fn, IOError, 'testing'), 'ok')
+        self.assertEqual(fn.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+        # Other errors are not retried
+        fn = mock.Mock(side_effect=ValueError)
+        self.assertRaises(ValueError, backoff.retry, fn, IOError, 'testing')
+        self.assertEqual(fn.call_count, 1)
+
+    @mock.patch('recore.backoff.time.sleep')
+    def test_retry_gives_up(self, sleep):
+        """Retrying stops at the deadline"""
+        now = [0.0]
+        sleep.side_effect = lambda s: now.__setitem__(0, now[0] + s)
+        with mock.patch('recore.backoff.time.time', lambda: now[0]):
+            fn = mock.Mock(side_effect=IOError('down'))
+            self.assertRaises(IOError, backoff.retry, fn, IOError,
+                              'testing', deadline=30)
+        self.assertTrue(now[0] <= 30)
+        self.assertTrue(fn.call_count > 1)
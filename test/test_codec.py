@@ -0,0 +1,119 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bson
+import gzip
+import json
+import zlib
+import pika
+import StringIO
+
+from . import TestCase, unittest
+
+from recore import codec
+
+
+MSG = {'project': 'example', 'dynamic': {'cart': 'c' * 100}}
+
+
+class TestCodec(TestCase):
+
+    def tearDown(self):
+        """
+        Put the default encoding back.
+        """
+        codec.configure(codec.JSON, 0)
+
+    def test_decode_defaults_to_json(self):
+        """
+        Messages without a content type are JSON
+        """
+        assert codec.decode(json.dumps(MSG)) == MSG
+        assert codec.decode(
+            json.dumps(MSG), pika.spec.BasicProperties()) == MSG
+
+    def test_decode_by_content_type(self):
+        """
+        The content_type property picks the decoder
+        """
+        props = pika.spec.BasicProperties(content_type=codec.BSON)
+        assert codec.decode(bson.BSON.encode(MSG), props) == MSG
+
+        # Parameters don't matter, and anything unknown is JSON
+        for content_type in ('application/json; charset=utf-8',
+                             'text/plain', 'text/x-what'):
+            props = pika.spec.BasicProperties(content_type=content_type)
+            assert codec.decode(json.dumps(MSG), props) == MSG
+        props = pika.spec.BasicProperties(
+            content_type='Application/BSON; x=y')
+        assert codec.decode(bson.BSON.encode(MSG), props) == MSG
+
+    def test_decode_bad_bodies(self):
+        """
+        Undecodable bodies raise ValueError whatever the codec
+        """
+        self.assertRaises(ValueError, codec.decode, '{"not": json')
+        props = pika.spec.BasicProperties(content_type=codec.BSON)
+        self.assertRaises(ValueError, codec.decode, 'not bson', props)
+        props = pika.spec.BasicProperties(content_encoding=codec.DEFLATE)
+        self.assertRaises(ValueError, codec.decode, 'not zlib', props)
+        props = pika.spec.BasicProperties(content_encoding='br')
+        self.assertRaises(ValueError, codec.decode, json.dumps(MSG), props)
+
+    def test_decode_compressed(self):
+        """
+        The content_encoding property says how to decompress
+        """
+        props = pika.spec.BasicProperties(content_encoding=codec.DEFLATE)
+        assert codec.decode(zlib.compress(json.dumps(MSG)), props) == MSG
+
+        buf = StringIO.StringIO()
+        gz = gzip.GzipFile(fileobj=buf, mode='wb')
+        gz.write(json.dumps(MSG))
+        gz.close()
+        props = pika.spec.BasicProperties(content_encoding=codec.GZIP)
+        assert codec.decode(buf.getvalue(), props) == MSG
+
+    def test_encode_default(self):
+        """
+        By default we send plain, uncompressed JSON
+        """
+        (body, props) = codec.encode(MSG, correlation_id='123')
+        assert json.loads(body) == MSG
+        assert props.content_type == codec.JSON
+        assert props.content_encoding is None
+        assert props.correlation_id == '123'
+
+    def test_encode_configured(self):
+        """
+        Outgoing content type and compression follow the config
+        """
+        codec.configure(codec.BSON, 50)
+        (body, props) = codec.encode(MSG)
+        assert props.content_type == codec.BSON
+        assert props.content_encoding == codec.DEFLATE
+        assert codec.decode(body, props) == MSG
+
+        # Small messages are not worth compressing
+        (body, props) = codec.encode({'id': '1'})
+        assert props.content_encoding is None
+        assert codec.decode(body, props) == {'id': '1'}
+
+    def test_configure_unsupported(self):
+        """
+        Configuring an unknown content type fails loudly
+        """
+        self.assertRaises(ValueError, codec.configure, 'text/x-what')
+        assert codec.CONTENT_TYPE == codec.JSON
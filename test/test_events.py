@@ -0,0 +1,97 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import mock
+import socket
+
+from . import TestCase, unittest
+
+from recore import events
+
+
+class TestEvents(TestCase):
+
+    def setUp(self):
+        self.mq = mock.patch('recore.events.recore.amqp.MQ_CONF',
+                             {'EXCHANGE': 're'}).start()
+        events.ENABLED = True
+
+    def tearDown(self):
+        mock.patch.stopall()
+        events.ENABLED = False
+        events.BATCH_SIZE = 100
+        events.BACKLOG = 10000
+        events.dropped = 0
+        while not events._queue.empty():
+            events._queue.get_nowait()
+
+    def test_routing_key(self):
+        """Events are routed by project, release and event"""
+        self.assertEqual(
+            events.routing_key('my.project', 'abc123', 'step.started'),
+            'release.my_project.abc123.step.started')
+
+    def test_emit(self):
+        """Events are queued for the publisher, unless disabled or the
+        backlog is full"""
+        events.emit('abc123', 'p', 'step.completed', step='build')
+        (key, body) = events._queue.get_nowait()
+        self.assertEqual(key, 'release.p.abc123.step.completed')
+        self.assertEqual(body['step'], 'build')
+        self.assertEqual(body['event'], 'step.completed')
+        self.assertTrue('at' in body)
+
+        events.ENABLED = False
+        events.emit('abc123', 'p', 'step.started')
+        self.assertTrue(events._queue.empty())
+
+        events.ENABLED = True
+        events.BACKLOG = 1
+        events.emit('abc123', 'p', 'step.started')
+        events.emit('abc123', 'p', 'step.completed')
+        self.assertEqual(events._queue.qsize(), 1)
+        self.assertEqual(events.dropped, 1)
+
+    def test_take(self):
+        """Batches hold up to BATCH_SIZE events"""
+        events.BATCH_SIZE = 2
+        for event in ('a', 'b', 'c'):
+            events.emit('abc123', 'p', event)
+        self.assertEqual([b['event'] for (_, b) in events.take()],
+                         ['a', 'b'])
+        self.assertEqual([b['event'] for (_, b) in events.take()], ['c'])
+
+    @mock.patch('recore.backoff.time.sleep')
+    def test_send_reconnects(self, sleep):
+        """A batch is sent in full across a lost connection, with
+        nothing sent twice"""
+        lost = mock.Mock()
+        lost.basic_publish.side_effect = [None, socket.error('reset')]
+        fresh = mock.Mock()
+        publisher = events.Publisher()
+        publisher.channel = lost
+        batch = [('release.p.1.a', {'event': 'a'}),
+                 ('release.p.1.b', {'event': 'b'}),
+                 ('release.p.1.c', {'event': 'c'})]
+        with mock.patch('recore.events._connect', return_value=fresh):
+            publisher.send(batch)
+        self.assertEqual(
+            [c[1]['routing_key'] for c in fresh.basic_publish.call_args_list],
+            ['release.p.1.b', 'release.p.1.c'])
+        self.assertEqual(json.loads(
+            fresh.basic_publish.call_args[1]['body']), {'event': 'c'})
+        self.assertEqual(fresh.basic_publish.call_args[1]['exchange'], 're')
+        self.assertEqual(batch, [])
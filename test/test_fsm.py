@@ -18,6 +18,10 @@ from bson.objectid import ObjectId
 from recore import mongo
 from recore import amqp
 from recore.fsm import FSM
+from recore.fsm import flights
+from recore.fsm.state import ReleaseState
+from recore.playbook import compile_steps
+import bson
 import datetime
 import json
 import logging
@@ -25,6 +29,8 @@ import mock
 import pika
 import pika.exceptions
 import pymongo
+import recore.codec
+import recore.fsm
 
 
 temp_queue = 'amqp-test_queue123'
@@ -94,6 +100,26 @@ class TestFsm(TestCase):
                 f._setup()
                 assert f.project == _state['project']
 
+    def test__setup_reads_state_once(self):
+        """The state document is only read the first time _setup runs"""
+        f = FSM(state_id)
+        f._connect_mq = mock.MagicMock(return_value=(mock.Mock(pika.channel.Channel),
+                                      mock.Mock(pika.connection.Connection)))
+
+        with mock.patch('recore.mongo.database') as (
+                mongo.database):
+            mongo.database = mock.MagicMock(pymongo.database.Database)
+            mongo.database.__getitem__.return_value = mock.MagicMock(pymongo.collection.Collection)
+
+            with mock.patch('recore.mongo.lookup_state') as (
+                    mongo.lookup_state):
+                mongo.lookup_state.return_value = _state
+
+                f._setup()
+                f._setup()
+                mongo.lookup_state.assert_called_once_with(state_id)
+                f._connect_mq.assert_called_once_with()
+
     def test__setup_lookup_state_none(self):
         """if lookup_state returns None then a LookupError is raised"""
         f = FSM(state_id)
@@ -226,12 +252,14 @@ class TestFsm(TestCase):
     def test_dequeue_next_active_step(self):
         """The FSM can remove the next step and update Mongo with it"""
         f = FSM(state_id)
-        f.remaining = ["Step 1", "Step 2"]
+        step1 = {"name": "Step 1", "plugin": "fake"}
+        step2 = {"name": "Step 2", "plugin": "fake"}
+        f.release = ReleaseState('project', {}, compile_steps([step1, step2]))
 
         _update_state = {
             '$set': {
-                'active_step': "Step 1",
-                'remaining_steps': ["Step 2"]
+                'active_step': step1,
+                'remaining_steps': [step2]
             }
         }
 
@@ -239,14 +267,14 @@ class TestFsm(TestCase):
                 us):
             f.dequeue_next_active_step()
             us.assert_called_once_with(_update_state)
-            self.assertEqual(f.active, "Step 1")
+            self.assertEqual(f.release.active_step.doc, step1)
 
     def test_move_active_to_completed(self):
         """FSM can update after completing a step"""
         f = FSM(state_id)
-        active_step = {"plugin": "not real"}
-        f.active = active_step.copy()
-        f.completed = []
+        active_step = {"plugin": "notreal"}
+        f.release = ReleaseState('project', {}, compile_steps([active_step]),
+                                 active=0)
 
         # For .called_once_with()
         _update_state = {
@@ -259,8 +287,23 @@ class TestFsm(TestCase):
         with mock.patch.object(f, 'update_state') as (us):
             f.move_active_to_completed()
             us.assert_called_once_with(_update_state)
-            self.assertEqual(f.active, None)
-            self.assertEqual(f.completed, [active_step])
+            self.assertEqual(f.release.active_step, None)
+            self.assertEqual(f.release.completed_docs(), [active_step])
+
+    def test_versioned_transitions(self):
+        """A versioned release only records its progress"""
+        f = FSM(state_id)
+        f.release = ReleaseState('project', {}, compile_steps([
+            {"name": "Step 1", "plugin": "fake"},
+            {"name": "Step 2", "plugin": "fake"}]), version='v1')
+
+        with mock.patch.object(f, 'update_state') as (us):
+            f.dequeue_next_active_step()
+            us.assert_called_once_with({'$set': {'active': 0}})
+            us.reset_mock()
+            f.move_active_to_completed()
+            us.assert_called_once_with(
+                {'$set': {'active': None, 'completed': 1}})
 
     @mock.patch.object(FSM, 'on_started')
     @mock.patch.object(FSM, 'dequeue_next_active_step')
@@ -271,11 +314,10 @@ class TestFsm(TestCase):
         f.reply_queue = temp_queue
 
         f.project = "mock tests"
-        f.dynamic = {}
-        f.active = {
+        f.release = ReleaseState(f.project, {}, compile_steps([{
             'plugin': 'fake',
             'parameters': {'no': 'parameters'}
-        }
+        }]), active=0)
         consume_iter = [
             (mock.Mock(name="method_mocked"),
              mock.Mock(name="properties_mocked"),
@@ -287,6 +329,7 @@ class TestFsm(TestCase):
         channel.consume.return_value = iter(consume_iter)
         channel.basic_publish = publish
         f.ch = channel
+        f.confirm_ch = channel
 
         f._run()
 
@@ -296,6 +339,52 @@ class TestFsm(TestCase):
         f.ch.cancel.assert_called_once_with()
         on_started.assert_called_once_with(f.ch, *consume_iter[0])
 
+        # The worker got the compiled step's message
+        kwargs = publish.call_args[1]
+        self.assertEqual(kwargs['routing_key'], 'worker.fake')
+        self.assertEqual(json.loads(kwargs['body']), {
+            'project': 'mock tests',
+            'parameters': {'no': 'parameters'},
+            'dynamic': {}
+        })
+
+    def test__step_body_dynamic(self):
+        """Steps are only sent the dynamic items they declare"""
+        f = FSM(state_id)
+        f.project = "mock tests"
+        dynamic = {'cart': 'c', 'environment': 'qa', 'big': 'x' * 1024}
+        f.release = ReleaseState(f.project, dynamic, compile_steps([
+            {'plugin': 'juicer', 'dynamic': ['cart', 'environment']},
+            {'plugin': 'shexec'},
+        ]))
+
+        declared = json.loads(f._step_body(f.release.steps[0]))
+        self.assertEqual(declared['dynamic'],
+                         {'cart': 'c', 'environment': 'qa'})
+
+        # Steps which declare nothing get everything
+        undeclared = json.loads(f._step_body(f.release.steps[1]))
+        self.assertEqual(undeclared['dynamic'], dynamic)
+        self.assertEqual(undeclared['project'], "mock tests")
+
+    def test__step_body_codec(self):
+        """Step messages follow the configured content type"""
+        f = FSM(state_id)
+        f.project = "mock tests"
+        f.release = ReleaseState(f.project, {'cart': 'c'}, compile_steps([
+            {'plugin': 'shexec', 'parameters': {'command': 'ls'}},
+        ]))
+        try:
+            recore.codec.configure(recore.codec.BSON)
+            body = f._step_body(f.release.steps[0])
+        finally:
+            recore.codec.configure(recore.codec.JSON)
+        self.assertEqual(bson.BSON(body).decode(), {
+            'project': 'mock tests',
+            'parameters': {'command': 'ls'},
+            'dynamic': {'cart': 'c'}
+        })
+
     @mock.patch.object(FSM, '_cleanup')
     @mock.patch.object(FSM, 'dequeue_next_active_step', mock.Mock(side_effect=IndexError))
     @mock.patch.object(FSM, '_setup')
@@ -308,6 +397,461 @@ class TestFsm(TestCase):
         cleanup.assert_called_once_with()
         self.assertTrue(result)
 
+    @mock.patch.object(FSM, '_cleanup')
+    @mock.patch.object(FSM, 'move_active_to_completed')
+    @mock.patch.object(FSM, '_setup')
+    def test__run_cached_step(self, setup, move_completed, cleanup):
+        """A cacheable step with a cached result is not sent to a worker"""
+        f = FSM(state_id)
+        f.db = mock.MagicMock()
+        f.ch = mock.Mock()
+        f.release = ReleaseState('project', {'cart': 'c'}, compile_steps([{
+            'name': 'build',
+            'plugin': 'fake',
+            'cacheable': True,
+            'dynamic': ['cart']
+        }]), active=0)
+        fingerprint = f.release.active_step.fingerprint({'cart': 'c'})
+
+        with mock.patch.object(f, 'dequeue_next_active_step',
+                               side_effect=[None, IndexError]):
+            with mock.patch('recore.fsm.recore.mongo') as mongo:
+                mongo.lookup_step_result.return_value = {
+                    '_id': fingerprint, 'release': 'abc'}
+                self.assertTrue(f._run())
+                mongo.lookup_step_result.assert_called_once_with(
+                    f.db, fingerprint)
+
+        move_completed.assert_called_once_with(cached={
+            'step': 'build',
+            'fingerprint': fingerprint,
+            'release': 'abc'})
+        self.assertFalse(f.ch.basic_publish.called)
+        cleanup.assert_called_once_with()
+
+    @mock.patch.object(FSM, '_cleanup')
+    @mock.patch.object(FSM, 'move_active_to_completed')
+    @mock.patch.object(FSM, '_setup')
+    def test__run_coalesced_step(self, setup, move_completed, cleanup):
+        """An identical coalesced step already running for another
+        release is followed rather than sent to a worker again"""
+        f = FSM(state_id)
+        f.ch = mock.Mock()
+        f.release = ReleaseState('project', {}, compile_steps([{
+            'name': 'build',
+            'plugin': 'fake',
+            'coalesce': True
+        }]), active=0)
+        fingerprint = f.release.active_step.fingerprint({})
+        (flight, _) = flights.join(fingerprint, 'leader')
+        flights.land(fingerprint, flight, flights.COMPLETED)
+        try:
+            with mock.patch.object(f, 'dequeue_next_active_step',
+                                   side_effect=[None, IndexError]):
+                with mock.patch('recore.fsm.flights.join',
+                                return_value=(flight, False)):
+                    self.assertTrue(f._run())
+        finally:
+            flights._flights.clear()
+
+        move_completed.assert_called_once_with(shared={
+            'step': 'build',
+            'fingerprint': fingerprint,
+            'release': 'leader'})
+        self.assertFalse(f.ch.basic_publish.called)
+
+        # A failed flight fails its followers too
+        flight.status = flights.FAILED
+        cleanup.reset_mock()
+        with mock.patch.object(f, 'dequeue_next_active_step'):
+            with mock.patch('recore.fsm.flights.join',
+                            return_value=(flight, False)):
+                with mock.patch.object(f, 'update_state') as update_state:
+                    self.assertFalse(f._run())
+        self.assertFalse(f.ch.basic_publish.called)
+        update = update_state.call_args[0][0]['$set']
+        self.assertEqual(update['status'], 'failed')
+        self.assertTrue('leader' in update['error'])
+        cleanup.assert_called_once_with()
+
+    @mock.patch.object(FSM, 'on_started')
+    @mock.patch.object(FSM, '_setup')
+    def test__run_coalesced_leader(self, setup, on_started):
+        """The leader of a coalesced step dispatches it and shares the
+        outcome, or abandons the flight if it gets none"""
+        f = FSM(state_id)
+        f.ch = mock.Mock()
+        f.ch.consume.return_value = iter([])
+        f.confirm_ch = f.ch
+        f.release = ReleaseState('project', {}, compile_steps([{
+            'plugin': 'fake', 'coalesce': True}]), active=0)
+        fingerprint = f.release.active_step.fingerprint({})
+
+        with mock.patch.object(f, 'dequeue_next_active_step'):
+            f._run()
+        self.assertEqual(f.ch.basic_publish.call_count, 1)
+        self.assertEqual(flights.in_flight(), 0)
+        self.assertEqual(f._flight, None)
+
+        # The leader shares its worker's outcome
+        (flight, _) = flights.join(fingerprint, state_id)
+        f._flight = (fingerprint, flight)
+        f.release.active = 0
+        with mock.patch.object(f, 'move_active_to_completed'):
+            with mock.patch.object(f, '_run'):
+                f.on_ended(f.ch, mock.Mock(), pika.spec.BasicProperties(),
+                           json.dumps(msg_completed))
+        self.assertEqual(flight.status, flights.COMPLETED)
+
+    @mock.patch.object(FSM, 'on_started')
+    @mock.patch.object(FSM, '_setup')
+    def test__run_plugin_slot(self, setup, on_started):
+        """A dispatched step holds a slot of its plugin until it ends"""
+        f = FSM(state_id)
+        f.ch = mock.Mock()
+        f.ch.consume.return_value = iter([])
+        f.confirm_ch = f.ch
+        f.release = ReleaseState('project', {}, compile_steps([{
+            'plugin': 'limited'}]), active=0)
+
+        with mock.patch('recore.fsm.throttle') as throttle:
+            throttle.acquire.return_value = True
+            with mock.patch.object(f, 'dequeue_next_active_step'):
+                f._run()
+            throttle.acquire.assert_called_once_with('limited', 0)
+            throttle.release.assert_called_once_with('limited')
+        self.assertEqual(f._slot, None)
+
+        # The slot is given back as soon as the worker answers
+        f._slot = 'limited'
+        with mock.patch('recore.fsm.throttle') as throttle:
+            with mock.patch.object(f, '_fail'):
+                f.on_ended(f.ch, mock.Mock(), pika.spec.BasicProperties(),
+                           json.dumps(msg_errored))
+            throttle.release.assert_called_once_with('limited')
+
+    @mock.patch.object(FSM, 'on_started')
+    @mock.patch.object(FSM, '_cleanup')
+    @mock.patch.object(FSM, 'update_state')
+    @mock.patch.object(FSM, '_setup')
+    def test__run_unroutable(self, setup, update_state, cleanup, on_started):
+        """A step nothing can receive fails the release right away"""
+        f = FSM(state_id)
+        f.ch = mock.Mock()
+        f.conn = mock.Mock()
+        f.conn.channel.return_value.basic_publish.return_value = False
+        f.release = ReleaseState('project', {}, compile_steps([{
+            'name': 'nowhere', 'plugin': 'missing'}]), active=0)
+
+        with mock.patch.object(f, 'dequeue_next_active_step'):
+            self.assertFalse(f._run())
+
+        f.conn.channel.return_value.confirm_delivery.assert_called_once_with()
+        self.assertEqual(
+            f.conn.channel.return_value.basic_publish.call_args[1][
+                'mandatory'], True)
+        update = update_state.call_args[0][0]['$set']
+        self.assertEqual(update['status'], 'failed')
+        self.assertTrue('worker.missing' in update['error'])
+        cleanup.assert_called_once_with()
+        self.assertFalse(on_started.called)
+        self.assertFalse(f.ch.consume.called)
+
+    @mock.patch.object(FSM, 'on_started')
+    @mock.patch.object(FSM, '_setup')
+    def test__run_queue_gone(self, setup, on_started):
+        """Every step is confirmed, so a worker queue which took the
+        last step but is gone by the next fails the release then"""
+        f = FSM(state_id)
+        f.ch = mock.Mock()
+        f.ch.consume.return_value = iter([])
+        f.conn = mock.Mock()
+        confirm_ch = f.conn.channel.return_value
+        # The broker returns the second step, before its ack
+        confirm_ch.basic_publish.side_effect = [True, False]
+        f.release = ReleaseState('project', {}, compile_steps([
+            {'plugin': 'known'}, {'plugin': 'known'}]), active=0)
+
+        with mock.patch.object(f, 'dequeue_next_active_step'):
+            f._run()
+            f.release.active = 1
+            with mock.patch.object(f, '_unroutable') as unroutable:
+                f._run()
+        unroutable.assert_called_once_with(f.release.active_step)
+        self.assertEqual(confirm_ch.basic_publish.call_count, 2)
+        self.assertEqual(confirm_ch.basic_publish.call_args[1]['mandatory'],
+                         True)
+        self.assertFalse(f.ch.basic_publish.called)
+        self.assertEqual(f.ch.consume.call_count, 1)
+
+    @mock.patch('recore.backoff.time.sleep')
+    @mock.patch.object(FSM, '_resume')
+    @mock.patch.object(FSM, '_run')
+    def test__supervise(self, run, resume, sleep):
+        """A lost connection is reopened and the release carries on,
+        but closing it ourselves ends the release"""
+        f = FSM(state_id)
+        f.ch = mock.Mock()
+        run.side_effect = pika.exceptions.ConnectionClosed
+        resume.return_value = True
+        with mock.patch.object(f, '_setup', side_effect=[
+                pika.exceptions.AMQPConnectionError('refused'), None]):
+            self.assertTrue(f._supervise())
+        resume.assert_called_once_with()
+        self.assertEqual(f.ch, None)
+        self.assertEqual(sleep.call_count, 1)
+
+        f._finishing = True
+        run.reset_mock()
+        resume.reset_mock()
+        self.assertTrue(f._supervise())
+        self.assertFalse(resume.called)
+
+    @mock.patch.object(FSM, '_run_step')
+    @mock.patch.object(FSM, '_await_ended')
+    @mock.patch.object(FSM, '_await_started')
+    def test__resume(self, started, ended, run_step):
+        """After reconnecting we wait for whatever the worker has left
+        to tell us, or send the step again if it never got it"""
+        f = FSM(state_id)
+        f.release = ReleaseState('project', {}, compile_steps([
+            {'plugin': 'fake'}]), active=0)
+
+        with mock.patch('recore.fsm.throttle') as throttle:
+            f._slot = 'fake'
+            f._phase = recore.fsm.DISPATCHED
+            f._resume()
+            started.assert_called_once_with()
+
+            f._slot = 'fake'
+            f._phase = recore.fsm.STARTED
+            f._resume()
+            ended.assert_called_once_with()
+            self.assertEqual(f._slot, None)
+            # The slot held before reconnecting is the one given back
+            self.assertFalse(throttle.acquire.called)
+            self.assertEqual(throttle.release.call_count, 2)
+
+        f.reply_queue_lost = True
+        f._resume()
+        run_step.assert_called_once_with(f.release.active_step)
+        self.assertEqual(f._phase, None)
+
+        with mock.patch.object(f, '_run') as run:
+            f.release.complete_active()
+            f._resume()
+            run.assert_called_once_with()
+
+    @mock.patch.object(FSM, '_flush_state')
+    @mock.patch.object(FSM, 'on_started')
+    def test__resume_keeps_slot(self, on_started, flush_state):
+        """A step keeps its slot and flight across a reconnect, and
+        lets go of them if the broker doesn't come back"""
+        f = FSM(state_id)
+        f.ch = mock.Mock()
+        f.confirm_ch = f.ch
+        f.release = ReleaseState('project', {}, compile_steps([{
+            'plugin': 'limited'}]), active=0)
+        flight = flights.Flight(state_id)
+        f._flight = ('fingerprint', flight)
+
+        with mock.patch('recore.fsm.throttle') as throttle:
+            throttle.acquire.return_value = True
+            f.ch.consume.side_effect = pika.exceptions.ConnectionClosed
+            self.assertRaises(pika.exceptions.ConnectionClosed,
+                              f._holding, f._dispatch,
+                              f.release.active_step)
+            throttle.acquire.assert_called_once_with('limited', 0)
+            self.assertFalse(throttle.release.called)
+            self.assertEqual(f._slot, 'limited')
+            self.assertEqual(flight.status, None)
+            self.assertEqual(f._phase, recore.fsm.DISPATCHED)
+
+            # Carry on waiting for the worker with the same slot
+            f.ch.consume.side_effect = None
+            f.ch.consume.return_value = iter([(
+                mock.Mock(), pika.spec.BasicProperties(), '{}')])
+            f._resume()
+            on_started.assert_called_once_with(
+                f.ch, mock.ANY, mock.ANY, '{}')
+            self.assertEqual(throttle.acquire.call_count, 1)
+            throttle.release.assert_called_once_with('limited')
+
+            # Giving up on the broker gives them back
+            throttle.reset_mock()
+            f._slot = 'limited'
+            f._flight = ('fingerprint', flight)
+            refused = pika.exceptions.AMQPConnectionError('refused')
+            with mock.patch.object(
+                    f, '_run', side_effect=pika.exceptions.ConnectionClosed):
+                with mock.patch('recore.backoff.retry', side_effect=refused):
+                    self.assertRaises(pika.exceptions.AMQPConnectionError,
+                                      f._supervise)
+            throttle.release.assert_called_once_with('limited')
+            self.assertEqual(flight.status, flights.ABANDONED)
+
+    def test_update_state_mongo_down(self):
+        """State updates are kept while MongoDB is unreachable and sent
+        in order once it is back"""
+        f = FSM(state_id)
+        f.state_coll = mock.MagicMock(spec=pymongo.collection.Collection)
+        f.state_coll.update.side_effect = [
+            pymongo.errors.AutoReconnect('failover'), True, True]
+
+        f.update_state({'$set': {'a': 1}})
+        self.assertEqual(len(f._pending), 1)
+        f.update_state({'$set': {'b': 2}})
+        self.assertEqual(f._pending, [])
+        self.assertEqual(
+            [c[0][1] for c in f.state_coll.update.call_args_list],
+            [{'$set': {'a': 1}}, {'$set': {'a': 1}}, {'$set': {'b': 2}}])
+
+    def test_events_follow_state(self):
+        """Release events are published only once the state update
+        before them is in MongoDB"""
+        f = FSM(state_id)
+        f.project = 'project'
+        f.release = ReleaseState('project', {}, compile_steps([{
+            'name': 'build', 'plugin': 'shexec'}]))
+        f.state_coll = mock.MagicMock(spec=pymongo.collection.Collection)
+        f.state_coll.update.side_effect = [
+            pymongo.errors.AutoReconnect('failover'), True, True]
+
+        with mock.patch('recore.fsm.recore.events') as events:
+            events.ENABLED = True
+            f.dequeue_next_active_step()
+            self.assertFalse(events.emit.called)
+            f.move_active_to_completed()
+            self.assertEqual(events.emit.call_args_list, [
+                mock.call(state_id, 'project', 'step.started',
+                          step='build'),
+                mock.call(state_id, 'project', 'step.completed',
+                          step='build')])
+
+    def test_failed_step_ends_release(self):
+        """A step which fails in its worker ends the release, with a
+        release.ended event saying it failed"""
+        f = FSM(state_id)
+        f.project = 'project'
+        f.ch = mock.Mock(pika.channel.Channel)
+        f.conn = mock.Mock(pika.connection.Connection)
+        f.reply_queue = temp_queue
+        f.release = ReleaseState('project', {}, compile_steps([{
+            'name': 'build', 'plugin': 'shexec'}]), active=0)
+        f.state_coll = mock.MagicMock(spec=pymongo.collection.Collection)
+
+        with mock.patch('recore.fsm.recore.events') as events:
+            events.ENABLED = True
+            self.assertFalse(f.on_ended(
+                f.ch, mock.Mock(), pika.spec.BasicProperties(),
+                json.dumps(msg_errored)))
+        self.assertEqual(events.emit.call_args_list, [
+            mock.call(state_id, 'project', 'step.failed', step='build'),
+            mock.call(state_id, 'project', 'release.ended',
+                      status='failed', step='build')])
+        f.ch.queue_delete.assert_called_once_with(queue=temp_queue)
+
+    def test_journal_mode(self):
+        """In journal mode transitions are appended to the journal and
+        the state document is only rewritten as a snapshot"""
+        f = FSM(state_id)
+        f.project = 'project'
+        f.db = mock.MagicMock()
+        f.state_coll = mock.MagicMock(spec=pymongo.collection.Collection)
+        f.release = ReleaseState('project', {}, compile_steps([{
+            'name': 'build', 'plugin': 'shexec'}]))
+
+        with mock.patch('recore.fsm.recore.journal.ENABLED', True):
+            with mock.patch('recore.fsm.recore.journal.SNAPSHOT_EVERY', 3):
+                with mock.patch('recore.fsm.recore.journal.snapshot') as snap:
+                    snap.return_value = 3
+                    f.dequeue_next_active_step()
+                    f.move_active_to_completed()
+                    self.assertFalse(snap.called)
+                    f.update_state({'$set': {'failed': False}})
+                    snap.assert_called_once_with(f.db, state_id)
+
+        self.assertFalse(f.state_coll.update.called)
+        entries = [c[0][0] for c in f.db['journal'].insert.call_args_list]
+        self.assertEqual([(e['seq'], e['type']) for e in entries], [
+            (1, 'step.started'), (2, 'step.completed'), (3, 'set')])
+        self.assertEqual(f._snapshot_seq, 3)
+
+    def test_update_state_wal(self):
+        """With the write-ahead log state updates go to it, not to
+        MongoDB"""
+        f = FSM(state_id)
+        f.state_coll = mock.MagicMock(spec=pymongo.collection.Collection)
+        with mock.patch('recore.fsm.recore.wal') as wal:
+            wal.ENABLED = True
+            wal.update.return_value = 123
+            f.update_state({'$set': {'a': 1}})
+            wal.update.assert_called_once_with(
+                'state', {'_id': ObjectId(state_id)}, {'$set': {'a': 1}})
+        self.assertEqual(f._pending, [])
+        self.assertEqual(f._wal_lsn, 123)
+        self.assertFalse(f.state_coll.update.called)
+
+    @mock.patch('recore.backoff.time.sleep')
+    def test__flush_state_wait(self, sleep):
+        """Waiting for kept updates retries until MongoDB is back"""
+        f = FSM(state_id)
+        f.state_coll = mock.MagicMock(spec=pymongo.collection.Collection)
+        f.state_coll.update.side_effect = [
+            pymongo.errors.AutoReconnect('failover'),
+            pymongo.errors.AutoReconnect('failover'), True]
+        f._pending = [{'$set': {'ended': UTCNOW}}]
+        f._flush_state(wait=True)
+        self.assertEqual(f._pending, [])
+        self.assertEqual(sleep.call_count, 2)
+
+    def test__connect_mq_reply_queue(self):
+        """The reply queue is named after the release, outlives the
+        connection, and is checked for when reconnecting"""
+        f = FSM(state_id)
+        with mock.patch('recore.fsm.pika.BlockingConnection') as connection:
+            with mock.patch('recore.fsm.recore.amqp.MQ_CONF'):
+                conn = connection.return_value
+                channel = conn.channel.return_value
+                channel.queue_declare.return_value.method.queue = (
+                    'recore.%s' % state_id)
+                f._connect_mq()
+                kwargs = channel.queue_declare.call_args[1]
+                self.assertEqual(kwargs['queue'], 'recore.%s' % state_id)
+                self.assertFalse(kwargs['exclusive'])
+                self.assertFalse(kwargs['auto_delete'])
+                self.assertFalse(f.reply_queue_lost)
+
+                channel.queue_declare.side_effect = [
+                    pika.exceptions.ChannelClosed(404, 'NOT_FOUND'),
+                    channel.queue_declare.return_value]
+                f._connect_mq()
+                self.assertTrue(f.reply_queue_lost)
+
+    def test_move_active_to_completed_caches(self):
+        """Completing a cacheable step records its result, and a step
+        completed from the cache is recorded as such"""
+        f = FSM(state_id)
+        f.db = mock.MagicMock()
+        steps = compile_steps([
+            {'plugin': 'fake', 'cacheable': True},
+            {'plugin': 'fake', 'cacheable': True, 'name': 'again'}])
+        f.release = ReleaseState('project', {}, steps, active=0)
+
+        with mock.patch.object(f, 'update_state') as us:
+            with mock.patch('recore.fsm.recore.mongo') as mongo:
+                f.move_active_to_completed()
+                mongo.record_step_result.assert_called_once_with(
+                    f.db, steps[0].fingerprint({}), state_id, None)
+
+                f.release.start_next()
+                cached = {'step': 'again', 'fingerprint': 'x',
+                          'release': 'abc'}
+                f.move_active_to_completed(cached=cached)
+                self.assertEqual(mongo.record_step_result.call_count, 1)
+                self.assertEqual(us.call_args[0][0]['$push'],
+                                 {'cached_steps': cached})
+
     @mock.patch.object(FSM, 'on_ended')
     def test_on_started(self, ended):
         """Once started, the FSM waits for a response, and then calls on_ended"""
@@ -332,21 +876,23 @@ class TestFsm(TestCase):
         f.ch.cancel.assert_called_once_with()
         ended.assert_called_once_with(f.ch, *consume_iter[0])
 
+    @mock.patch.object(FSM, '_cleanup')
+    @mock.patch.object(FSM, 'update_state')
     @mock.patch.object(FSM, '_run')
     @mock.patch.object(FSM, 'move_active_to_completed')
-    def test_on_ended(self, run, move_completed):
+    def test_on_ended(self, run, move_completed, update_state, cleanup):
         """Once a step ends the FSM checks if it completed or else"""
         f = FSM(state_id)
 
         consume_completed = [
             mock.Mock(name="method_mocked"),
-            mock.Mock(name="properties_mocked"),
+            pika.spec.BasicProperties(),
             json.dumps(msg_completed)
         ]
 
         consume_errored = [
             mock.Mock(name="method_mocked"),
-            mock.Mock(name="properties_mocked"),
+            pika.spec.BasicProperties(),
             json.dumps(msg_errored)
         ]
 
@@ -363,3 +909,89 @@ class TestFsm(TestCase):
         self.assertFalse(f.move_active_to_completed.called)
         self.assertFalse(f._run.called)
         self.assertFalse(result)
+        # The release failed, and ends
+        update_state.assert_called_once_with({
+            '$set': {'failed': True, 'status': 'failed'}})
+        self.assertTrue(f._failed)
+        cleanup.assert_called_once_with()
+
+    @mock.patch.object(FSM, 'on_ended')
+    @mock.patch.object(FSM, '_cleanup')
+    @mock.patch.object(FSM, 'update_state')
+    def test__await_ended_cancel(self, update_state, cleanup, ended):
+        """A cancel in the reply queue stops the release and the worker
+        running its step"""
+        f = FSM(state_id)
+        f.reply_queue = temp_queue
+        f.release = ReleaseState('project', {}, compile_steps([{
+            'name': 'slow', 'plugin': 'shexec'}]), active=0)
+        f._phase = recore.fsm.STARTED
+        f._slot = 'shexec'
+        f._worker_queue = 'worker.shexec.1'
+        flight = flights.Flight(state_id)
+        f._flight = ('fingerprint', flight)
+
+        cancel = (mock.Mock(name="method_mocked"),
+                  pika.spec.BasicProperties(type=recore.fsm.CANCEL),
+                  json.dumps({'id': state_id}))
+        f.ch = mock.Mock()
+        f.ch.consume.return_value = iter([cancel])
+
+        with mock.patch('recore.fsm.throttle') as throttle:
+            self.assertFalse(f._await_ended())
+            throttle.release.assert_called_once_with('shexec')
+
+        self.assertFalse(ended.called)
+        publish = f.ch.basic_publish.call_args[1]
+        self.assertEqual(publish['routing_key'], 'worker.shexec.1')
+        self.assertEqual(publish['properties'].type, recore.fsm.CANCEL)
+        self.assertEqual(publish['properties'].correlation_id, state_id)
+        self.assertEqual(update_state.call_args[0][0]['$set'],
+                         {'cancelled': True, 'status': 'cancelled'})
+        cleanup.assert_called_once_with()
+        self.assertEqual(flight.status, flights.ABANDONED)
+        self.assertEqual(f._phase, None)
+
+    @mock.patch.object(FSM, '_cleanup')
+    @mock.patch.object(FSM, 'update_state')
+    @mock.patch.object(FSM, '_setup')
+    def test__run_cancelled(self, setup, update_state, cleanup):
+        """A release cancelled between steps dispatches nothing more"""
+        f = FSM(state_id)
+        f.ch = mock.Mock()
+        f.release = ReleaseState('project', {}, compile_steps([{
+            'plugin': 'shexec'}]))
+        f.cancel()
+
+        with mock.patch.object(f, 'dequeue_next_active_step') as dequeue:
+            self.assertFalse(f._run())
+            self.assertFalse(dequeue.called)
+        self.assertFalse(f.ch.basic_publish.called)
+        self.assertEqual(update_state.call_args[0][0]['$set']['status'],
+                         'cancelled')
+        cleanup.assert_called_once_with()
+
+    def test_status(self):
+        """The FSM reports where its release is at from memory"""
+        f = FSM(state_id)
+        self.assertEqual(f.status(), {'id': state_id, 'status': 'starting'})
+
+        f.release = ReleaseState('project', {}, compile_steps([
+            {'name': name, 'plugin': 'shexec'}
+            for name in ('one', 'two', 'three')]), completed=1)
+        f.project = 'project'
+        f.started_at = datetime.datetime(2014, 6, 1, 12, 0, 0)
+        f.state_coll = mock.Mock()
+        f.db = mock.Mock()
+        f.dequeue_next_active_step()
+        f._phase = recore.fsm.DISPATCHED
+
+        report = f.status()
+        self.assertEqual(report['status'], 'running')
+        self.assertEqual(report['step'], 'two')
+        self.assertEqual(report['phase'], 'dispatched')
+        self.assertEqual((report['completed'], report['total']), (1, 3))
+        self.assertEqual(report['started'], '2014-06-01T12:00:00')
+        self.assertNotEqual(report['step_started'], None)
+        self.assertEqual(report['plugin']['name'], 'shexec')
+        self.assertEqual(report['plugin']['waiting'], 0)
@@ -0,0 +1,67 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from . import TestCase, unittest
+
+from recore.fsm import flights
+
+
+class TestFsmFlights(TestCase):
+
+    def tearDown(self):
+        flights._flights.clear()
+
+    def test_join(self):
+        """The first to join a flight leads it, later ones follow"""
+        (flight, leading) = flights.join('fp', 'release1')
+        self.assertTrue(leading)
+        self.assertEqual(flight.leader, 'release1')
+        (same, leading) = flights.join('fp', 'release2')
+        self.assertFalse(leading)
+        self.assertTrue(same is flight)
+        (other, leading) = flights.join('fp2', 'release2')
+        self.assertTrue(leading)
+        self.assertEqual(flights.in_flight(), 2)
+
+    def test_land(self):
+        """Followers get the first outcome, and a landed flight is gone"""
+        (flight, _) = flights.join('fp', 'release1')
+        outcome = []
+        follower = threading.Thread(
+            target=lambda: outcome.append(flight.wait(5)))
+        follower.start()
+
+        flights.land('fp', flight, flights.COMPLETED)
+        flights.land('fp', flight, flights.ABANDONED)
+        follower.join(5)
+        self.assertEqual(outcome, [flights.COMPLETED])
+        self.assertEqual(flights.in_flight(), 0)
+
+        # The next identical step starts a new flight
+        (again, leading) = flights.join('fp', 'release2')
+        self.assertTrue(leading)
+        self.assertFalse(again is flight)
+
+    def test_land_late(self):
+        """Landing an old flight leaves a newer one alone"""
+        (old, _) = flights.join('fp', 'release1')
+        flights.land('fp', old, flights.ABANDONED)
+        (new, _) = flights.join('fp', 'release2')
+        flights.land('fp', old, flights.COMPLETED)
+        self.assertEqual(old.status, flights.ABANDONED)
+        self.assertEqual(flights.in_flight(), 1)
+        self.assertFalse(new.landed.is_set())
@@ -0,0 +1,93 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from . import TestCase, unittest
+
+from recore.fsm import state
+from recore.playbook import compile_steps
+
+
+STEPS = [
+    {'name': 'one', 'plugin': 'shexec', 'parameters': {'command': 'ls'}},
+    {'name': 'two', 'plugin': 'juicer', 'parameters': {},
+     'dynamic': ['cart', 'environment']},
+    {'name': 'three', 'plugin': 'shexec', 'parameters': {'command': 'id'}},
+]
+
+
+class TestFsmState(TestCase):
+
+    def test_from_document(self):
+        """Release state can be rebuilt from a state document"""
+        doc = {
+            'project': 'example',
+            'dynamic': {'cart': 'c'},
+            'completed_steps': STEPS[:1],
+            'active_step': STEPS[1],
+            'remaining_steps': STEPS[2:],
+        }
+        release = state.ReleaseState.from_document(doc)
+        self.assertEqual(release.project, 'example')
+        self.assertEqual(release.dynamic, {'cart': 'c'})
+        self.assertIs(release.steps, compile_steps(STEPS))
+        self.assertEqual(release.completed, 1)
+        self.assertEqual(release.active_step.name, 'two')
+        self.assertEqual(release.completed_docs(), STEPS[:1])
+        self.assertEqual(release.remaining_docs(), STEPS[2:])
+
+    def test_from_new_document(self):
+        """A fresh state document has nothing active or completed"""
+        doc = {
+            'project': 'example',
+            'dynamic': {},
+            'completed_steps': [],
+            'active_step': {},
+            'remaining_steps': STEPS,
+        }
+        release = state.ReleaseState.from_document(doc)
+        self.assertEqual(release.completed, 0)
+        self.assertIsNone(release.active_step)
+        self.assertEqual(release.remaining_docs(), STEPS)
+
+    def test_from_versioned_document(self):
+        """A versioned state document only records its progress through
+        the steps of its playbook version"""
+        doc = {
+            'project': 'example',
+            'dynamic': {},
+            'playbook_version': 'v1',
+            'completed': 1,
+            'active': 1,
+        }
+        self.assertRaises(ValueError, state.ReleaseState.from_document, doc)
+        steps = compile_steps(STEPS)
+        release = state.ReleaseState.from_document(doc, steps)
+        self.assertIs(release.steps, steps)
+        self.assertEqual(release.version, 'v1')
+        self.assertEqual(release.completed, 1)
+        self.assertEqual(release.active_step.name, 'two')
+
+    def test_progress(self):
+        """Steps move from remaining to active to completed by index"""
+        release = state.ReleaseState('p', {}, compile_steps(STEPS))
+        for (i, expected) in enumerate(STEPS):
+            step = release.start_next()
+            self.assertEqual(step.doc, expected)
+            self.assertEqual(release.remaining_docs(), STEPS[i + 1:])
+            release.complete_active()
+            self.assertEqual(release.completed_docs(), STEPS[:i + 1])
+            self.assertIsNone(release.active_step)
+        with self.assertRaises(IndexError):
+            release.start_next()
@@ -0,0 +1,73 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from . import TestCase, unittest
+import threading
+import time
+import mock
+
+from . import TestCase, unittest
+
+from recore.fsm import throttle
+
+
+class TestFsmThrottle(TestCase):
+
+    def tearDown(self):
+        throttle.init_throttle({})
+
+    def test_unlimited(self):
+        """Plugins without limits are only counted"""
+        for _ in range(100):
+            self.assertTrue(throttle.acquire('free', 0))
+        self.assertEqual(throttle.saturation()['free']['in_flight'], 100)
+        throttle.release('free')
+        self.assertEqual(throttle.saturation()['free']['in_flight'], 99)
+
+    def test_concurrency(self):
+        """Steps over a plugin's concurrency wait for one to end"""
+        throttle.init_throttle({'slow': {'concurrency': 2}})
+        self.assertTrue(throttle.acquire('slow', 0))
+        self.assertTrue(throttle.acquire('slow', 0))
+        self.assertFalse(throttle.acquire('slow', 0))
+
+        got = []
+        waiter = threading.Thread(
+            target=lambda: got.append(throttle.acquire('slow', 5)))
+        waiter.start()
+        time.sleep(0.05)
+        self.assertEqual(throttle.saturation()['slow']['waiting'], 1)
+        throttle.release('slow')
+        waiter.join(5)
+        self.assertEqual(got, [True])
+        self.assertEqual(throttle.saturation()['slow']['in_flight'], 2)
+
+    def test_rate(self):
+        """A plugin's rate is limited by a token bucket"""
+        throttle.init_throttle({'api': {'RATE': 10, 'BURST': 2}})
+        now = [1000.0]
+        with mock.patch('recore.fsm.throttle.time.time',
+                        side_effect=lambda: now[0]):
+            limiter = throttle.limiter('api')
+            self.assertTrue(limiter.acquire(0))
+            self.assertTrue(limiter.acquire(0))
+            # The burst is used up
+            self.assertFalse(limiter.acquire(0))
+            now[0] += 0.1
+            self.assertTrue(limiter.acquire(0))
+            self.assertFalse(limiter.acquire(0))
+        # Releasing a step does not give a token back
+        limiter.release()
+        self.assertEqual(limiter.saturation()['in_flight'], 2)
@@ -0,0 +1,149 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import mock
+
+from . import TestCase, unittest
+
+from recore.job import cancel
+import recore.fsm
+
+# Mocks
+channel = mock.MagicMock()
+
+
+class TestJobCancel(TestCase):
+
+    def tearDown(self):
+        """
+        Reset mocks.
+        """
+        channel.reset_mock()
+
+    @mock.patch('recore.job.cancel.recore.admission')
+    @mock.patch('recore.job.cancel.recore.fsm.registry')
+    def test_cancel_running(self, registry, admission):
+        """
+        Verify a running release's FSM is told to stop
+        """
+        fsm = mock.Mock()
+        registry.get.return_value = fsm
+
+        assert cancel.cancel(channel, 'abc123', 'replyto') is True
+        fsm.cancel.assert_called_once_with()
+        (wake, answer) = channel.basic_publish.call_args_list
+        self.assertEqual(wake[1]['routing_key'], 'recore.abc123')
+        self.assertEqual(wake[1]['properties'].type, recore.fsm.CANCEL)
+        self.assertEqual(answer[1]['routing_key'], 'replyto')
+        self.assertEqual(json.loads(answer[1]['body']),
+                         {'id': 'abc123', 'cancelled': True})
+        self.assertFalse(admission.unqueue.called)
+
+    @mock.patch('recore.job.cancel.recore.mongo')
+    @mock.patch('recore.job.cancel.recore.admission')
+    @mock.patch('recore.job.cancel.recore.fsm.registry')
+    def test_cancel_queued(self, registry, admission, mongo):
+        """
+        Verify a release waiting to start is never started
+        """
+        registry.get.return_value = None
+        admission.position.return_value = 0
+        mongo.cancel_waiting.return_value = True
+
+        assert cancel.cancel(channel, 'abc123') is True
+        admission.unqueue.assert_called_once_with('abc123')
+        mongo.cancel_waiting.assert_called_once_with(
+            mongo.database, 'abc123')
+        # No reply_to, no answer
+        self.assertFalse(channel.basic_publish.called)
+
+    @mock.patch('recore.job.cancel.recore.schedule')
+    @mock.patch('recore.job.cancel.recore.mongo')
+    @mock.patch('recore.job.cancel.recore.admission')
+    @mock.patch('recore.job.cancel.recore.fsm.registry')
+    def test_cancel_queued_mongo_down(self, registry, admission, mongo,
+                                      schedule):
+        """
+        Verify a waiting release stays as it was if it can't be
+        cancelled in MongoDB
+        """
+        import pymongo.errors
+        registry.get.return_value = None
+        admission.position.return_value = 0
+        mongo.cancel_waiting.side_effect = pymongo.errors.AutoReconnect('x')
+
+        assert cancel.cancel(channel, 'abc123', 'replyto') is False
+        self.assertFalse(admission.unqueue.called)
+        self.assertFalse(schedule.unschedule.called)
+        self.assertEqual(json.loads(channel.basic_publish.call_args[1]['body']),
+                         {'id': 'abc123', 'cancelled': False})
+
+    @mock.patch('recore.job.cancel.recore.schedule')
+    @mock.patch('recore.job.cancel.recore.mongo')
+    @mock.patch('recore.job.cancel.recore.admission')
+    @mock.patch('recore.job.cancel.recore.fsm.registry')
+    def test_cancel_scheduled(self, registry, admission, mongo, schedule):
+        """
+        Verify a scheduled release is never started
+        """
+        registry.get.return_value = None
+        admission.position.return_value = None
+        schedule.is_scheduled.return_value = True
+        mongo.cancel_waiting.return_value = True
+
+        assert cancel.cancel(channel, 'abc123') is True
+        schedule.unschedule.assert_called_once_with('abc123')
+        mongo.cancel_waiting.assert_called_once_with(
+            mongo.database, 'abc123')
+
+    @mock.patch('recore.job.cancel.recore.mongo')
+    @mock.patch('recore.job.cancel.recore.admission')
+    @mock.patch('recore.job.cancel.recore.fsm.registry')
+    def test_cancel_unknown(self, registry, admission, mongo):
+        """
+        Verify releases nobody is running are left alone
+        """
+        registry.get.return_value = None
+        admission.position.return_value = None
+        mongo.cancel_waiting.return_value = False
+        mongo.lookup_release_status.return_value = {'ended': True}
+
+        assert cancel.cancel(channel, 'abc123', 'replyto') is False
+        self.assertFalse(admission.unqueue.called)
+        self.assertEqual(json.loads(channel.basic_publish.call_args[1]['body']),
+                         {'id': 'abc123', 'cancelled': False})
+
+    @mock.patch('recore.job.cancel.recore.mongo')
+    @mock.patch('recore.job.cancel.recore.admission')
+    @mock.patch('recore.job.cancel.recore.fsm.registry')
+    def test_cancel_elsewhere(self, registry, admission, mongo):
+        """
+        Verify releases held by another process are cancelled through
+        MongoDB, or told to stop if they are running
+        """
+        registry.get.return_value = None
+        admission.position.return_value = None
+
+        mongo.cancel_waiting.return_value = True
+        assert cancel.cancel(channel, 'abc123') is True
+        self.assertFalse(channel.basic_publish.called)
+
+        mongo.cancel_waiting.return_value = False
+        mongo.lookup_release_status.return_value = {'project': 'p'}
+        assert cancel.cancel(channel, 'abc123') is True
+        wake = channel.basic_publish.call_args[1]
+        self.assertEqual(wake['routing_key'], 'recore.abc123')
+        self.assertEqual(wake['properties'].type, recore.fsm.CANCEL)
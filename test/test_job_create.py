@@ -13,7 +13,10 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
 import mock
+import pika.exceptions
+import pymongo.errors
 
 from . import TestCase, unittest
 
@@ -30,6 +33,7 @@ class TestJobCreate(TestCase):
         Reset mocks.
         """
         channel.reset_mock()
+        create._recent_keys.clear()
 
     def test_release_with_good_data(self):
         """
@@ -46,7 +50,28 @@ class TestJobCreate(TestCase):
             channel.basic_publish.assert_called_with(
                 exchange='',
                 routing_key='replyto',
-                body='{"id": "1234567890"}')
+                body='{"id": "1234567890"}',
+                properties=mock.ANY)
+            props = channel.basic_publish.call_args[1]['properties']
+            assert props.content_type == 'application/json'
+
+    def test_release_when_reply_fails(self):
+        """
+        Verify the release id is still returned if the reply is lost
+        """
+        with mock.patch(
+                'recore.job.create.recore.mongo') as create.recore.mongo:
+            create.recore.mongo.lookup_project = mock.MagicMock(
+                return_value={"project": "test"})
+            create.recore.mongo.initialize_state = mock.MagicMock(
+                return_value=1234567890)
+            channel.basic_publish.side_effect = \
+                pika.exceptions.ConnectionClosed()
+            try:
+                assert create.release(
+                    channel, 'test', 'replyto', {}) == "1234567890"
+            finally:
+                channel.basic_publish.side_effect = None
 
     def test_release_if_project_does_not_exist(self):
         """
@@ -59,3 +84,198 @@ class TestJobCreate(TestCase):
                 return_value={})
 
             assert create.release(channel, 'test', 'replyto', {}) is None
+
+    def test_release_with_invalid_playbook(self):
+        """
+        Verify create.release refuses to start a release of a playbook
+        which does not compile
+        """
+        with mock.patch(
+                'recore.job.create.recore.mongo') as create.recore.mongo:
+            create.recore.mongo.lookup_project = mock.MagicMock(
+                return_value={"project": "test",
+                              "steps": [{"name": "no plugin"}]})
+            create.recore.mongo.initialize_state = mock.MagicMock()
+
+            assert create.release(channel, 'test', 'replyto', {}) is None
+            assert create.recore.mongo.initialize_state.call_count == 0
+            assert channel.basic_publish.call_count == 0
+
+    def test_release_with_missing_dynamic(self):
+        """
+        Verify create.release refuses to start a release when dynamic
+        items declared by the playbook's steps are not given
+        """
+        with mock.patch(
+                'recore.job.create.recore.mongo') as create.recore.mongo:
+            create.recore.mongo.lookup_project = mock.MagicMock(
+                return_value={"project": "test",
+                              "steps": [{"plugin": "juicer",
+                                         "dynamic": ["cart", "env"]}]})
+            create.recore.mongo.initialize_state = mock.MagicMock(
+                return_value=1234567890)
+
+            assert create.release(
+                channel, 'test', 'replyto', {'cart': 'c'}) is None
+            assert create.release(channel, 'test', 'replyto', []) is None
+            assert create.recore.mongo.initialize_state.call_count == 0
+
+            assert create.release(
+                channel, 'test', 'replyto',
+                {'cart': 'c', 'env': 'e'}) == "1234567890"
+
+    def test_release_batch(self):
+        """
+        Verify create.release_batch looks projects up once, creates the
+        valid releases in bulk and replies with every id in order
+        """
+        with mock.patch(
+                'recore.job.create.recore.mongo') as create.recore.mongo:
+            create.recore.mongo.lookup_projects = mock.MagicMock(
+                return_value={
+                    "good": {"project": "good", "steps": []},
+                    "bad": {"project": "bad",
+                            "steps": [{"name": "no plugin"}]}})
+            create.recore.mongo.initialize_states = mock.MagicMock(
+                return_value=[111, 222])
+
+            ids = create.release_batch(channel, [
+                {"project": "good"},
+                {"project": "bad"},
+                {"project": "missing"},
+                {"no": "project"},
+                {"project": "good", "dynamic": {"cart": "c"}}], 'replyto')
+
+            assert ids == ["111", None, None, None, "222"]
+            assert create.recore.mongo.lookup_projects.call_count == 1
+            create.recore.mongo.initialize_states.assert_called_once_with(
+                create.recore.mongo.database,
+                [("good", {}, []), ("good", {"cart": "c"}, [])])
+            channel.basic_publish.assert_called_once_with(
+                exchange='',
+                routing_key='replyto',
+                body='{"ids": ["111", null, null, null, "222"]}',
+                properties=mock.ANY)
+
+    def test_release_batch_nothing_valid(self):
+        """
+        Verify create.release_batch does not insert when every release
+        is rejected, but still replies
+        """
+        with mock.patch(
+                'recore.job.create.recore.mongo') as create.recore.mongo:
+            create.recore.mongo.lookup_projects = mock.MagicMock(
+                return_value={})
+            create.recore.mongo.initialize_states = mock.MagicMock()
+
+            assert create.release_batch(
+                channel, [{"project": "missing"}], 'replyto') == [None]
+            assert create.recore.mongo.initialize_states.call_count == 0
+            assert channel.basic_publish.call_count == 1
+
+    def test_release_with_idempotency_key(self):
+        """
+        Verify a repeated idempotency key answers with the release it
+        first created instead of creating another
+        """
+        with mock.patch(
+                'recore.job.create.recore.mongo') as create.recore.mongo:
+            create.recore.mongo.lookup_project = mock.MagicMock(
+                return_value={"project": "test"})
+            create.recore.mongo.lookup_idempotent_release = mock.MagicMock(
+                return_value=None)
+            create.recore.mongo.initialize_state = mock.MagicMock(
+                return_value=1234567890)
+
+            assert create.release(
+                channel, 'test', 'replyto', {}, 'key') == "1234567890"
+            assert create.recore.mongo.initialize_state.call_args[1][
+                'idempotency_key'] == 'key'
+
+            # The retry is answered from the LRU
+            assert create.release(
+                channel, 'test', 'replyto', {}, 'key') is None
+            assert create.recore.mongo.initialize_state.call_count == 1
+            assert create.recore.mongo.lookup_idempotent_release.call_count == 1
+            channel.basic_publish.assert_called_with(
+                exchange='',
+                routing_key='replyto',
+                body='{"id": "1234567890"}',
+                properties=mock.ANY)
+
+    def test_release_with_idempotency_key_in_mongo(self):
+        """
+        Verify keys not in the LRU are found in mongo, and that keys
+        from outside the window are given up
+        """
+        now = datetime.datetime.utcnow()
+        with mock.patch(
+                'recore.job.create.recore.mongo') as create.recore.mongo:
+            create.recore.mongo.lookup_project = mock.MagicMock(
+                return_value={"project": "test"})
+            create.recore.mongo.lookup_idempotent_release = mock.MagicMock(
+                return_value={'_id': 'abc', 'created': now})
+            create.recore.mongo.initialize_state = mock.MagicMock(
+                return_value=1234567890)
+
+            assert create.release(
+                channel, 'test', 'replyto', {}, 'key') is None
+            assert create.recore.mongo.initialize_state.call_count == 0
+            assert channel.basic_publish.call_args[1]['body'] == (
+                '{"id": "abc"}')
+
+            create._recent_keys.clear()
+            create.recore.mongo.lookup_idempotent_release.return_value = {
+                '_id': 'abc',
+                'created': now - datetime.timedelta(
+                    seconds=create.IDEMPOTENCY_WINDOW + 1)}
+            assert create.release(
+                channel, 'test', 'replyto', {}, 'key') == "1234567890"
+            create.recore.mongo.release_idempotency_key.assert_called_once_with(
+                create.recore.mongo.database, 'abc')
+
+    def test_release_with_idempotency_key_race(self):
+        """
+        Verify losing the race to insert a key answers with the
+        winner's release
+        """
+        with mock.patch(
+                'recore.job.create.recore.mongo') as create.recore.mongo:
+            create.recore.mongo.lookup_project = mock.MagicMock(
+                return_value={"project": "test"})
+            create.recore.mongo.lookup_idempotent_release = mock.MagicMock(
+                side_effect=[None, {'_id': 'abc',
+                                    'created': datetime.datetime.utcnow()}])
+            create.recore.mongo.initialize_state = mock.MagicMock(
+                side_effect=pymongo.errors.DuplicateKeyError('dup'))
+
+            assert create.release(
+                channel, 'test', 'replyto', {}, 'key') is None
+            assert channel.basic_publish.call_args[1]['body'] == (
+                '{"id": "abc"}')
+
+    def test_remember_key_is_bounded(self):
+        """
+        Verify the LRU of recent keys forgets the oldest keys
+        """
+        now = datetime.datetime.utcnow()
+        with mock.patch('recore.job.create.IDEMPOTENCY_CACHE_SIZE', 2):
+            create.remember_key('a', '1', now)
+            create.remember_key('b', '2', now)
+            create.remember_key('a', '1', now)
+            create.remember_key('c', '3', now)
+            assert list(create._recent_keys) == ['a', 'c']
+
+    def test_init_idempotency(self):
+        """
+        Verify the IDEMPOTENCY config section is applied
+        """
+        window = create.IDEMPOTENCY_WINDOW
+        size = create.IDEMPOTENCY_CACHE_SIZE
+        try:
+            create.init_idempotency({'WINDOW': 60, 'CACHE_SIZE': '10'})
+            assert create.IDEMPOTENCY_WINDOW == 60
+            assert create.IDEMPOTENCY_CACHE_SIZE == 10
+        finally:
+            create.IDEMPOTENCY_WINDOW = window
+            create.IDEMPOTENCY_CACHE_SIZE = size
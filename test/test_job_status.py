@@ -0,0 +1,168 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import json
+import mock
+
+from . import TestCase, unittest
+
+from recore.job import status
+
+# Mocks
+channel = mock.MagicMock()
+
+
+class TestJobStatus(TestCase):
+
+    def setUp(self):
+        self.registry = mock.patch(
+            'recore.job.status.recore.fsm.registry').start()
+        self.registry.get.return_value = None
+        self.admission = mock.patch(
+            'recore.job.status.recore.admission').start()
+        self.admission.position.return_value = None
+        self.admission.QUEUED = 'queued'
+        self.admission.RUNNING = 'running'
+        self.mongo = mock.patch('recore.job.status.recore.mongo').start()
+
+    def tearDown(self):
+        """
+        Reset mocks.
+        """
+        mock.patch.stopall()
+        channel.reset_mock()
+
+    def test_status_running(self):
+        """
+        Verify a release running here is answered from memory
+        """
+        fsm = mock.Mock()
+        fsm.status.return_value = {'id': 'abc123', 'status': 'running'}
+        self.registry.get.return_value = fsm
+
+        status.status(channel, 'abc123', 'replyto', 'corr')
+        self.assertFalse(self.mongo.lookup_release_status.called)
+        publish = channel.basic_publish.call_args[1]
+        self.assertEqual(publish['routing_key'], 'replyto')
+        self.assertEqual(publish['properties'].correlation_id, 'corr')
+        self.assertEqual(json.loads(publish['body']),
+                         {'id': 'abc123', 'status': 'running'})
+
+    def test_status_queued(self):
+        """
+        Verify a release waiting to start says where it is in line
+        """
+        self.admission.position.return_value = 3
+        report = status.status(channel, 'abc123', 'replyto')
+        self.assertEqual(report['status'], 'queued')
+        self.assertEqual(report['position'], 3)
+        self.assertFalse(self.mongo.lookup_release_status.called)
+
+    def test_status_from_mongo(self):
+        """
+        Verify other releases are looked up in mongo
+        """
+        created = datetime.datetime(2014, 6, 1, 12, 0, 0)
+        self.mongo.lookup_release_status.return_value = {
+            'project': 'p',
+            'status': 'running',
+            'created': created,
+            'completed_steps': [{'name': 'a'}],
+            'active_step': {'name': 'b'},
+            'remaining_steps': [{'name': 'c'}, {'name': 'd'}],
+        }
+        report = status.status(channel, 'abc123', 'replyto')
+        self.mongo.lookup_release_status.assert_called_once_with(
+            self.mongo.database, 'abc123')
+        self.assertEqual(report, {
+            'id': 'abc123',
+            'project': 'p',
+            'status': 'running',
+            'step': 'b',
+            'completed': 1,
+            'total': 4,
+            'created': '2014-06-01T12:00:00',
+            'ended': None,
+        })
+
+        # Finished releases are told apart by how they ended
+        self.mongo.lookup_release_status.return_value = {
+            'project': 'p', 'status': 'running', 'ended': created,
+            'failed': True, 'error': 'No worker queue'}
+        report = status.stored_status('abc123')
+        self.assertEqual(report['status'], 'failed')
+        self.assertEqual(report['error'], 'No worker queue')
+
+    def test_status_versioned(self):
+        """
+        Verify the active step of a versioned release is named from its
+        playbook version
+        """
+        step = mock.Mock()
+        step.name = 'b'
+        self.mongo.lookup_playbook_version.return_value = (mock.Mock(), step)
+        self.mongo.lookup_release_status.return_value = {
+            '_id': 'abc123', 'project': 'p', 'status': 'running',
+            'playbook_version': 'v1', 'completed': 1, 'active': 1,
+            'total': 3}
+        report = status.stored_status('abc123')
+        self.mongo.lookup_playbook_version.assert_called_once_with(
+            self.mongo.database, 'v1')
+        self.assertEqual((report['step'], report['completed'],
+                          report['total']), ('b', 1, 3))
+
+    def test_status_archived(self):
+        """
+        Verify archived releases report their step counts
+        """
+        ended = datetime.datetime(2014, 6, 1, 12, 0, 0)
+        self.mongo.lookup_release_status.return_value = {
+            '_id': 'abc123', 'project': 'p', 'ended': ended,
+            'archived': ended, 'completed': 4, 'total': 4}
+        report = status.stored_status('abc123')
+        self.assertEqual((report['status'], report['step'],
+                          report['completed'], report['total']),
+                         ('completed', None, 4, 4))
+        self.assertFalse(self.mongo.lookup_playbook_version.called)
+
+    def test_status_scheduled(self):
+        """
+        Verify scheduled releases say when they start
+        """
+        self.mongo.lookup_release_status.return_value = {
+            '_id': 'abc123', 'project': 'p', 'status': 'scheduled',
+            'start_at': datetime.datetime(2014, 6, 1, 2, 0, 0),
+            'remaining_steps': [{'name': 'a'}]}
+        report = status.stored_status('abc123')
+        self.assertEqual(report['status'], 'scheduled')
+        self.assertEqual(report['start_at'], '2014-06-01T02:00:00')
+
+    def test_status_unknown(self):
+        """
+        Verify releases nobody knows about are reported as unknown
+        """
+        self.mongo.lookup_release_status.return_value = None
+        report = status.status(channel, 'abc123', 'replyto')
+        self.assertEqual(report, {'id': 'abc123', 'status': 'unknown'})
+
+    def test_status_no_reply_to(self):
+        """
+        Verify nothing is sent when the request has no reply_to
+        """
+        self.admission.position.return_value = 3
+        report = status.status(channel, 'abc123', None)
+        self.assertEqual(report['status'], 'queued')
+        self.assertFalse(channel.basic_publish.called)
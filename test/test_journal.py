@@ -0,0 +1,111 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import mock
+import pymongo.errors
+from bson.objectid import ObjectId
+
+from . import TestCase, unittest
+
+from recore import journal
+
+_id = ObjectId()
+
+
+def state_document():
+    return {
+        '_id': _id,
+        'project': 'example',
+        'active_step': None,
+        'completed_steps': [],
+        'remaining_steps': [{'name': 'one'}, {'name': 'two'}],
+    }
+
+
+class TestJournal(TestCase):
+
+    def test_set_entry(self):
+        """Only plain $set updates become entries"""
+        e = journal.set_entry(str(_id), 3, {'$set': {'failed': True}})
+        self.assertEqual(e['release'], _id)
+        self.assertEqual(e['seq'], 3)
+        self.assertEqual(e['type'], journal.SET)
+        self.assertEqual(e['fields'], {'failed': True})
+        self.assertRaises(ValueError, journal.set_entry, _id, 4,
+                          {'$push': {'completed_steps': {}}})
+
+    def test_apply(self):
+        """Entries move steps along and set fields"""
+        doc = state_document()
+        journal.apply(doc, journal.entry(_id, 1, journal.STEP_STARTED))
+        self.assertEqual(doc['active_step'], {'name': 'one'})
+        self.assertEqual(doc['remaining_steps'], [{'name': 'two'}])
+
+        journal.apply(doc, journal.entry(_id, 2, journal.STEP_COMPLETED,
+                                         cached='abc'))
+        self.assertEqual(doc['active_step'], None)
+        self.assertEqual(doc['completed_steps'], [{'name': 'one'}])
+        self.assertEqual(doc['cached_steps'], ['abc'])
+
+        journal.apply(doc, journal.set_entry(_id, 3, {'$set': {'x': 1}}))
+        self.assertEqual(doc['x'], 1)
+        self.assertEqual(doc['journal_seq'], 3)
+
+        self.assertRaises(ValueError, journal.apply, doc,
+                          journal.entry(_id, 4, 'bogus'))
+
+    def test_apply_versioned(self):
+        """Entries move a versioned state document's progress along"""
+        doc = {'_id': _id, 'project': 'example', 'playbook_version': 'v1',
+               'completed': 0, 'active': None, 'total': 2}
+        journal.apply(doc, journal.entry(_id, 1, journal.STEP_STARTED))
+        self.assertEqual(doc['active'], 0)
+        journal.apply(doc, journal.entry(_id, 2, journal.STEP_COMPLETED))
+        self.assertEqual((doc['completed'], doc['active']), (1, None))
+        journal.apply(doc, journal.entry(_id, 3, journal.STEP_STARTED))
+        self.assertEqual(doc['active'], 1)
+        self.assertNotIn('active_step', doc)
+
+    def test_replay_and_snapshot(self):
+        """A snapshot is the state document plus the entries after the
+        seq it already includes, in order"""
+        doc = state_document()
+        doc['journal_seq'] = 1
+        doc['active_step'] = {'name': 'one'}
+        doc['remaining_steps'] = [{'name': 'two'}]
+        d = mock.MagicMock()
+        d['state'].find_one.return_value = doc
+        d['journal'].find.return_value = [
+            journal.entry(_id, 3, journal.STEP_STARTED),
+            journal.entry(_id, 2, journal.STEP_COMPLETED),
+        ]
+
+        self.assertEqual(journal.snapshot(d, str(_id)), 3)
+        d['journal'].find.assert_called_once_with(
+            {'release': _id, 'seq': {'$gt': 1}})
+        (spec, update) = d['state'].update.call_args[0]
+        self.assertEqual(spec, {'_id': _id})
+        self.assertEqual(update['$set']['completed_steps'], [{'name': 'one'}])
+        self.assertEqual(update['$set']['active_step'], {'name': 'two'})
+        self.assertEqual(update['$set']['remaining_steps'], [])
+        self.assertEqual(update['$set']['journal_seq'], 3)
+
+    def test_append_twice(self):
+        """Writing an entry that is already there is not an error"""
+        d = mock.MagicMock()
+        d['journal'].insert.side_effect = pymongo.errors.DuplicateKeyError(
+            'dup')
+        self.assertTrue(journal.append(d, journal.entry(_id, 1, journal.SET,
+                                                        fields={})))
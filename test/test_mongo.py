@@ -109,6 +109,212 @@ class TestMongo(TestCase):
                 })
 
 
+    def test_lookup_projects(self):
+        """
+        Make sure many projects are looked up with a single query
+        """
+        db = mock.MagicMock()
+        collection = mock.MagicMock()
+        collection.find = mock.MagicMock(return_value=[
+            {"project": "a", "steps": []}])
+        db.__getitem__.return_value = collection
+
+        assert mongo.lookup_projects(db, ["a", "b"]) == {
+            "a": {"project": "a", "steps": []}}
+        collection.find.assert_called_once_with(
+            {'project': {'$in': ["a", "b"]}})
+
+        # Error result is {}
+        assert mongo.lookup_projects({}, ["a"]) == {}
+
+    def test_initialize_states(self):
+        """
+        Make sure many states are created with one bulk insert, and
+        without looking their projects up again
+        """
+        db = mock.MagicMock()
+        collection = mock.MagicMock()
+        collection.insert = mock.MagicMock(return_value=[1, 2])
+        db.__getitem__.return_value = collection
+
+        with mock.patch('recore.mongo.lookup_project') as lookup:
+            assert mongo.initialize_states(db, [
+                ('a', {}, []),
+                ('b', {'cart': 'c'}, [{'plugin': 'x'}])]) == [1, 2]
+            assert lookup.call_count == 0
+        assert collection.insert.call_count == 1
+        states = collection.insert.call_args[0][0]
+        assert [s['project'] for s in states] == ['a', 'b']
+        assert states[1]['dynamic'] == {'cart': 'c'}
+        assert states[1]['remaining_steps'] == [{'plugin': 'x'}]
+
+        collection.insert.side_effect = pymongo.errors.PyMongoError('err')
+        self.assertRaises(
+            pymongo.errors.PyMongoError,
+            mongo.initialize_states, db, [('a', {}, [])])
+
+    def test_initialize_state_with_idempotency_key(self):
+        """
+        Make sure the idempotency key is only recorded when given, as
+        the unique index on it is sparse
+        """
+        assert 'idempotency_key' not in mongo.new_state_record('p', {}, [])
+        assert mongo.new_state_record('p', {}, [], 'key')[
+            'idempotency_key'] == 'key'
+
+        db = mock.MagicMock()
+        mongo.ensure_indexes(db)
+        db['state'].ensure_index.assert_any_call(
+            'idempotency_key', unique=True, sparse=True)
+
+    def test_playbook_versions(self):
+        """
+        Make sure a playbook version is stored once and its steps are
+        compiled from the store only when they aren't cached
+        """
+        db = mock.MagicMock()
+        steps = [{'name': 'versioned', 'plugin': 'shexec'}]
+        version = mongo.recore.playbook.playbook_version(steps)
+        mongo._stored_versions.discard(version)
+
+        db['playbook_versions'].insert.side_effect = \
+            pymongo.errors.DuplicateKeyError('E11000')
+        self.assertEqual(mongo.store_playbook_version(db, steps), version)
+        self.assertEqual(mongo.store_playbook_version(db, steps), version)
+        self.assertEqual(db['playbook_versions'].insert.call_count, 1)
+        stored = db['playbook_versions'].insert.call_args[0][0]
+        self.assertEqual(stored['_id'], version)
+        self.assertEqual(stored['steps'], steps)
+
+        with mock.patch('recore.mongo.recore.playbook.compiled_version',
+                        return_value=None):
+            db['playbook_versions'].find_one.return_value = stored
+            compiled = mongo.lookup_playbook_version(db, version)
+            self.assertEqual(compiled[0].name, 'versioned')
+
+            db['playbook_versions'].find_one.return_value = None
+            self.assertRaises(LookupError, mongo.lookup_playbook_version,
+                              db, version)
+        # Now it's compiled the store isn't asked again
+        db['playbook_versions'].find_one.reset_mock()
+        self.assertIs(mongo.lookup_playbook_version(db, version), compiled)
+        self.assertFalse(db['playbook_versions'].find_one.called)
+
+    def test_initialize_versioned_state(self):
+        """
+        Make sure versioned state records reference the playbook
+        version instead of copying its steps
+        """
+        db = mock.MagicMock()
+        steps = [{'name': 'a', 'plugin': 'x'}, {'name': 'b', 'plugin': 'x'}]
+        with mock.patch('recore.mongo.PLAYBOOK_VERSIONS', True):
+            with mock.patch('recore.mongo.store_playbook_version',
+                            return_value='v1') as store:
+                mongo.initialize_state(db, 'p', {}, steps)
+                mongo.initialize_states(db, [('p', {}, steps)])
+        store.assert_called_with(db, steps)
+        state0 = db['state'].insert.call_args_list[0][0][0]
+        self.assertEqual(state0['playbook_version'], 'v1')
+        self.assertEqual(state0['completed'], 0)
+        self.assertIsNone(state0['active'])
+        self.assertEqual(state0['total'], 2)
+        for key in ('completed_steps', 'active_step', 'remaining_steps'):
+            self.assertNotIn(key, state0)
+        states = db['state'].insert.call_args_list[1][0][0]
+        self.assertEqual(states[0]['playbook_version'], 'v1')
+
+    def test_lookup_archived_release_status(self):
+        """
+        Make sure releases no longer in the state collection are looked
+        up in the archive
+        """
+        collections = {'state': mock.MagicMock(),
+                       'state_archive': mock.MagicMock()}
+        db = mock.MagicMock()
+        db.__getitem__.side_effect = collections.__getitem__
+        id = bson.ObjectId()
+        collections['state'].find_one.return_value = None
+        collections['state_archive'].find_one.return_value = {'_id': id}
+        self.assertEqual(mongo.lookup_release_status(db, str(id)),
+                         {'_id': id})
+        collections['state_archive'].find_one.assert_called_once_with(
+            {'_id': id}, fields=mongo.STATUS_FIELDS)
+
+    def test_scheduled_releases(self):
+        """
+        Make sure scheduled releases are recorded, found again and
+        claimed only once
+        """
+        start_at = datetime.datetime(2014, 6, 1, 2, 0, 0)
+        state0 = mongo.new_state_record('p', {}, [], start_at=start_at)
+        self.assertEqual(state0['status'], 'scheduled')
+        self.assertEqual(state0['start_at'], start_at)
+        self.assertNotIn('status', mongo.new_state_record('p', {}, []))
+
+        db = mock.MagicMock()
+        id = bson.ObjectId()
+        db['state'].find.return_value = [{'_id': id, 'start_at': start_at}]
+        self.assertEqual(mongo.lookup_scheduled(db), [(str(id), start_at)])
+        db['state'].find.assert_called_once_with(
+            {'status': 'scheduled'}, fields=['start_at'])
+
+        db['state'].update.return_value = {'n': 1}
+        assert mongo.change_status(db, str(id), 'scheduled', 'running')
+        db['state'].update.assert_called_once_with(
+            {'_id': id, 'status': 'scheduled'},
+            {'$set': {'status': 'running'}})
+        db['state'].update.return_value = {'n': 0}
+        assert not mongo.change_status(db, str(id), 'scheduled', 'running')
+        assert not mongo.cancel_waiting(db, str(id))
+        self.assertEqual(db['state'].update.call_args[0][0]['status'],
+                         {'$in': ['queued', 'scheduled']})
+
+    def test_step_results(self):
+        """
+        Make sure cached step results are looked up within the TTL and
+        recorded with an upsert, and that errors don't propagate
+        """
+        db = mock.MagicMock()
+        collection = mock.MagicMock()
+        collection.find_one = mock.MagicMock(return_value={'_id': 'fp'})
+        db.__getitem__.return_value = collection
+
+        assert mongo.lookup_step_result(db, 'fp') == {'_id': 'fp'}
+        spec = collection.find_one.call_args[0][0]
+        assert spec['_id'] == 'fp'
+        assert '$gt' in spec['created']
+
+        mongo.record_step_result(db, 'fp', 'abc', 'build')
+        (spec, update) = collection.update.call_args[0]
+        assert spec == {'_id': 'fp'}
+        assert update['$set']['release'] == 'abc'
+        assert collection.update.call_args[1] == {'upsert': True}
+
+        collection.find_one.side_effect = pymongo.errors.PyMongoError('e')
+        collection.update.side_effect = pymongo.errors.PyMongoError('e')
+        assert mongo.lookup_step_result(db, 'fp') is None
+        mongo.record_step_result(db, 'fp', 'abc', 'build')
+
+    def test_queued_releases(self):
+        """
+        Make sure admission statuses are recorded and queued releases
+        are found oldest first
+        """
+        db = mock.MagicMock()
+        collection = mock.MagicMock()
+        db.__getitem__.return_value = collection
+        id = '53e3a1e3b9f1d24ab0000000'
+
+        mongo.set_status(db, id, 'queued')
+        collection.update.assert_called_once_with(
+            {'_id': mongo.ObjectId(id)}, {'$set': {'status': 'queued'}})
+
+        collection.find.return_value = [
+            {'_id': 'b', 'created': UTCNOW},
+            {'_id': 'a', 'created': UTCNOW - datetime.timedelta(1)}]
+        assert mongo.lookup_queued(db) == ['a', 'b']
+        assert collection.find.call_args[0][0] == {'status': 'queued'}
+
     def test_initialize_state_with_error(self):
         """
         Make sure that if mongo errors out we are notified with the
@@ -0,0 +1,141 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from . import TestCase, unittest
+
+from recore import playbook
+
+
+STEPS = [
+    {'name': 'one', 'plugin': 'shexec', 'parameters': {'command': 'ls'}},
+    {'name': 'two', 'plugin': 'juicer', 'parameters': {},
+     'dynamic': ['cart', 'environment']},
+    {'name': 'three', 'plugin': 'shexec', 'parameters': {'command': 'id'}},
+]
+
+
+class TestPlaybook(TestCase):
+
+    def test_step(self):
+        """Steps expose the playbook fields and keep the original doc"""
+        step = playbook.Step(STEPS[1])
+        self.assertEqual(step.name, 'two')
+        self.assertEqual(step.plugin, 'juicer')
+        self.assertEqual(step.parameters, {})
+        self.assertEqual(step.dynamic, ('cart', 'environment'))
+        self.assertIs(step.doc, STEPS[1])
+        with self.assertRaises(AttributeError):
+            step.something_else = True
+
+    def test_compile_steps_is_shared(self):
+        """The same playbook version parses to the very same steps"""
+        first = playbook.compile_steps(STEPS)
+        # An equal but separately decoded copy, as from another release
+        second = playbook.compile_steps([dict(s) for s in STEPS])
+        self.assertIs(first, second)
+        self.assertEqual(len(first), 3)
+
+        changed = [dict(s) for s in STEPS]
+        changed[0]['parameters'] = {'command': 'ls -l'}
+        self.assertIsNot(playbook.compile_steps(changed), first)
+
+    def test_compile_steps_cache_is_bounded(self):
+        """Old playbook versions fall out of the step cache"""
+        size = playbook.STEP_CACHE_SIZE
+        try:
+            playbook.STEP_CACHE_SIZE = 2
+            for i in range(5):
+                playbook.compile_steps([{'name': str(i), 'plugin': 'p'}])
+            self.assertEqual(len(playbook._step_cache), 2)
+        finally:
+            playbook.STEP_CACHE_SIZE = size
+
+    def test_step_compiled_fields(self):
+        """Routing keys and parameter JSON are worked out up front"""
+        step = playbook.Step(STEPS[0])
+        self.assertEqual(step.routing_key, 'worker.shexec')
+        self.assertEqual(step.parameters_json, '{"command": "ls"}')
+        self.assertEqual(
+            json.loads(step.body('"proj"', '{"cart": "c"}')),
+            {'project': 'proj',
+             'parameters': {'command': 'ls'},
+             'dynamic': {'cart': 'c'}})
+
+    def test_compile_playbook(self):
+        """Playbook documents compile to their steps"""
+        steps = playbook.compile_playbook({'project': 'p', 'steps': STEPS})
+        self.assertEqual([s.name for s in steps], ['one', 'two', 'three'])
+        self.assertEqual(playbook.compile_playbook({'project': 'p'}), ())
+
+    def test_invalid_playbooks(self):
+        """Malformed playbooks are rejected when compiled"""
+        bad = [
+            {'steps': 'not a list'},
+            {'steps': ['not an object']},
+            {'steps': [[STEPS[0], STEPS[1]]]},
+            {'steps': [{'name': 'no plugin'}]},
+            {'steps': [{'plugin': ''}]},
+            {'steps': [{'plugin': 'has.dots'}]},
+            {'steps': [{'plugin': 'has spaces'}]},
+            {'steps': [{'plugin': 'p', 'name': 7}]},
+            {'steps': [{'plugin': 'p', 'parameters': ['a', 'list']}]},
+            {'steps': [{'plugin': 'p', 'parameters': {'x': object()}}]},
+            {'steps': [{'plugin': 'p', 'dynamic': 'cart'}]},
+            {'steps': [{'plugin': 'p', 'dynamic': [1, 2]}]},
+        ]
+        for doc in bad:
+            with self.assertRaises(playbook.InvalidPlaybook):
+                playbook.compile_playbook(doc)
+
+    def test_invalid_playbooks_are_not_cached(self):
+        """A playbook that failed to compile fails again next time"""
+        doc = {'steps': [{'name': 'no plugin'}]}
+        for _ in range(2):
+            with self.assertRaises(playbook.InvalidPlaybook):
+                playbook.compile_playbook(doc)
+
+    def test_fingerprint(self):
+        """A step's fingerprint covers its plugin, parameters and the
+        dynamic data it is given, and nothing else"""
+        (a, b) = playbook.compile_steps([
+            {'name': 'a', 'plugin': 'p', 'parameters': {'x': 1}},
+            {'name': 'b', 'plugin': 'p', 'parameters': {'x': 1},
+             'cacheable': True}])
+        self.assertFalse(a.cacheable)
+        self.assertTrue(b.cacheable)
+        self.assertEqual(a.fingerprint({'c': 1}), b.fingerprint({'c': 1}))
+        self.assertNotEqual(a.fingerprint({'c': 1}), a.fingerprint({'c': 2}))
+        (c,) = playbook.compile_steps([
+            {'plugin': 'p', 'parameters': {'x': 2}}])
+        self.assertNotEqual(a.fingerprint({}), c.fingerprint({}))
+
+        with self.assertRaises(playbook.InvalidPlaybook):
+            playbook.compile_steps([{'plugin': 'p', 'cacheable': 'yes'}])
+        with self.assertRaises(playbook.InvalidPlaybook):
+            playbook.compile_steps([{'plugin': 'p', 'coalesce': 1}])
+
+    def test_missing_dynamic(self):
+        """Declared dynamic variables not given for a release are found"""
+        steps = playbook.compile_steps(STEPS)
+        self.assertEqual(
+            playbook.missing_dynamic(steps, {}), ['cart', 'environment'])
+        self.assertEqual(
+            playbook.missing_dynamic(steps, {'cart': 'c'}), ['environment'])
+        self.assertEqual(
+            playbook.missing_dynamic(
+                steps, {'cart': 'c', 'environment': 'e', 'extra': 1}), [])
+
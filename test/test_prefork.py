@@ -0,0 +1,139 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import mock
+import os
+
+from . import TestCase, unittest
+
+from recore import prefork
+
+
+def exit_at_once(config, index, queue, interval):
+    queue.put((index, {'pid': os.getpid(), 'active': index, 'queued': 1,
+                       'scheduled': 0}))
+    raise SystemExit(3)
+
+
+class TestPrefork(TestCase):
+
+    def test_worker_config(self):
+        """Workers get their own write-ahead log, and can't share an
+        SQLite store"""
+        config = {'DB': {'BACKEND': 'mongo'},
+                  'WAL': {'PATH': '/var/lib/recore/state.wal'}}
+        self.assertEqual(
+            prefork.worker_config(config, 2, 4)['WAL']['PATH'],
+            '/var/lib/recore/state.wal.2')
+        self.assertEqual(config['WAL']['PATH'], '/var/lib/recore/state.wal')
+        self.assertEqual(prefork.worker_config({'DB': {}}, 0, 4),
+                         {'DB': {}})
+        self.assertRaises(ValueError, prefork.worker_config,
+                          {'DB': {'BACKEND': 'sqlite'}}, 0, 4)
+
+    def test_worker_config_limits(self):
+        """Each worker gets its share of the core's limits"""
+        config = {'ADMISSION': {'MAX_ACTIVE': 10, 'MAX_DB_LATENCY': 0.5},
+                  'PLUGINS': {'shexec': {'CONCURRENCY': 6, 'RATE': 8,
+                                         'BURST': 2},
+                              'free': {}}}
+        configs = [prefork.worker_config(config, index, 4)
+                   for index in range(4)]
+        self.assertEqual([c['ADMISSION']['MAX_ACTIVE'] for c in configs],
+                         [3, 3, 2, 2])
+        self.assertEqual(configs[0]['ADMISSION']['MAX_DB_LATENCY'], 0.5)
+        self.assertEqual(
+            [c['PLUGINS']['shexec']['CONCURRENCY'] for c in configs],
+            [2, 2, 1, 1])
+        self.assertEqual(configs[3]['PLUGINS']['shexec']['RATE'], 2.0)
+        self.assertEqual(configs[3]['PLUGINS']['shexec']['BURST'], 1.0)
+        self.assertEqual(configs[3]['PLUGINS']['free'], {})
+        self.assertEqual(config['ADMISSION']['MAX_ACTIVE'], 10)
+
+    def test_share(self):
+        """Limits are split as evenly as they can be, but never to
+        nothing"""
+        self.assertEqual([prefork.share(2, 3, i) for i in range(3)],
+                         [1, 1, 1])
+        self.assertEqual([prefork.share(7, 3, i) for i in range(3)],
+                         [3, 2, 2])
+
+    def test_replay_logs(self):
+        """Before starting workers the supervisor replays every log an
+        earlier run left, whatever number of workers it had"""
+        config = {'DB': {'SERVERS': ['db'], 'PORT': 27017, 'NAME': 'n',
+                         'PASSWORD': 'p', 'DATABASE': 'recore'},
+                  'WAL': {'PATH': '/tmp/state.wal', 'SIZE': 4096}}
+        with mock.patch('recore.prefork.recore.mongo.connect') as connect:
+            (connection, d) = (mock.Mock(), mock.Mock())
+            connect.return_value = (connection, d)
+            with mock.patch('recore.prefork.recore.wal') as wal:
+                wal.worker_logs.return_value = [
+                    '/tmp/state.wal.0', '/tmp/state.wal.5']
+                with mock.patch('recore.prefork.os.path.exists',
+                                return_value=True):
+                    prefork.replay_logs(config)
+        self.assertEqual(wal.replay.call_args_list, [
+            mock.call(d, '/tmp/state.wal', 4096),
+            mock.call(d, '/tmp/state.wal.0', 4096),
+            mock.call(d, '/tmp/state.wal.5', 4096)])
+        connection.close.assert_called_once_with()
+
+        # Nothing to do without the log
+        with mock.patch('recore.prefork.recore.mongo.connect') as connect:
+            prefork.replay_logs({'DB': {}})
+            self.assertFalse(connect.called)
+
+    def test_merge(self):
+        """The supervisor adds up its workers' stats"""
+        self.assertEqual(prefork.merge({
+            0: {'pid': 10, 'active': 3, 'queued': 1, 'scheduled': 0,
+                'plugins': {'shexec': {'in_flight': 2, 'waiting': 1}}},
+            1: {'pid': 11, 'active': 4, 'queued': 0, 'scheduled': 2,
+                'plugins': {'shexec': {'in_flight': 3, 'waiting': 0},
+                            'noop': {'in_flight': 1, 'waiting': 0}}}}),
+            {'workers': 2, 'active': 7, 'queued': 1, 'scheduled': 2,
+             'plugins': {'shexec': {'in_flight': 5, 'waiting': 1},
+                         'noop': {'in_flight': 1, 'waiting': 0}}})
+
+    def test_restart(self):
+        """Workers which exit are started again after a delay, and
+        their stats are collected"""
+        supervisor = prefork.Supervisor({}, 2, target=exit_at_once)
+        for index in range(2):
+            supervisor.spawn(index).join(5)
+        supervisor.collect(5)
+        supervisor.collect(0.1)
+        self.assertEqual(sorted(supervisor.reports), [0, 1])
+
+        with mock.patch('recore.prefork.recore.backoff.delay',
+                        return_value=1.0) as delay:
+            now = supervisor.started[0] + 2
+            supervisor.check(now)
+            delay.assert_called_with(0)
+        self.assertEqual(supervisor.children[0].exitcode, 3)
+        self.assertEqual(supervisor.restart_at[0], now + 1.0)
+        self.assertEqual(supervisor.reports, {})
+
+        first = supervisor.children[0].pid
+        supervisor.check(now + 1.5)
+        self.assertNotEqual(supervisor.children[0].pid, first)
+        self.assertEqual(supervisor.restart_at, {})
+        supervisor.shutdown()
+        # Exiting again this soon means a longer delay
+        with mock.patch('recore.prefork.recore.backoff.delay',
+                        return_value=1.0) as delay:
+            supervisor.check(supervisor.started[0] + 1)
+            delay.assert_called_with(1)
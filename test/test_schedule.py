@@ -0,0 +1,158 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import time
+import mock
+import pymongo.errors
+
+from . import TestCase, unittest
+
+from recore import schedule
+
+
+class TestTimerWheel(TestCase):
+
+    def test_due(self):
+        """Ids come out once their time has come, earliest first"""
+        wheel = schedule.TimerWheel(slots=10, tick=1.0, now=100)
+        wheel.add('b', 103.5)
+        wheel.add('a', 102)
+        wheel.add('late', 50)
+        self.assertEqual(len(wheel), 3)
+        self.assertEqual(wheel.advance(101), ['late'])
+        self.assertEqual(wheel.advance(101.9), [])
+        self.assertEqual(wheel.advance(104), ['a', 'b'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_rounds(self):
+        """Ids further out than a turn of the wheel wait for theirs"""
+        wheel = schedule.TimerWheel(slots=10, tick=1.0, now=0)
+        wheel.add('far', 25)
+        wheel.add('near', 5)
+        self.assertEqual(wheel.advance(15), ['near'])
+        self.assertIn('far', wheel)
+        self.assertEqual(wheel.advance(24), [])
+        self.assertEqual(wheel.advance(25), ['far'])
+
+    def test_long_sleep(self):
+        """Waking up turns later still finds everything that's due"""
+        wheel = schedule.TimerWheel(slots=10, tick=1.0, now=0)
+        for n in range(50):
+            wheel.add(n, n * 7)
+        self.assertEqual(wheel.advance(1000), range(50))
+
+    def test_remove(self):
+        """Removed and rescheduled ids don't come out when they were
+        due"""
+        wheel = schedule.TimerWheel(slots=10, tick=1.0, now=0)
+        wheel.add('a', 3)
+        wheel.add('b', 3)
+        wheel.add('b', 8)
+        self.assertTrue(wheel.remove('a'))
+        self.assertFalse(wheel.remove('a'))
+        self.assertEqual(wheel.advance(5), [])
+        self.assertEqual(wheel.advance(8), ['b'])
+
+
+class TestSchedule(TestCase):
+
+    def setUp(self):
+        self.mongo = mock.patch('recore.schedule.recore.mongo').start()
+        self.admission = mock.patch(
+            'recore.schedule.recore.admission').start()
+        schedule.wheel = schedule.TimerWheel(now=0)
+
+    def tearDown(self):
+        mock.patch.stopall()
+        schedule.wheel = None
+        schedule._claimed.clear()
+
+    def test_parse_start_at(self):
+        """start_at is an ISO 8601 UTC time or an epoch time"""
+        when = datetime.datetime(2014, 6, 1, 2, 0, 0)
+        for value in ('2014-06-01T02:00:00Z', '2014-06-01T02:00:00',
+                      '2014-06-01T02:00', '2014-06-01T02:00:00.000Z',
+                      1401588000):
+            self.assertEqual(schedule.parse_start_at(value), when)
+        for value in ('tomorrow', '2014-06-01', True, {}):
+            self.assertRaises(ValueError, schedule.parse_start_at, value)
+
+    def test_run_due(self):
+        """Due releases are claimed and started. Those another core
+        claimed are left alone, and ones which couldn't be claimed are
+        tried again."""
+        for (id, when) in (('a', 10), ('b', 11), ('c', 12), ('d', 99)):
+            schedule.add(id, datetime.datetime.utcfromtimestamp(when))
+        self.mongo.change_status.side_effect = [
+            True, False, pymongo.errors.AutoReconnect('gone')]
+        self.assertEqual(schedule.run_due(now=20), ['a'])
+        self.admission.start.assert_called_once_with('a')
+        self.mongo.change_status.assert_any_call(
+            self.mongo.database, 'b', 'scheduled', self.admission.RUNNING)
+        self.assertIn('c', schedule.wheel)
+        self.assertEqual(schedule.scheduled(), 2)
+
+    def test_run_due_start_fails(self):
+        """A claimed release which can't be started is given back and
+        tried again, and the other due releases still start"""
+        for (id, when) in (('a', 10), ('b', 11)):
+            schedule.add(id, datetime.datetime.utcfromtimestamp(when))
+        self.admission.start.side_effect = [
+            pymongo.errors.AutoReconnect('gone'), None]
+        # Claiming works, giving 'a' back doesn't
+        self.mongo.change_status.side_effect = [
+            True, pymongo.errors.AutoReconnect('gone'), True]
+        self.assertEqual(schedule.run_due(now=20), ['b'])
+        self.assertIn('a', schedule.wheel)
+        self.assertIn('a', schedule._claimed)
+
+        # Next time 'a' is started without claiming it again
+        self.admission.start.side_effect = None
+        self.mongo.change_status.reset_mock()
+        later = time.time() + schedule.RETRY_AFTER + 1
+        self.assertEqual(schedule.run_due(now=later), ['a'])
+        self.assertFalse(self.mongo.change_status.called)
+        self.assertEqual(schedule._claimed, set())
+
+        # Given back, it's claimed like any other
+        schedule.add('c', datetime.datetime.utcfromtimestamp(50))
+        self.admission.start.side_effect = pymongo.errors.AutoReconnect('x')
+        self.mongo.change_status.side_effect = [True, True]
+        self.assertEqual(schedule.run_due(now=later + 1), [])
+        self.mongo.change_status.assert_called_with(
+            self.mongo.database, 'c', self.admission.RUNNING, 'scheduled')
+        self.assertEqual(schedule._claimed, set())
+        self.assertIn('c', schedule.wheel)
+
+    def test_unschedule(self):
+        """Unscheduled releases never start"""
+        schedule.add('a', datetime.datetime.utcfromtimestamp(10))
+        self.assertTrue(schedule.is_scheduled('a'))
+        self.assertTrue(schedule.unschedule('a'))
+        self.assertFalse(schedule.is_scheduled('a'))
+        self.assertFalse(schedule.unschedule('a'))
+        self.assertEqual(schedule.run_due(now=20), [])
+
+    def test_init_schedule(self):
+        """Releases still scheduled in the database are loaded"""
+        self.mongo.lookup_scheduled.return_value = [
+            ('a', datetime.datetime(2999, 1, 1))]
+        with mock.patch('recore.schedule.Scheduler') as scheduler:
+            schedule.init_schedule({'TICK': 2})
+            self.assertTrue(scheduler.return_value.start.called)
+        self.assertEqual(schedule.wheel.tick, 2.0)
+        self.assertIn('a', schedule.wheel)
+        schedule.TICK = 1.0
@@ -0,0 +1,49 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import mock
+
+from . import TestCase, unittest
+
+import recore.mongo
+import recore.store
+from recore.store import sqlite
+
+
+class TestStore(TestCase):
+
+    def test_init_store(self):
+        """The DB BACKEND picks the store"""
+        with mock.patch('recore.mongo.init_mongo') as init:
+            recore.store.init_store({'SERVERS': ['db'], 'PORT': 27017})
+            init.assert_called_once_with({'SERVERS': ['db'],
+                                          'PORT': 27017})
+
+        scratch = tempfile.mkdtemp()
+        try:
+            with mock.patch('recore.mongo.database'):
+                recore.store.init_store({
+                    'BACKEND': 'sqlite',
+                    'PATH': os.path.join(scratch, 'recore.db')})
+                self.assertTrue(isinstance(recore.mongo.database,
+                                           sqlite.Database))
+        finally:
+            shutil.rmtree(scratch)
+
+        self.assertRaises(ValueError, recore.store.init_store,
+                          {'BACKEND': 'punchcards'})
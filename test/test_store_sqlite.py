@@ -0,0 +1,123 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import os
+import shutil
+import tempfile
+import mock
+import pymongo.errors
+from bson.objectid import ObjectId
+
+from . import TestCase, unittest
+
+from recore import mongo
+from recore.store import sqlite
+
+
+class TestSQLiteStore(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'recore.db')
+        self.d = sqlite.Database(self.path)
+        mongo.ensure_indexes(self.d)
+
+    def tearDown(self):
+        self.d.close()
+        shutil.rmtree(self.dir)
+
+    def test_state(self):
+        """The state functions of recore.mongo work on it"""
+        self.d['playbooks'].insert({'project': 'p', 'steps': [
+            {'name': 'one', 'plugin': 'shexec'}]})
+        id = mongo.initialize_state(self.d, 'p', {'cart': 'x'})
+        self.assertTrue(isinstance(id, ObjectId))
+        self.d['state'].update({'_id': id}, {
+            '$set': {'active_step': {'name': 'one'}, 'remaining_steps': []},
+            '$push': {'cached_steps': {'release': 'r'}}})
+
+        with mock.patch('recore.mongo.database', self.d):
+            state = mongo.lookup_state(str(id))
+        self.assertEqual(state['project'], 'p')
+        self.assertEqual(state['dynamic'], {'cart': 'x'})
+        self.assertEqual(state['active_step'], {'name': 'one'})
+        self.assertEqual(state['cached_steps'], [{'release': 'r'}])
+        self.assertEqual(
+            mongo.lookup_release_status(self.d, id)['active_step'],
+            {'name': 'one'})
+
+    def test_queries(self):
+        """Queries by indexed and unindexed fields find the same"""
+        for n in xrange(5):
+            self.d['state'].insert({'status': 'queued' if n % 2 else None,
+                                    'n': n, 'created': n})
+        self.assertEqual(sorted(mongo.lookup_queued(self.d)),
+                         sorted(str(s['_id']) for s in self.d['state'].find(
+                             {'n': {'$in': [1, 3]}})))
+        self.assertEqual(len(self.d['state'].find({'n': {'$gt': 2}})), 2)
+        self.assertEqual(self.d['state'].find_one({'n': 7}), None)
+        self.d['state'].remove({'status': 'queued'})
+        self.assertEqual(len(self.d['state'].find()), 3)
+
+        # What it can't do fails the way MongoDB would
+        self.assertRaises(pymongo.errors.OperationFailure,
+                          self.d['state'].find, {'n': {'$regex': '1'}})
+        self.assertRaises(pymongo.errors.OperationFailure,
+                          self.d['state'].update, {'n': 0},
+                          {'$rename': {'n': 'm'}})
+
+    def test_unique(self):
+        """Unique indexes hold, on insert and on update"""
+        self.d['state'].insert({'idempotency_key': 'k'})
+        other = self.d['state'].insert({'project': 'p'})
+        self.assertRaises(pymongo.errors.DuplicateKeyError,
+                          self.d['state'].insert, {'idempotency_key': 'k'})
+        self.assertRaises(pymongo.errors.DuplicateKeyError,
+                          self.d['state'].update, {'_id': other},
+                          {'$set': {'idempotency_key': 'k'}})
+        self.assertRaises(pymongo.errors.DuplicateKeyError,
+                          self.d['state'].insert, {'_id': other})
+
+        self.d['journal'].insert({'release': other, 'seq': 1})
+        self.assertRaises(
+            pymongo.errors.DuplicateKeyError, self.d['journal'].insert,
+            [{'release': other, 'seq': 2}, {'release': other, 'seq': 1}],
+            continue_on_error=True)
+        self.assertEqual(len(self.d['journal'].find({'release': other})), 2)
+
+    def test_reopen(self):
+        """Documents and indexes are still there when reopened"""
+        self.d['state'].insert({'idempotency_key': 'k'})
+        self.d.close()
+        self.d = sqlite.Database(self.path)
+        self.assertEqual(len(self.d['state'].find({'idempotency_key': 'k'})),
+                         1)
+        self.assertRaises(pymongo.errors.DuplicateKeyError,
+                          self.d['state'].insert, {'idempotency_key': 'k'})
+
+    def test_step_results_expire(self):
+        """Expired cached step results are removed"""
+        old = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=mongo.STEP_RESULT_TTL + 1)
+        self.d['step_results'].insert({'_id': 'old', 'created': old})
+        mongo.record_step_result(self.d, 'new', 'r', 'step')
+        self.assertEqual(
+            [s['_id'] for s in self.d['step_results'].find()], ['new'])
+        self.assertEqual(mongo.lookup_step_result(self.d, 'new')['step'],
+                         'step')
+
+    def test_bad_synchronous(self):
+        self.assertRaises(ValueError, sqlite.Database, self.path, 'SOMETIMES')
@@ -0,0 +1,111 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import mock
+import threading
+import pika.exceptions
+import pika.spec
+
+from . import TestCase, unittest
+
+import recore.transport
+from recore.transport import local
+
+
+class TestTransport(TestCase):
+
+    def tearDown(self):
+        recore.transport.TRANSPORT = recore.transport.AMQP
+        local.broker = None
+
+    def test_init_transport(self):
+        """The MQ TRANSPORT picks what connect() connects to"""
+        recore.transport.init_transport({})
+        with mock.patch('recore.transport.pika.BlockingConnection') as conn:
+            with mock.patch('recore.amqp.MQ_CONF', {
+                    'NAME': 'n', 'PASSWORD': 'p', 'SERVER': 'mq'}):
+                self.assertEqual(recore.transport.connect(),
+                                 conn.return_value)
+
+        recore.transport.init_transport({'TRANSPORT': 'local'})
+        self.assertTrue(isinstance(local.broker, local.Broker))
+        self.assertTrue(isinstance(recore.transport.connect(),
+                                   local.Connection))
+
+        self.assertRaises(ValueError, recore.transport.init_transport,
+                          {'TRANSPORT': 'pigeons'})
+
+
+class TestLocalBroker(TestCase):
+
+    def setUp(self):
+        self.broker = local.Broker()
+        self.connection = self.broker.connection()
+        self.channel = self.connection.channel()
+
+    def test_routing(self):
+        """Topic bindings and the default exchange route like RabbitMQ,
+        and binding twice doesn't deliver twice"""
+        self.channel.queue_declare(queue='core')
+        for _ in xrange(2):
+            self.channel.queue_bind(queue='core', exchange='re',
+                                    routing_key='job.#')
+        self.assertTrue(self.channel.basic_publish('re', 'job.create', 'a'))
+        self.assertFalse(self.channel.basic_publish('re', 'other', 'b'))
+        self.assertTrue(self.channel.basic_publish('', 'core', 'c'))
+        self.assertFalse(self.channel.basic_publish('', 'nowhere', 'd'))
+        self.assertEqual(self.broker.queue('core').qsize(), 2)
+
+    def test_passive_declare(self):
+        self.assertRaises(pika.exceptions.ChannelClosed,
+                          self.channel.queue_declare, queue='missing',
+                          passive=True)
+        result = self.channel.queue_declare(queue='')
+        self.assertTrue(result.method.queue.startswith('amq.gen-'))
+
+    def test_requeue_on_close(self):
+        """Unacked messages go back where they were, ahead of anything
+        which came after them, as soon as the connection closes"""
+        self.channel.queue_declare(queue='replies')
+        for body in ('started', 'completed'):
+            self.channel.basic_publish('', 'replies', body,
+                                       pika.spec.BasicProperties())
+        consumer = self.channel.consume('replies')
+        (method, properties, body) = next(consumer)
+        self.assertEqual(body, 'started')
+        self.connection.close()
+        self.assertRaises(pika.exceptions.ConnectionClosed,
+                          self.channel.basic_ack, method.delivery_tag)
+
+        consumer = self.broker.connection().channel().consume('replies')
+        self.assertEqual([next(consumer)[2] for _ in xrange(2)],
+                         ['started', 'completed'])
+
+    def test_consume_cancel(self):
+        """Consuming stops once the channel is cancelled"""
+        self.channel.queue_declare(queue='q')
+        self.channel.basic_publish('', 'q', 'one')
+        got = []
+
+        def consume():
+            for (method, properties, body) in self.channel.consume('q'):
+                self.channel.basic_ack(method.delivery_tag)
+                got.append(body)
+                self.channel.cancel()
+        t = threading.Thread(target=consume)
+        t.start()
+        t.join(1)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(got, ['one'])
@@ -0,0 +1,196 @@
+# Copyright (C) 2014 SEE AUTHORS FILE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import mock
+import os
+import shutil
+import tempfile
+import bson
+import pymongo.errors
+from bson.objectid import ObjectId
+
+from . import TestCase, unittest
+
+from recore import wal
+
+_id = ObjectId()
+
+
+class TestWriteAheadLog(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state.wal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_reopen(self):
+        """What MongoDB doesn't have yet is still there after a
+        restart, and nothing else is"""
+        log = wal.WriteAheadLog(self.path, 4096)
+        log.append({'n': 1})
+        lsn = log.append({'n': 2})
+        log.append({'n': 3})
+        (first, second) = log.pending(2)
+        self.assertEqual(first[0], {'n': 1})
+        log.advance(second[1])
+        self.assertTrue(log.wait(lsn, 0))
+        log.close()
+
+        log = wal.WriteAheadLog(self.path, 4096)
+        self.assertEqual([r for (r, _) in log.pending(10)], [{'n': 3}])
+        log.advance(log.tail)
+        log.close()
+
+        log = wal.WriteAheadLog(self.path, 4096)
+        self.assertEqual(log.pending(10), [])
+
+    def test_reuse(self):
+        """Once flushed the log starts over, and records from before
+        that are never read again"""
+        log = wal.WriteAheadLog(self.path, 4096)
+        for n in xrange(3):
+            log.append({'n': n})
+        log.advance(log.pending(10)[-1][1])
+        self.assertEqual(log.head, wal.HEADER.size)
+        log.append({'n': 'new'})
+        log.close()
+
+        log = wal.WriteAheadLog(self.path, 4096)
+        self.assertEqual([r for (r, _) in log.pending(10)], [{'n': 'new'}])
+
+    def test_torn_record(self):
+        """A record only partly written when we crashed is ignored"""
+        log = wal.WriteAheadLog(self.path, 4096)
+        log.append({'n': 1})
+        end = log.append({'n': 2}) + wal.HEADER.size
+        log.map[end - 1] = 'X'
+        log.close()
+
+        log = wal.WriteAheadLog(self.path, 4096)
+        self.assertEqual([r for (r, _) in log.pending(10)], [{'n': 1}])
+
+    def test_not_a_log(self):
+        """Refuse to use a file which isn't a log"""
+        with open(self.path, 'w') as fp:
+            fp.write('something else entirely')
+        self.assertRaises(ValueError, wal.WriteAheadLog, self.path, 4096)
+
+    def test_too_big(self):
+        log = wal.WriteAheadLog(self.path, 64)
+        self.assertRaises(ValueError, log.append, {'x': 'y' * 100})
+
+    def test_worker_logs(self):
+        """Logs left by prefork workers are replayed when the core
+        starts"""
+        for name in ('state.wal.10', 'state.wal.2', 'state.wal.x',
+                     'state.wal.rejected'):
+            log = wal.WriteAheadLog(os.path.join(self.dir, name), 4096)
+            log.append({'c': 'journal', 'i': {'from': name}})
+            log.close()
+        self.assertEqual(wal.worker_logs(self.path), [
+            self.path + '.2', self.path + '.10'])
+
+        d = mock.MagicMock()
+        with mock.patch.multiple('recore.wal', ENABLED=False, log=None,
+                                 flusher=None, Flusher=mock.DEFAULT):
+            wal.init_wal({'PATH': self.path, 'SIZE': 4096}, d)
+            wal.log.close()
+        self.assertEqual(
+            [c[0][0] for c in d['journal'].insert.call_args_list],
+            [[{'from': 'state.wal.2'}], [{'from': 'state.wal.10'}]])
+        self.assertEqual(wal.WriteAheadLog(self.path + '.2', 4096).pending(1),
+                         [])
+
+    def test_set_aside(self):
+        """A record MongoDB refuses is set aside, and the records
+        around it are still written"""
+        log = wal.WriteAheadLog(self.path, 4096)
+        bad = {'_id': ObjectId()}
+        good = {'_id': _id}
+        for spec in (good, bad, good):
+            log.append({'c': 'state', 'q': spec, 'u': {'$set': {'n': 1}}})
+
+        def update(spec, document):
+            if spec == bad:
+                raise pymongo.errors.OperationFailure('too large')
+        d = mock.MagicMock()
+        d['state'].update.side_effect = update
+        wal.Flusher(d, log).flush()
+
+        self.assertEqual(log.pending(10), [])
+        # After the batch, each record on its own
+        self.assertEqual(
+            [c[0][0] for c in d['state'].update.call_args_list[-3:]],
+            [good, bad, good])
+        with open(self.path + '.rejected', 'rb') as rejected:
+            self.assertEqual(bson.decode_all(rejected.read()), [
+                {'c': 'state', 'q': bad, 'u': {'$set': {'n': 1}}}])
+
+
+class TestWrite(TestCase):
+
+    def test_write(self):
+        """Successive $set updates of a document are merged, pushes
+        made safe to repeat, and inserts batched"""
+        d = mock.MagicMock()
+        spec = {'_id': _id}
+        wal.write(d, [
+            {'c': 'state', 'q': spec, 'u': {'$set': {'a': 1, 'b': 1}}},
+            {'c': 'journal', 'i': {'seq': 1}},
+            {'c': 'state', 'q': spec, 'u': {'$set': {'b': 2}}},
+            {'c': 'state', 'q': spec, 'u': {'$push': {'c': 3}}},
+            {'c': 'journal', 'i': {'seq': 2}},
+        ])
+        self.assertEqual(d['state'].update.call_args_list, [
+            mock.call(spec, {'$set': {'a': 1, 'b': 2}}),
+            mock.call(spec, {'$addToSet': {'c': 3}})])
+        d['journal'].insert.assert_called_once_with(
+            [{'seq': 1}, {'seq': 2}], continue_on_error=True)
+
+    def test_write_again(self):
+        """Inserting records MongoDB already has is fine"""
+        d = mock.MagicMock()
+        d['journal'].insert.side_effect = [
+            pymongo.errors.DuplicateKeyError('dup'),
+            pymongo.errors.DuplicateKeyError('dup'), None]
+        wal.write(d, [{'c': 'journal', 'i': {'seq': 1}},
+                      {'c': 'journal', 'i': {'seq': 2}}])
+        self.assertEqual(d['journal'].insert.call_count, 3)
+
+    @mock.patch('recore.wal.time.sleep')
+    def test_flush_through_outage(self, sleep):
+        """The flusher keeps trying while MongoDB is away"""
+        log = mock.Mock()
+        log.pending.return_value = [({'c': 'journal', 'i': {}}, 42)]
+        d = mock.MagicMock()
+        d['journal'].insert.side_effect = [
+            pymongo.errors.AutoReconnect('failover'), None]
+        wal.Flusher(d, log).flush()
+        self.assertEqual(sleep.call_count, 1)
+        log.advance.assert_called_once_with(42)
+
+    @mock.patch('recore.wal.recore.admission.observe_db_latency')
+    @mock.patch('recore.wal.time.time')
+    def test_flush_latency(self, time, observe):
+        """Admission control is fed the time per record, not per
+        batch"""
+        log = mock.Mock()
+        log.pending.return_value = [
+            ({'c': 'journal', 'i': {'seq': n}}, n) for n in range(4)]
+        time.side_effect = [10.0, 12.0]
+        wal.Flusher(mock.MagicMock(), log).flush()
+        observe.assert_called_once_with(0.5)